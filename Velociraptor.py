@@ -1,13 +1,11 @@
 import tkinter as tk
 from tkinter import ttk
 import tkinter.font as tkfont
+import collections
 import datetime
-import matplotlib
-import matplotlib.style
-matplotlib.use('TkAgg')
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
 import itertools
+import math
+import os
 import bike
 
 # Necessary for py2app to work.
@@ -15,23 +13,565 @@ import tkinter.filedialog
 import tkinter.messagebox
 
 
+# Label of the year selector entry showing every year.
+ALL_YEARS = 'Toutes'
+EPOCH = datetime.datetime(1970, 1, 1)
+# Each year is drawn over this one, a leap year, so that the x axis of the
+# graph is the same for every year.
+REFERENCE_YEAR = 2000
+# Milliseconds between two checks for results of the background thread.
+POLL_INTERVAL = 20
+# Milliseconds between two checks for changes of the rides database when
+# inotify cannot be used.
+WATCH_INTERVAL = 1000
+# Number of years whose graph and statistics are kept.
+VIEW_CACHE_SIZE = 8
+# Kinds of graphs, the cumulative distance and speed of each ride or the
+# distance and duration of the rolling windows of some days.
+CUMULATIVE = 'Cumul'
+GRAPH_KINDS = {CUMULATIVE: None, '7 jours': 7, '30 jours': 30,
+               '365 jours': 365}
+
+
 def format_ride(ride):
     """Create a list of strings representing the given ride."""
     time_str_format = '%Y-%m-%d'
 
-    if ride['duration'] != 0:
-        speed = '{:.1f}'.format(ride['distance'] / ride['duration'])
+    if ride.duration != 0:
+        speed = '{:.1f}'.format(ride.distance / ride.duration)
     else:
         speed = 'nan'
-    elements = [str(ride['id']),
-                ride['timestamp'].strftime(time_str_format),
-                '{:.1f}'.format(ride['distance']),
-                '{:.1f}'.format(ride['duration']), speed]
-    elements.append(ride['comment'])
-    elements.append(ride['url'] != '')
+    elements = [str(ride.id),
+                ride.timestamp.strftime(time_str_format),
+                '{:.1f}'.format(ride.distance),
+                '{:.1f}'.format(ride.duration), speed]
+    elements.append(ride.comment)
+    elements.append(ride.url != '')
     return elements
 
 
+def ride_speed(ride):
+    """Return the average speed of the ride, NaN if its duration is zero."""
+    if ride.duration != 0:
+        return ride.distance / ride.duration
+    return float('nan')
+
+
+def graph_day(timestamp, all_years):
+    """Return the x coordinate of ``timestamp`` on the graph, in days since
+    1970.  Unless ``all_years`` is true, the timestamp is first moved to
+    ``REFERENCE_YEAR``."""
+    if not all_years:
+        timestamp = (datetime.datetime(REFERENCE_YEAR, 1, 1) +
+                     (timestamp - datetime.datetime(timestamp.year, 1, 1)))
+    return (timestamp - EPOCH).total_seconds() / 86400
+
+
+def nice_ceiling(value):
+    """Return a round number a little above ``value``, used as the upper
+    limit of an axis so that it does not change for every small change of
+    the data."""
+    if not value > 0:
+        return 1.0
+    step = 10 ** math.floor(math.log10(value)) / 2
+    return math.ceil(value * 1.05 / step) * step
+
+
+def lttb(x, y, threshold):
+    """Downsample the points ``(x, y)`` to ``threshold`` points, keeping the
+    shape of the series, with the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and last points are kept and the others are split into
+    ``threshold - 2`` buckets.  From each bucket, the point that forms the
+    largest triangle with the point kept from the previous bucket and the
+    average of the next bucket is kept.  Return the arrays of the x and y
+    coordinates of the points kept.
+
+    """
+    import numpy as np
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+    # Speeds of rides without a duration are NaN, they must not win.
+    finite_y = np.nan_to_num(y)
+    # Bucket i holds the points bounds[i] to bounds[i + 1], the last bucket
+    # holds the last point.
+    bounds = np.append(np.linspace(1, n - 1, threshold - 1).astype(int), n)
+    sizes = np.diff(bounds)
+    mean_x = np.add.reduceat(x, bounds[:-1]) / sizes
+    mean_y = np.add.reduceat(finite_y, bounds[:-1]) / sizes
+    kept = np.empty(threshold, dtype=int)
+    kept[0] = 0
+    kept[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = bounds[i], bounds[i + 1]
+        areas = np.abs((x[a] - mean_x[i + 1]) * (finite_y[start:end] -
+                                                  finite_y[a]) -
+                       (x[a] - x[start:end]) * (mean_y[i + 1] - finite_y[a]))
+        a = start + int(areas.argmax())
+        kept[i + 1] = a
+    return x[kept], y[kept]
+
+
+def bisect_rides(rides, epoch, right=False):
+    """Return the index at which a ride with the timestamp ``epoch``, as
+    :attr:`bike.Ride.epoch`, would be inserted in the chronologically sorted
+    ``rides``, before the rides with the same timestamp, or after them if
+    ``right`` is true."""
+    low, high = 0, len(rides)
+    while low < high:
+        middle = (low + high) // 2
+        if (rides[middle].epoch < epoch or
+                right and rides[middle].epoch == epoch):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def graph_data(rides, all_years):
+    """Return the cumulative distances, the x coordinates and the speeds of
+    the ``rides`` on the graph."""
+    cumsum = list(itertools.accumulate(ride.distance for ride in rides))
+    # Computed from the epochs so that the datetimes of the rides are not
+    # built.  Unless all_years is true, the rides are all of the same year
+    # and the same shift moves them to REFERENCE_YEAR.
+    shift = 0.0
+    if rides and not all_years:
+        shift = (graph_day(rides[0].timestamp, all_years) -
+                 graph_day(rides[0].timestamp, True))
+    days = [ride.epoch / 86400 + shift for ride in rides]
+    speeds = [ride_speed(ride) for ride in rides]
+    return cumsum, days, speeds
+
+
+def graph_lines(data, width):
+    """Return ``(width, distance_x, distance_y, speed_x, speed_y)``, the lines
+    of the graph ``data`` downsampled to ``width`` points."""
+    cumsum, days, speeds = data
+    return (width,) + lttb(days, cumsum, width) + lttb(days, speeds, width)
+
+
+def compute_graph(rides, all_years, width):
+    """Return the graph data of the ``rides`` and its lines for axes
+    ``width`` pixels wide."""
+    data = graph_data(rides, all_years)
+    return [data, graph_lines(data, width)]
+
+
+def compute_trend(rides, year, window, width):
+    """Return the graph data of the rolling ``window`` days totals of the
+    ``rides`` during ``year``, or during every year if it is ``ALL_YEARS``,
+    and its lines for axes ``width`` pixels wide.  The data is the list of
+    the distances, of the x coordinates and of the durations."""
+    trends = bike.rolling_stats(rides, windows=(window,), distances=())
+    if trends is None:
+        return [([], [], []), None]
+    days = trends['days']
+    distances = trends['distance'][window]
+    durations = trends['duration'][window]
+    all_years = year == ALL_YEARS
+    if not all_years:
+        first = days[0].toordinal()
+        start = max(0, datetime.date(int(year), 1, 1).toordinal() - first)
+        end = max(0, datetime.date(int(year) + 1, 1, 1).toordinal() - first)
+        days = days[start:end]
+        distances = distances[start:end]
+        durations = durations[start:end]
+    x = [graph_day(datetime.datetime.combine(day, datetime.time()), all_years)
+         for day in days]
+    data = (distances, x, durations)
+    return [data, graph_lines(data, width)]
+
+
+def read_rides(position=None):
+    """Read the rides added and edited since ``position``, or every ride if it
+    is ``None``.
+
+    Return a dictionary holding the ``version`` of the database, and the
+    ``position``, ``rides`` and ``edits`` returned by
+    :func:`bike.follow_rides`.  If every ride was read, ``edits`` is ``None``
+    and the dictionary also holds the ``rides_by_year``, the rides by id in
+    ``rides_by_id``, the total distance of each year in ``year_totals``, the
+    ``max_speed`` and the ``search_index``.
+
+    """
+    # Read the version first, changes made while reading are caught by the
+    # next comparison.
+    version = bike.db_version()
+    position, rides, edits = bike.follow_rides(position)
+    data = {'version': version, 'position': position, 'rides': rides,
+            'edits': edits}
+    if edits is None:
+        rides_by_year = group_by_year(rides)
+        data['rides_by_year'] = rides_by_year
+        data['rides_by_id'] = {ride.id: ride for ride in rides}
+        data['year_totals'] = {year: sum(ride.distance for ride in rides)
+                               for year, rides in rides_by_year.items()}
+        data['max_speed'] = max((speed for speed in
+                                 (ride_speed(ride) for ride in rides)
+                                 if not math.isnan(speed)), default=0.0)
+        data['search_index'] = bike.search_index(rides, version)
+    return data
+
+
+def import_matplotlib():
+    """Import the parts of matplotlib the graph uses."""
+    import matplotlib
+    matplotlib.use('TkAgg')
+    import matplotlib.dates
+    import matplotlib.style
+    import matplotlib.backends.backend_tkagg
+    import matplotlib.figure
+
+
+def find_ride(rides, ride):
+    """Return the index of ``ride`` in the chronologically sorted
+    ``rides``.  Raise ``ValueError`` if it is not there."""
+    index = bisect_rides(rides, ride.epoch)
+    while index < len(rides) and rides[index].epoch == ride.epoch:
+        if rides[index].id == ride.id:
+            return index
+        index += 1
+    raise ValueError('ride {} not found'.format(ride.id))
+
+
+def group_by_year(rides):
+    """Return a dictionary mapping each year to the list of its rides, in the
+    order of ``rides``."""
+    rides_by_year = {}
+    for ride in rides:
+        rides_by_year.setdefault(ride.year, []).append(ride)
+    return rides_by_year
+
+
+class LRUCache(object):
+    """Mapping that only keeps its ``maxsize`` most recently used entries."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+    def values(self):
+        return self.entries.values()
+
+
+class FileWatcher(object):
+    """Tell whether some files changed, with inotify where it is available
+    and by comparing their inode, size and modification time otherwise.
+
+    Files are watched through their directory, so that their replacement by
+    another file, as when the rides are rewritten, is noticed too.
+
+    """
+
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+    # IN_DELETE
+    INOTIFY_MASK = 0x2 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.names = {os.fsencode(os.path.basename(path)) for path in paths}
+        self.fd = self._inotify(os.path.dirname(os.path.abspath(paths[0])))
+        self.stamps = self._stamps()
+
+    def _inotify(self, dirname):
+        """Return a non-blocking inotify file descriptor watching
+        ``dirname``, or ``None`` if inotify is not available."""
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(dirname),
+                                  self.INOTIFY_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _stamps(self):
+        stamps = []
+        for path in self.paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stamps.append(None)
+            else:
+                stamps.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return stamps
+
+    def changed(self):
+        """Return whether the files changed since the last call."""
+        if self.fd is None:
+            stamps = self._stamps()
+            changed, self.stamps = stamps != self.stamps, stamps
+            return changed
+        import struct
+        changed = False
+        while True:
+            try:
+                events = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            pos = 0
+            while pos < len(events):
+                wd, mask, cookie, length = struct.unpack_from('iIII', events,
+                                                              pos)
+                pos += struct.calcsize('iIII')
+                name = events[pos:pos + length].rstrip(b'\0')
+                pos += length
+                changed |= name in self.names
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class RidesView(ttk.Frame):
+    """List of rides that only creates and formats the rows it displays.
+
+    The Treeview holds one item per visible row and scrolling changes the
+    rides these items show, so that scrolling and replacing the rides take
+    the same time however many rides there are.
+
+    """
+    colnames = ['id', 'Date', 'Distance (km)', 'Durée (h)',
+                'Vitesse (km/h)', 'Commentaire', 'url']
+
+    def __init__(self, master):
+        ttk.Frame.__init__(self, master)
+        self.rides = []
+        # Index of the ride shown in the first row, number of rows that fit
+        # in the view, index of the selected ride.
+        self.first = 0
+        self.num_rows = 10
+        self.selected = None
+        self.row_metrics = None
+        self.tree = ttk.Treeview(self, columns=self.colnames,
+                selectmode='browse')
+        # Make rides view resizable.
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+        self.tree.grid(column=0, row=0, sticky='ewns')
+
+        # Add scrollbars, the vertical one scrolls through the rides rather
+        # than through the items of the Treeview.
+        self.vsb = ttk.Scrollbar(self, orient='vertical', command=self.yview)
+        hsb = ttk.Scrollbar(self, orient='horizontal',
+                command=self.tree.xview)
+        self.tree.configure(xscrollcommand=hsb.set)
+        hsb.grid(column=0, row=1, sticky='ew')
+        self.vsb.grid(column=1, row=0, sticky='ns')
+
+        # Adjust columns
+        self.tree.column('#0', width=0, stretch=False)
+        for col in self.colnames:
+            self.tree.heading(col, text=col)
+            width = tkfont.Font().measure(col) + 10
+            self.tree.column(col, minwidth=width, width=width)
+        id_width = tkfont.Font().measure('9999') + 10
+        self.tree.column('id', width=id_width, minwidth=id_width,
+                anchor=tk.CENTER)
+        date_width = 100
+        self.tree.column('Date', width=date_width, minwidth=date_width,
+                anchor=tk.CENTER)
+        comment_width = 160
+        self.tree.column('Commentaire', width=comment_width,
+                minwidth=comment_width)
+        for col in ['Distance (km)', 'Durée (h)', 'Vitesse (km/h)']:
+            self.tree.column(col, anchor=tk.E)
+
+        self.tree.bind('<Configure>', self._fit)
+        self.tree.bind('<<TreeviewSelect>>', self._on_select)
+        for sequence in ['<MouseWheel>', '<Button-4>', '<Button-5>']:
+            self.tree.bind(sequence, self._on_wheel)
+        for sequence, step in [('<Up>', -1), ('<Down>', 1),
+                               ('<Prior>', 'page_up'), ('<Next>', 'page_down'),
+                               ('<Home>', 'home'), ('<End>', 'end')]:
+            self.tree.bind(sequence,
+                    lambda event, step=step: self._move_selection(step))
+
+    def set_rides(self, rides):
+        """Show ``rides``, scrolled to the top, with no selection."""
+        self.rides = rides
+        self.first = 0
+        self.selected = None
+        self.refresh()
+
+    def selected_ride(self):
+        """Return the selected ride, or ``None``."""
+        if self.selected is None or self.selected >= len(self.rides):
+            return None
+        return self.rides[self.selected]
+
+    def select(self, index):
+        """Select the ride at ``index`` and scroll to show it."""
+        self.selected = index
+        if index < self.first:
+            self.scroll_to(index)
+        elif index >= self.first + self.num_rows:
+            self.scroll_to(index - self.num_rows + 1)
+        self.refresh()
+
+    def inserted(self, index):
+        """Update the view after a ride was inserted at ``index`` in the list
+        of rides it shows."""
+        if self.selected is not None and self.selected >= index:
+            self.selected += 1
+        if index < self.first:
+            self.first += 1
+        self.refresh()
+
+    def removed(self, index):
+        """Update the view after the ride at ``index`` was removed from the
+        list of rides it shows."""
+        if self.selected == index:
+            self.selected = None
+        elif self.selected is not None and self.selected > index:
+            self.selected -= 1
+        if index < self.first:
+            self.first -= 1
+        self.first = max(0, min(self.first, len(self.rides) - self.num_rows))
+        self.refresh()
+
+    def refresh(self):
+        """Fill the items of the Treeview with the rides from ``first``."""
+        count = max(0, min(self.num_rows, len(self.rides) - self.first))
+        items = self.tree.get_children()
+        if len(items) > count:
+            self.tree.delete(*items[count:])
+        for i in range(count):
+            values = format_ride(self.rides[self.first + i])
+            if i < len(items):
+                self.tree.item(items[i], values=values)
+            else:
+                self.tree.insert('', 'end', iid=str(i), values=values)
+        if self.selected is not None and 0 <= self.selected - self.first < count:
+            self.tree.selection_set(str(self.selected - self.first))
+        else:
+            self.tree.selection_set(())
+        if self.rides:
+            self.vsb.set(self.first / len(self.rides),
+                         (self.first + count) / len(self.rides))
+        else:
+            self.vsb.set(0, 1)
+        if self.row_metrics is None and count:
+            self._fit()
+
+    def yview(self, *args):
+        """Scroll through the rides, called by the vertical scrollbar with the
+        arguments of the ``yview`` method of scrollable widgets."""
+        if args[0] == 'moveto':
+            self.scroll_to(int(round(float(args[1]) * len(self.rides))))
+        elif args[0] == 'scroll':
+            step = int(args[1])
+            if args[2] == 'pages':
+                step *= self.num_rows
+            self.scroll_to(self.first + step)
+
+    def scroll_to(self, first):
+        """Show the rides from index ``first`` in the first row."""
+        first = max(0, min(first, len(self.rides) - self.num_rows))
+        if first != self.first:
+            self.first = first
+            self.refresh()
+
+    def _fit(self, event=None):
+        """Adjust the number of rows to the height of the Treeview."""
+        if event is None and not self.tree.winfo_ismapped():
+            # The size is not known yet, a <Configure> event will follow.
+            return
+        items = self.tree.get_children()
+        bbox = self.tree.bbox(items[0]) if items else ''
+        if bbox:
+            # Height of the headings and of a row.
+            self.row_metrics = bbox[1], bbox[3]
+        if self.row_metrics is not None:
+            heading_height, row_height = self.row_metrics
+        else:
+            row_height = tkfont.nametofont('TkDefaultFont').metrics(
+                    'linespace')
+            heading_height = row_height
+        if event is not None:
+            height = event.height
+        else:
+            height = self.tree.winfo_height()
+        num_rows = max(1, (height - heading_height) // row_height)
+        if num_rows != self.num_rows:
+            self.num_rows = num_rows
+            self.first = max(0, min(self.first,
+                                    len(self.rides) - self.num_rows))
+            self.refresh()
+
+    def _on_select(self, event):
+        selection = self.tree.selection()
+        if selection:
+            self.selected = self.first + int(selection[0])
+
+    def _on_wheel(self, event):
+        if event.num == 4:
+            step = -1
+        elif event.num == 5:
+            step = 1
+        elif abs(event.delta) >= 120:
+            # Windows, multiples of 120 per notch.
+            step = -event.delta // 120
+        else:
+            # macOS
+            step = -event.delta
+        self.yview('scroll', 3 * step, 'units')
+        return 'break'
+
+    def _move_selection(self, step):
+        """Move the selection by ``step`` rides, or by a page or to the first or
+        the last ride, and scroll to keep it visible."""
+        if not self.rides:
+            return 'break'
+        if step == 'page_up':
+            step = -self.num_rows
+        elif step == 'page_down':
+            step = self.num_rows
+        elif step == 'home':
+            step = -len(self.rides)
+        elif step == 'end':
+            step = len(self.rides)
+        if self.selected is None:
+            index = self.first
+        else:
+            index = max(0, min(self.selected + step, len(self.rides) - 1))
+        self.select(index)
+        return 'break'
+
+
 class RideDetailDialog(tk.Toplevel):
     def __init__(self, parent, title=None, ride=None):
         tk.Toplevel.__init__(self, parent)
@@ -100,12 +640,12 @@ class RideDetailDialog(tk.Toplevel):
 
     def ok(self, event=None):
         if not self.validate():
+            self.result = None
             self.initial_focus.focus_set()  # invalid entry, focus back
             return
 
         self.withdraw()
         self.update_idletasks()
-        self.apply()
         self.cancel()
 
     def cancel(self, event=None):
@@ -135,23 +675,15 @@ class RideDetailDialog(tk.Toplevel):
         except ValueError:
             self.fields[2].configure(foreground='red')
             valid = False
-        self.result.append(self.fields[3].get())
-        self.result.append(self.fields[4].get())
+        # A ride takes a single line of the rides file.
+        for field in self.fields[3:]:
+            text = field.get()
+            if '\n' in text or '\r' in text:
+                field.configure(foreground='red')
+                valid = False
+            self.result.append(text)
         return valid
 
-    def apply(self):
-        if self.ride is not None:
-            # Update rides database
-            self.ride['timestamp'] = self.result[0]
-            self.ride['distance'] = self.result[1]
-            self.ride['duration'] = self.result[2]
-            self.ride['comment'] = self.result[3]
-            self.ride['url'] = self.result[4]
-            bike.update_db(self.parent.rides)
-        else:
-            # Append new ride to database
-            bike.add_ride(*self.result)
-
 
 class VelociraptorGui(tk.Tk):
     def __init__(self, parent):
@@ -165,7 +697,7 @@ class VelociraptorGui(tk.Tk):
         """Setup the GUI widgets.
 
         +----------------------------------+
-        | Add button   Edit button         |
+        | Add button   Edit button  Search |
         +----------------------------------+
         |                     |            |
         |                     | Graph view |
@@ -177,14 +709,90 @@ class VelociraptorGui(tk.Tk):
         +----------------------------------+
 
         """
+        import concurrent.futures
+        # Reading the rides and computing the graph and the statistics is
+        # done in a background thread, the results are handed back to the Tk
+        # thread by _poll_tasks.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.tasks = []
+        self.polling = False
+        # Incremented whenever the rides shown change, results computed for
+        # older generations are dropped.
+        self.generation = 0
+        self.loaded = False
+        # Changes made to the database by other programs are read from
+        # follow_position on, one read at a time.
+        self.watcher = None
+        self.following = False
+        self.follow_again = False
+        # Whether the rides view shows the rides found by the search box
+        # rather than those of the selected year.
+        self.searching = False
         self.buttonbox()
         self._init_rides_view()
-        self._init_graph_view()
+        self.graph_view = None
+        self.graph_entry = None
         self._init_stats_view()
         self.grid_columnconfigure(0, weight=1)
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(1, weight=1)
         self.focus_set()
+        # Importing matplotlib is slow, the graph is only added once it is
+        # done.
+        self.run_in_background(import_matplotlib, self._init_graph_view,
+                               generation=None)
+        self.reload()
+
+    def run_in_background(self, function, callback, *args, generation=0):
+        """Call ``function(*args)`` in the background thread, then
+        ``callback`` with its result in the Tk thread, unless the rides shown
+        changed in between.  With ``generation=None``, ``callback`` is always
+        called."""
+        if generation is not None:
+            generation = self.generation
+        future = self.executor.submit(function, *args)
+        self.tasks.append((future, generation, callback))
+        if not self.polling:
+            self.polling = True
+            self.after(POLL_INTERVAL, self._poll_tasks)
+
+    def cancel_tasks(self):
+        """Drop the results of the background tasks for the rides shown so
+        far, and do not even start those still waiting."""
+        self.generation += 1
+        for future, generation, callback in self.tasks:
+            if generation is not None:
+                future.cancel()
+
+    def _poll_tasks(self):
+        tasks, self.tasks = self.tasks, []
+        pending = []
+        try:
+            for task in tasks:
+                future, generation, callback = task
+                if not future.done():
+                    pending.append(task)
+                elif not future.cancelled() and generation in (
+                        None, self.generation):
+                    # A failed task must not keep the others from finishing.
+                    try:
+                        callback(future.result())
+                    except Exception as error:
+                        self.report_error(error)
+        finally:
+            # Callbacks may have started new tasks.
+            self.tasks = pending + self.tasks
+            if self.tasks:
+                self.after(POLL_INTERVAL, self._poll_tasks)
+            else:
+                self.polling = False
+
+    def report_error(self, error):
+        """Show ``error`` in place of the statistics, and its traceback on the
+        standard error."""
+        self.stats_text.set('Erreur : {}'.format(error))
+        self.report_callback_exception(type(error), error,
+                                       error.__traceback__)
 
     def buttonbox(self):
         """Add standard button box."""
@@ -195,6 +803,16 @@ class VelociraptorGui(tk.Tk):
         edit_button.pack(side=tk.LEFT)
         del_button = ttk.Button(box, text='Effacer', command=self.del_ride)
         del_button.pack(side=tk.LEFT)
+        # Disabled while the rides are read.
+        self.edit_buttons = [add_button, edit_button, del_button]
+
+        search_label = ttk.Label(box, text='Rechercher :')
+        search_label.pack(side=tk.LEFT, padx=(10, 2))
+        self.search_text = tk.StringVar()
+        self.search_text.trace_add('write', lambda *args: self.show_rides())
+        search_entry = ttk.Entry(box, textvariable=self.search_text,
+                                 width=20)
+        search_entry.pack(side=tk.LEFT)
 
         self.year = tk.StringVar()
         self.year_combo = ttk.Combobox(box, textvariable=self.year, width=10)
@@ -202,112 +820,387 @@ class VelociraptorGui(tk.Tk):
         self.year_combo.pack(side=tk.RIGHT)
         self.year_combo.state(['readonly'])
 
+        self.graph_kind = tk.StringVar(value=CUMULATIVE)
+        kind_combo = ttk.Combobox(box, textvariable=self.graph_kind,
+                                  values=list(GRAPH_KINDS), width=10)
+        kind_combo.bind('<<ComboboxSelected>>',
+                        lambda event: self.update_graph_view())
+        kind_combo.pack(side=tk.RIGHT)
+        kind_combo.state(['readonly'])
+
         box.grid(column=0, row=0, columnspan=2, sticky='ew', ipadx=5, ipady=5)
 
     def _init_rides_view(self):
-        colnames = ['id', 'Date', 'Distance (km)', 'Durée (h)',
-                    'Vitesse (km/h)', 'Commentaire', 'url']
-        self.rides_container = ttk.Frame(self)
-        self.rides_container.grid(column=0, row=1, rowspan=2, sticky='ewns')
-        self.rides_view = ttk.Treeview(self.rides_container, columns=colnames,
-                selectmode='browse')
-        # Make rides view resizable.
-        self.rides_container.grid_columnconfigure(0, weight=1)
-        self.rides_container.grid_rowconfigure(0, weight=1)
-        self.rides_view.grid(column=0, row=0, sticky='ewns')
-
-        # Add scrollbars
-        vsb = ttk.Scrollbar(self.rides_container, orient='vertical',
-                command=self.rides_view.yview)
-        hsb = ttk.Scrollbar(self.rides_container, orient='horizontal',
-                command=self.rides_view.xview)
-        self.rides_view.configure(xscrollcommand=hsb.set,
-                yscrollcommand=vsb.set)
-        hsb.grid(column=0, row=1, sticky='ew')
-        vsb.grid(column=1, row=0, sticky='ns')
-
-        # Adjust columns
-        self.rides_view.column('#0', width=0, stretch=False)
-        for col in colnames:
-            self.rides_view.heading(col, text=col)
-            width = tkfont.Font().measure(col) + 10
-            self.rides_view.column(col, minwidth=width, width=width)
-        id_width = tkfont.Font().measure('9999') + 10
-        self.rides_view.column('id', width=id_width, minwidth=id_width,
-                anchor=tk.CENTER)
-        date_width = 100
-        self.rides_view.column('Date', width=date_width, minwidth=date_width,
-                anchor=tk.CENTER)
-        comment_width = 160
-        self.rides_view.column('Commentaire', width=comment_width,
-                minwidth=comment_width)
-        for col in ['Distance (km)', 'Durée (h)', 'Vitesse (km/h)']:
-            self.rides_view.column(col, anchor=tk.E)
+        self.rides_view = RidesView(self)
+        self.rides_view.grid(column=0, row=1, rowspan=2, sticky='ewns')
 
         # Bind double click events
-        self.rides_view.bind('<Double-1>', self.edit_ride)
+        self.rides_view.tree.bind('<Double-1>', self.edit_ride)
 
-        # Populate the view with data
         self.year.set(str(datetime.datetime.now().year))
-        self.load_data()
-        self.update_rides_view()
-        if self.years:
-            self.year.set(self.years[0])
 
     def change_year(self, event):
+        if self.loaded:
+            self.show_year()
+
+    @bike.profiled
+    def load_data(self, data=None):
+        """Store every ride, as returned by :func:`read_rides`, reading them
+        if not given."""
+        if data is None:
+            data = read_rides()
+        self.db_version = data['version']
+        self.follow_position = data['position']
+        self.rides_by_year = data['rides_by_year']
+        self.year_totals = data['year_totals']
+        self.max_speed = data['max_speed']
+        self.search_index = data['search_index']
+        # Kept up to date by _insert_ride and _remove_ride.
+        self.rides_by_id = data['rides_by_id']
+        # What is computed for the views of each year is kept until a ride
+        # of that year changes.
+        self.view_cache = LRUCache(VIEW_CACHE_SIZE)
+        self.update_years()
+
+    def update_years(self):
+        self.years = sorted((year for year, rides in self.rides_by_year.items()
+                             if rides), reverse=True)
+        self.year_combo['values'] = self.years + [ALL_YEARS]
+
+    def reload(self):
+        """Read every ride again, in the background, and update the views
+        from scratch once done."""
+        self.cancel_tasks()
+        self.loaded = False
+        for button in self.edit_buttons:
+            button.state(['disabled'])
+        self.stats_text.set('Chargement...')
+        self.run_in_background(read_rides, self._rides_read)
+
+    def _rides_read(self, data):
+        self.load_data(data)
+        self.loaded = True
+        for button in self.edit_buttons:
+            button.state(['!disabled'])
+        year = self.year.get()
+        if (self.years and year != ALL_YEARS and
+                int(year) not in self.years):
+            self.year.set(self.years[0])
+        self.show_year()
+        if self.watcher is None:
+            self.watch()
+        elif self.follow_again:
+            self.follow()
+
+    def watch(self):
+        """Follow the changes made to the database by other programs, as
+        soon as inotify reports them or by checking the files every
+        ``WATCH_INTERVAL`` milliseconds."""
+        self.watcher = FileWatcher(bike.db_files())
+        if self.watcher.fd is not None:
+            try:
+                self.tk.createfilehandler(self.watcher.fd, tk.READABLE,
+                                          self._on_file_event)
+                return
+            except (AttributeError, tk.TclError):
+                # File handlers are not supported on Windows.
+                pass
+        self.after(WATCH_INTERVAL, self._check_files)
+
+    def _on_file_event(self, fd, mask):
+        if self.watcher.changed():
+            self.follow()
+
+    def _check_files(self):
+        if self.watcher.changed():
+            self.follow()
+        self.after(WATCH_INTERVAL, self._check_files)
+
+    def follow(self):
+        """Read the rides added and edited since the last read, in the
+        background, and update the views with them.  Only the new lines of
+        the file are read, unless it was rewritten."""
+        if not self.loaded or self.following:
+            # Done once the current read is over.
+            self.follow_again = True
+            return
+        self.following = True
+        self.follow_again = False
+        position = self.follow_position
+        self.run_in_background(read_rides,
+                               lambda data: self._followed(position, data),
+                               position, generation=None)
+
+    def _followed(self, position, data):
+        self.following = False
+        if not self.loaded or position is not self.follow_position:
+            # Read from a position that was since replaced by a reload.
+            self.follow_again = True
+        elif data['edits'] is None:
+            # The database was rewritten, or is stored in a backend that
+            # cannot tell what changed.
+            if data['version'] == self.db_version:
+                self.follow_position = data['position']
+            else:
+                self._rides_read(data)
+                return
+        else:
+            self.follow_position = data['position']
+            self.db_version = data['version']
+            self.apply_changes(self.new_changes(data['rides'],
+                                                data['edits']))
+        if self.follow_again:
+            self.follow()
+
+    def new_changes(self, rides, edits):
+        """Return the list of the ``(old, new)`` ride pairs for the new
+        ``rides`` and the ``edits`` returned by :func:`bike.follow_rides`,
+        leaving out the changes the views already show, such as those made
+        from this window."""
+        # Rides as they will be once the changes are applied, looked up in
+        # rides_by_id otherwise.
+        changed = {}
+        changes = []
+        for ride in rides:
+            if ride.id not in self.rides_by_id:
+                changes.append((None, ride))
+                changed[ride.id] = ride
+        for ride_id, row in edits.items():
+            if ride_id in changed:
+                old = changed[ride_id]
+            else:
+                old = self.rides_by_id.get(ride_id)
+            new = self.make_ride(row, ride_id) if row is not None else None
+            if old != new:
+                changes.append((old, new))
+                changed[ride_id] = new
+        return changes
+
+    def show_year(self):
+        """Show the rides of the selected year right away, and their
+        statistics and graph once computed in the background."""
+        self.cancel_tasks()
         self.update_rides_view()
-        self.update_graph_view()
         self.update_stats()
+        self.update_graph_view()
 
-    def load_data(self):
-        self.rides = bike.read_db_file(year='all')
-        self.years = sorted(list(set(ride['timestamp'].year for ride in
-            self.rides)), reverse=True)
-        self.year_combo['values'] = self.years
-
+    @bike.profiled
     def update_rides_view(self):
-        self.viewable_rides = [ride for ride in self.rides if
-                ride['timestamp'].year == int(self.year.get())]
-        self.rides_view.delete(*self.rides_view.get_children())
-        for ride in self.viewable_rides:
-            self.rides_view.insert('', 'end', values=format_ride(ride))
+        if self.year.get() == ALL_YEARS:
+            entry = self.view_entry()
+            if 'rides' not in entry:
+                entry['rides'] = [ride for year in sorted(self.rides_by_year)
+                                  for ride in self.rides_by_year[year]]
+            self.viewable_rides = entry['rides']
+        else:
+            # Keep the list of an empty year, rides added to it are shown.
+            self.viewable_rides = self.rides_by_year.setdefault(
+                    int(self.year.get()), [])
+        self.show_rides()
+
+    def show_rides(self):
+        """Show the rides of every year matching the text of the search box,
+        as it is typed, or the rides of the selected year if it is empty."""
+        text = self.search_text.get().strip()
+        self.searching = bool(text)
+        if not self.loaded:
+            return
+        if not self.searching:
+            self.rides_view.set_rides(self.viewable_rides)
+            return
+        found = [self.rides_by_id[ride_id]
+                 for ride_id in self.search_index.search(text)]
+        found.sort(key=lambda ride: ride.epoch)
+        self.rides_view.set_rides(found)
+
+    def view_entry(self, key=None):
+        """Return the dictionary of what is kept for the view of the year
+        ``key``, by default the selected one: the ``graph`` data and lines,
+        the ``sums`` of the statistics and, for every year, the list of the
+        ``rides``.  The entry shown is updated in place when a ride
+        changes."""
+        if key is None:
+            key = self.year.get()
+        entry = self.view_cache.get(key)
+        if entry is None:
+            entry = self.view_cache[key] = {}
+        return entry
 
     def get_graph_data(self):
-        cumsum = list(itertools.accumulate(ride['distance'] for ride in
-                        self.viewable_rides))
-        dates = [ride['timestamp'] for ride in self.viewable_rides]
-        speeds = [ride['distance'] / ride['duration'] for ride in
-                self.viewable_rides]
-        return cumsum, dates, speeds
+        return graph_data(self.viewable_rides,
+                          self.year.get() == ALL_YEARS)
 
+    @bike.profiled
     def update_graph_view(self):
-        cumsum, dates, speeds = self.get_graph_data()
-        self.ax1.clear()
-        self.ax2.clear()
-        self.ax1.plot(dates, cumsum)
-        self.ax2.plot(dates, speeds)
-        self.ax1.set_ylabel('distance (km)')
-        self.ax2.set_ylabel('vitesse (km/h)')
-        self.fig.autofmt_xdate()
+        if self.graph_view is None or not self.loaded:
+            return
+        key = self.year.get()
+        window = GRAPH_KINDS[self.graph_kind.get()]
+        entry = self.view_entry(key)
+        if window is None:
+            graph = entry.get('graph')
+        else:
+            graph = entry.get('trends', {}).get(window)
+        if graph is not None:
+            self.graph_entry = graph
+            self.draw_graph()
+            return
+        self.graph_entry = None
+
+        def computed(graph):
+            self._graph_computed(key, window, graph)
+        if window is None:
+            self.run_in_background(compute_graph, computed,
+                                   list(self.viewable_rides),
+                                   key == ALL_YEARS, self.graph_width())
+        else:
+            self.run_in_background(compute_trend, computed,
+                                   self.trend_rides(key), key, window,
+                                   self.graph_width())
+
+    def _graph_computed(self, key, window, graph):
+        entry = self.view_entry(key)
+        if window is None:
+            entry['graph'] = graph
+        else:
+            entry.setdefault('trends', {})[window] = graph
+        if window == GRAPH_KINDS[self.graph_kind.get()]:
+            self.graph_entry = graph
+            self.draw_graph()
+
+    def trend_rides(self, key):
+        """Return the list of the rides the rolling totals of the year
+        ``key`` depend on, which are those of that year and of the one
+        before."""
+        if key == ALL_YEARS:
+            years = sorted(self.rides_by_year)
+        else:
+            years = [int(key) - 1, int(key)]
+        return [ride for year in years
+                for ride in self.rides_by_year.get(year, ())]
+
+    def graph_width(self):
+        """Return the width of the axes of the graph in pixels."""
+        return max(3, int(self.ax1.bbox.width))
+
+    def get_graph_limits(self):
+        """Return the limits of the axes of the graph, which are the same for
+        every year unless all the years are shown."""
+        all_years = self.year.get() == ALL_YEARS
+        window = GRAPH_KINDS[self.graph_kind.get()]
+        distances, days, values = self.graph_entry[0]
+        if all_years:
+            xlim = (days[0] - 1, days[-1] + 1) if days else (0.0, 1.0)
+            max_distance = sum(self.year_totals.values())
+        else:
+            xlim = (graph_day(datetime.datetime(REFERENCE_YEAR, 1, 1), True),
+                    graph_day(datetime.datetime(REFERENCE_YEAR + 1, 1, 1),
+                              True))
+            max_distance = max(self.year_totals.values(), default=0.0)
+        if window is None:
+            max_value = self.max_speed
+        else:
+            # Rolling totals are scaled to the ones shown.
+            max_distance = max(distances, default=0.0)
+            max_value = max(values, default=0.0)
+        return (window, all_years, xlim, (0.0, nice_ceiling(max_distance)),
+                (0.0, nice_ceiling(max_value)))
+
+    def draw_graph(self):
+        """Draw the graph data, downsampled to the width of the axes.  Unless
+        the limits of the axes change, only the lines are redrawn."""
+        data, lines = self.graph_entry
+        width = self.graph_width()
+        if lines is None or lines[0] != width:
+            lines = self.graph_entry[1] = graph_lines(data, width)
+        self.distance_line.set_data(lines[1] + self.day_offset, lines[2])
+        self.speed_line.set_data(lines[3] + self.day_offset, lines[4])
+        limits = self.get_graph_limits()
+        if limits == self.graph_limits and self.graph_background is not None:
+            self.graph_view.restore_region(self.graph_background)
+            self._draw_lines()
+            self.graph_view.blit(self.fig.bbox)
+            return
+        self.graph_limits = limits
+        window, all_years, xlim, distance_ylim, speed_ylim = limits
+        if window is None:
+            self.ax1.set_ylabel('distance (km)')
+            self.ax2.set_ylabel('vitesse (km/h)')
+        else:
+            self.ax1.set_ylabel('distance sur {} jours (km)'.format(window))
+            self.ax2.set_ylabel('durée sur {} jours (h)'.format(window))
+        if all_years:
+            locator = self.mdates.AutoDateLocator()
+            formatter = self.mdates.AutoDateFormatter(locator)
+        else:
+            locator = self.mdates.MonthLocator()
+            formatter = self.mdates.DateFormatter('%b')
+        self.ax2.xaxis.set_major_locator(locator)
+        self.ax2.xaxis.set_major_formatter(formatter)
+        self.ax2.set_xlim(xlim[0] + self.day_offset, xlim[1] + self.day_offset)
+        self.ax1.set_ylim(*distance_ylim)
+        self.ax2.set_ylim(*speed_ylim)
         self.graph_view.draw()
-        
-    def _init_graph_view(self):
+
+    def _draw_lines(self):
+        self.ax1.draw_artist(self.distance_line)
+        self.ax2.draw_artist(self.speed_line)
+
+    def _on_graph_draw(self, event):
+        # Keep the figure without the lines to redraw them over it.
+        self.graph_background = self.graph_view.copy_from_bbox(self.fig.bbox)
+        self._draw_lines()
+
+    def _init_graph_view(self, result=None):
+        import matplotlib
+        import matplotlib.style
+        matplotlib.use('TkAgg')
+        import matplotlib.dates
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
+
         matplotlib.style.use('ggplot')
+        self.mdates = matplotlib.dates
+        self.day_offset = matplotlib.dates.date2num(EPOCH)
         self.fig = Figure(figsize=(4, 4), tight_layout=True)
-        cumsum, dates, speeds = self.get_graph_data()
         self.ax1, self.ax2 = self.fig.subplots(2, sharex=True)
-        self.ax1.plot(dates, cumsum)
-        self.ax2.plot(dates, speeds)
-        self.ax1.set_ylabel('distance (km)')
-        self.ax2.set_ylabel('vitesse (km/h)')
+        # The lines are animated, that is left out when the figure is drawn,
+        # and drawn over a copy of the rest of the figure instead.
+        self.distance_line, = self.ax1.plot([], [], animated=True)
+        self.speed_line, = self.ax2.plot([], [], animated=True)
+        self.ax2.xaxis_date()
         self.fig.autofmt_xdate()
+        self.graph_limits = None
+        self.graph_background = None
         self.graph_view = FigureCanvasTkAgg(self.fig, master=self)
-        self.graph_view.draw()
+        self.graph_view.mpl_connect('draw_event', self._on_graph_draw)
+        self.update_graph_view()
 
         self.graph_view.get_tk_widget().grid(column=1, row=1, sticky='nsew')
 
+    @bike.profiled
     def update_stats(self):
-        stats = bike.get_stats(self.viewable_rides)
+        key = self.year.get()
+        entry = self.view_entry(key)
+        if 'sums' in entry:
+            self.sums = entry['sums']
+            self.show_stats()
+            return
+        self.sums = None
+        self.run_in_background(bike.get_stats,
+                               lambda stats: self._stats_computed(key, stats),
+                               list(self.viewable_rides))
+
+    def _stats_computed(self, key, stats):
+        # Number of rides and sums of the distances, durations and speeds,
+        # adjusted when a ride changes.
+        self.sums = [stats['num_rides'], stats['tot_distance'],
+                     stats['tot_duration'], stats['speed'] * stats['num_rides']]
+        self.view_entry(key)['sums'] = self.sums
+        self.show_stats()
+
+    def show_stats(self):
+        stats = bike.summarize(*self.sums)
         stats_text = 'Distance totale : {:.1f} km\n'.format(stats['tot_distance'])
         stats_text += 'Durée totale : {:.1f} h\n'.format(stats['tot_duration'])
         stats_text += 'Distance moyenne : {:.1f} km\n'.format(stats['mean_distance'])
@@ -320,49 +1213,204 @@ class VelociraptorGui(tk.Tk):
         self.stats_view = tk.Label(self, textvariable=self.stats_text,
                 justify=tk.LEFT, anchor=tk.NW)
         self.stats_view.grid(column=1, row=2)
-        self.update_stats()
 
     def add_ride(self):
         dialog = RideDetailDialog(self, 'Ajouter une randonnée')
         result = dialog.result
         dialog.destroy()
         if result:
-            self.load_data()
-            self.update_rides_view()
-            self.update_graph_view()
-            self.update_stats()
+            version = bike.db_version()
+            ride_id = bike.add_ride(*result)
+            self.change_ride(version, None, self.make_ride(result, ride_id))
 
     def edit_ride(self, event=None):
-        try:
-            iid = self.rides_view.selection()[0]
-        except IndexError:
+        ride = self.rides_view.selected_ride()
+        if ride is None:
             return
-        rideid = int(self.rides_view.item(iid, 'values')[0])
-        ride = self.rides[rideid]
         dialog = RideDetailDialog(self, 'Modifier une randonnée', ride=ride)
         result = dialog.result
         dialog.destroy()
         if result:
-            self.load_data()
-            self.update_rides_view()
-            self.update_graph_view()
-            self.update_stats()
+            version = bike.db_version()
+            try:
+                bike.update_ride(ride['id'], *result)
+            except ValueError as error:
+                self.ride_not_changed(error)
+                return
+            self.change_ride(version, ride, self.make_ride(result, ride['id']))
 
     def del_ride(self):
+        ride = self.rides_view.selected_ride()
+        if ride is None:
+            return
+        version = bike.db_version()
         try:
-            iid = self.rides_view.selection()[0]
-        except IndexError:
+            bike.delete_ride(ride['id'])
+        except ValueError as error:
+            self.ride_not_changed(error)
             return
-        rideid = int(self.rides_view.item(iid, 'values')[0])
-        self.rides.pop(rideid)
-        bike.update_db(self.rides)
-        self.load_data()
-        self.update_rides_view()
-        self.update_graph_view()
-        self.update_stats()
+        self.change_ride(version, ride, None)
+
+    def ride_not_changed(self, error):
+        """Tell why the selected ride could not be changed, most likely
+        because another program deleted it, and read every ride again."""
+        tkinter.messagebox.showerror(
+            'Erreur', 'La randonnée n\'a pas pu être modifiée : {}'.format(
+                error), parent=self)
+        self.reload()
+
+    @staticmethod
+    def make_ride(values, ride_id):
+        return bike.Ride(*values, id=ride_id)
+
+    @bike.profiled
+    def change_ride(self, version, old, new):
+        """Update the views after ride ``old`` was replaced by ``new`` in the
+        database, which was at ``version`` before.  ``old`` is ``None`` for
+        an addition and ``new`` for a deletion.
+
+        Only the affected rows, points and sums are changed, unless the
+        database was also changed by another program or the rides were
+        renumbered, in which case everything is read again.
+
+        """
+        new_version = bike.db_version()
+        if version != self.db_version or new_version[0] != version[0]:
+            self.reload()
+            return
+        self.db_version = new_version
+        self.apply_changes([(old, new)])
+
+    def apply_changes(self, changes):
+        """Update the rides and the views after each ride ``old`` of the
+        ``(old, new)`` ``changes`` was replaced by ``new``, changing only the
+        affected rows, points and sums."""
+        changed = False
+        try:
+            for old, new in changes:
+                if old is not None:
+                    changed |= self._remove_ride(old)
+                if new is not None:
+                    changed |= self._insert_ride(new)
+        except ValueError:
+            # A ride to replace is not where it should be, start over.
+            self.reload()
+            return
+        self.update_years()
+        if changes and self.searching:
+            self.show_rides()
+        if changes:
+            # Rolling totals also depend on the rides of the year before.
+            for entry in self.view_cache.values():
+                entry.pop('trends', None)
+            if GRAPH_KINDS[self.graph_kind.get()] is not None:
+                self.graph_entry = None
+                changed = True
+        if not changed:
+            return
+        if self.sums is None or (self.graph_view is not None and
+                                 self.graph_entry is None):
+            # Still being computed from the rides as they were, start over.
+            self.cancel_tasks()
+            self.update_stats()
+            self.update_graph_view()
+            return
+        if self.graph_view is not None:
+            self.draw_graph()
+        self.show_stats()
+
+    def _forget_year(self, year):
+        """Drop what is kept for the views of ``year`` and of all the years,
+        but the one shown, which is updated in place."""
+        for key in [str(year), ALL_YEARS]:
+            if key != self.year.get():
+                self.view_cache.pop(key)
+
+    def _remove_ride(self, ride):
+        """Remove the ride with the id of ``ride`` from the rides of its year
+        and from the views if they show that year, and return whether they
+        do.  The ride is removed as it is now, which may differ from
+        ``ride`` if it was changed since by another program.  Raise
+        ``ValueError`` if it is not there."""
+        if ride.id not in self.rides_by_id:
+            raise ValueError('ride {} not found'.format(ride.id))
+        ride = self.rides_by_id[ride.id]
+        year = ride.year
+        rides = self.rides_by_year.get(year, [])
+        index = find_ride(rides, ride)
+        del rides[index]
+        del self.rides_by_id[ride.id]
+        self.search_index.remove(ride.id, ride.comment, ride.url)
+        self.year_totals[year] -= ride.distance
+        self._forget_year(year)
+        if self.year.get() == ALL_YEARS:
+            index = find_ride(self.viewable_rides, ride)
+            del self.viewable_rides[index]
+        elif rides is not self.viewable_rides:
+            return False
+        if not self.searching:
+            self.rides_view.removed(index)
+        graph = self.view_entry().get('graph')
+        if graph is not None:
+            cumsum, days, speeds = graph[0]
+            del cumsum[index], days[index], speeds[index]
+            for i in range(index, len(cumsum)):
+                cumsum[i] -= ride.distance
+            graph[1] = None
+        self._add_to_sums(ride, -1)
+        return True
+
+    def _insert_ride(self, ride):
+        """Insert ``ride`` in the rides of its year and in the views if they
+        show that year, and return whether they do."""
+        self.search_index.add(ride.id, ride.comment, ride.url)
+        self.rides_by_id[ride.id] = ride
+        year = ride.year
+        rides = self.rides_by_year.setdefault(year, [])
+        index = bisect_rides(rides, ride.epoch, right=True)
+        rides.insert(index, ride)
+        self.year_totals[year] = (self.year_totals.get(year, 0.0) +
+                                  ride.distance)
+        speed = ride_speed(ride)
+        if speed > self.max_speed:
+            self.max_speed = speed
+        self._forget_year(year)
+        all_years = self.year.get() == ALL_YEARS
+        if all_years:
+            index = bisect_rides(self.viewable_rides, ride.epoch,
+                                 right=True)
+            self.viewable_rides.insert(index, ride)
+        elif rides is not self.viewable_rides:
+            return False
+        if not self.searching:
+            self.rides_view.inserted(index)
+            self.rides_view.select(index)
+        graph = self.view_entry().get('graph')
+        if graph is not None:
+            cumsum, days, speeds = graph[0]
+            cumsum.insert(index, cumsum[index - 1] if index else 0.0)
+            days.insert(index, graph_day(ride.timestamp, all_years))
+            speeds.insert(index, speed)
+            for i in range(index, len(cumsum)):
+                cumsum[i] += ride.distance
+            graph[1] = None
+        self._add_to_sums(ride, 1)
+        return True
+
+    def _add_to_sums(self, ride, sign):
+        if self.sums is None:
+            return
+        self.sums[0] += sign
+        self.sums[1] += sign * ride.distance
+        self.sums[2] += sign * ride.duration
+        if ride.duration != 0:
+            self.sums[3] += sign * ride.distance / ride.duration
 
 if __name__ == '__main__':
+    if bike.trace_enabled():
+        bike.start_profile()
     gui = VelociraptorGui(None)
     gui.title('Velociraptor')
     gui.mainloop()
+    bike.report_profile()
     
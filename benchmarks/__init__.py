@@ -0,0 +1,6 @@
+"""Benchmarks for ``bike`` and Velociraptor.
+
+Each benchmark is a module that can be run with ``python -m benchmarks.NAME``
+from the root of the repository and prints its results as JSON.
+
+"""
@@ -0,0 +1,241 @@
+"""How ``bike`` and Velociraptor scale with the size of the ride history.
+
+For each size, a synthetic rides database is generated (see
+:mod:`benchmarks.synthetic`) and the main functions of :mod:`bike` and of the
+GUI are timed, then run once more under :mod:`tracemalloc` to measure their
+peak memory use.  The GUI functions are run without a window; when no display
+is available, the rides view is replaced by a stand-in that only formats the
+rows it would display, so that the cost of Tk itself is not included.
+
+For each function, ``first_s`` is the time of the first run, which includes
+building the helper files of the database, and ``best_s`` the best time of
+all the runs.
+``rides_mib`` is the memory held by the list of every ride read.
+
+Usage::
+
+    python -m benchmarks.scaling [--sizes N ...] [--repeat R] [-o FILE]
+
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+import bike
+from benchmarks import synthetic
+
+WAHOO_SAMPLES = 4 * 3600
+
+
+class _RidesViewStandIn(object):
+    """Format the rows a :class:`Velociraptor.RidesView` would display when Tk
+    cannot be used."""
+
+    num_rows = 40
+
+    def set_rides(self, rides):
+        import Velociraptor
+        self.rows = [Velociraptor.format_ride(ride)
+                     for ride in rides[:self.num_rows]]
+
+
+def _headless_gui(rides, year):
+    """Return an object with the state the Velociraptor methods need, and
+    whether a real Tk rides view is used."""
+    import tkinter as tk
+    import Velociraptor
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        rides_view = _RidesViewStandIn()
+        real_tk = False
+    else:
+        root.withdraw()
+        rides_view = Velociraptor.RidesView(root)
+        real_tk = True
+    year_var = types.SimpleNamespace(get=lambda: str(year))
+    gui = types.SimpleNamespace(
+        rides=rides, rides_by_year=Velociraptor.group_by_year(rides),
+        year=year_var, rides_view=rides_view, viewable_rides=[],
+        search_text=types.SimpleNamespace(get=lambda: ''), loaded=True)
+    gui.show_rides = lambda: Velociraptor.VelociraptorGui.show_rides(gui)
+    return gui, real_tk
+
+
+def _git_commit():
+    """Return the commit the benchmark is run on, if known."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _remove_helper_files():
+    """Remove the files ``bike`` keeps next to the database."""
+    for suffix in (bike.CACHE_SUFFIX, bike.INDEX_SUFFIX,
+                   bike.AGGREGATES_SUFFIX, bike.JOURNAL_SUFFIX,
+                   bike.SEARCH_SUFFIX, bike.SEARCH_LOG_SUFFIX,
+                   bike.APPENDS_SUFFIX):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(bike._sidecar_path(suffix))
+
+
+def measure(func, repeat, setup=None):
+    """Run ``func`` ``repeat`` times and once more under tracemalloc, calling
+    ``setup`` before each run, and return the timings and the peak memory
+    use."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'first_s': times[0],
+            'best_s': min(times),
+            'mean_s': sum(times) / len(times),
+            'peak_mib': peak / 2 ** 20}
+
+
+def run_size(num_rides, repeat, tmpdir):
+    """Run the benchmarks on a database of ``num_rides`` rides and return the
+    results as a dictionary."""
+    bike.RIDEDB = os.path.join(tmpdir, 'bikerides-{}'.format(num_rides))
+    bike.BACKEND = 'csv'
+    start = time.perf_counter()
+    years = synthetic.write_rides(bike.RIDEDB, num_rides)
+    generate_s = time.perf_counter() - start
+    # The last full year, as shown by the GUI.
+    year = years[-2] if len(years) > 1 else years[-1]
+    results = {'generate_s': generate_s,
+               'file_mib': os.path.getsize(bike.RIDEDB) / 2 ** 20,
+               'years': len(years)}
+
+    results['read_db_file_cold'] = measure(
+        lambda: bike.read_db_file(year='all'), repeat,
+        setup=_remove_helper_files)
+    results['read_db_file'] = measure(
+        lambda: bike.read_db_file(year='all'), repeat)
+    results['read_db_file_year'] = measure(
+        lambda: bike.read_db_file(year=year), repeat)
+    tracemalloc.start()
+    try:
+        rides = bike.read_db_file(year='all')
+        results['rides_mib'] = tracemalloc.get_traced_memory()[0] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    results['get_stats'] = measure(lambda: bike.get_stats(rides), repeat)
+    results['rolling_stats'] = measure(lambda: bike.rolling_stats(rides),
+                                       repeat)
+    query = bike.Query('distance>50 and comment~"lac" and date>={}'.format(
+        year))
+    results['read_db_file_query'] = measure(
+        lambda: bike.read_db_file(year='all', query=query), repeat)
+    results['iter_rides_query'] = measure(
+        lambda: list(bike.iter_rides('all', query=query)), repeat)
+    results['search_index_build'] = measure(
+        lambda: bike.SearchIndex.build(rides), repeat)
+    index = bike.SearchIndex.build(rides)
+    results['search_index_save_load'] = measure(
+        lambda: (index.save(), bike.SearchIndex.load(index.version)), repeat)
+    for text in ('croix', 'tour du'):
+        results['search ' + text] = measure(lambda: index.search(text),
+                                            repeat)
+    rides_args = argparse.Namespace(year='all')
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            results['print_rides'] = measure(
+                lambda: bike.print_rides(rides_args), repeat)
+        for export_format in ('csv', 'ndjson'):
+            export_args = argparse.Namespace(year='all', format=export_format,
+                                             output=os.devnull)
+            results['export_' + export_format] = measure(
+                lambda: bike.export(export_args), repeat)
+    results['update_db'] = measure(lambda: bike.update_db(rides), repeat)
+    durations = [('{:.3f}', '{}:{:02d}', '{}h{:02d}', '{}h', '{}:')[i % 5]
+                 for i in range(num_rides)]
+    durations = [duration.format(i % 10, i % 60)
+                 for i, duration in enumerate(durations)]
+    results['parse_duration'] = measure(
+        lambda: [bike.parse_duration(duration) for duration in durations],
+        repeat)
+    wahoo_file = os.path.join(tmpdir, 'wahoo.csv')
+    synthetic.write_wahoo_csv(wahoo_file, WAHOO_SAMPLES)
+    wahoo_args = argparse.Namespace(filename=wahoo_file, comment=None,
+                                    dir=None)
+    results['read_wahoo_csv'] = measure(
+        lambda: bike.read_wahoo_csv(wahoo_args), repeat)
+
+    import Velociraptor
+    gui, real_tk = _headless_gui(bike.read_db_file(year='all'), year)
+    results['gui_real_tk'] = real_tk
+    results['update_rides_view'] = measure(
+        lambda: Velociraptor.VelociraptorGui.update_rides_view(gui), repeat)
+    results['gui_rides'] = len(gui.viewable_rides)
+    results['get_graph_data'] = measure(
+        lambda: Velociraptor.VelociraptorGui.get_graph_data(gui), repeat)
+    all_years_gui = types.SimpleNamespace(
+        viewable_rides=gui.rides,
+        year=types.SimpleNamespace(get=lambda: Velociraptor.ALL_YEARS))
+    results['get_graph_data_all_years'] = measure(
+        lambda: Velociraptor.VelociraptorGui.get_graph_data(all_years_gui),
+        repeat)
+    cumsum, days, speeds = Velociraptor.VelociraptorGui.get_graph_data(
+        all_years_gui)
+    if bike._import_numpy() is not None:
+        results['lttb_all_years'] = measure(
+            lambda: Velociraptor.lttb(days, cumsum, 1000), repeat)
+    return results
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000],
+                        help='numbers of rides of the generated databases, '
+                        'for instance 10000 100000 1000000')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs of each function')
+    parser.add_argument('-o', '--output', help='write the JSON results to a '
+                        'file instead of the standard output')
+    args = parser.parse_args(argv)
+
+    results = {'benchmark': 'scaling',
+               'commit': _git_commit(),
+               'python': platform.python_version(),
+               'numpy': bike._import_numpy() is not None,
+               'repeat': args.repeat,
+               'sizes': {}}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in args.sizes:
+            results['sizes'][str(size)] = run_size(size, args.repeat, tmpdir)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Startup time regression check.
+
+Run ``bike`` commands and import Velociraptor under ``python -X importtime``,
+report the total import time and the slowest modules as JSON, and fail if a
+module that should only be imported lazily shows up, or if the total import
+time exceeds a budget.
+
+Usage::
+
+    python -m benchmarks.startup [--budget-ms MS] [-o FILE]
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be imported by each check.
+CHECKS = [
+    ('bike stats', [os.path.join(ROOT, 'bike.py'), 'stats'],
+     ['webbrowser', 'concurrent.futures', 'sqlite3', 'tempfile', 'pandas',
+      'numpy', 'matplotlib']),
+    ('bike rides', [os.path.join(ROOT, 'bike.py'), 'rides'],
+     ['webbrowser', 'concurrent.futures', 'sqlite3', 'pandas', 'numpy',
+      'matplotlib']),
+    ('import bike', ['-c', 'import bike'],
+     ['argparse', 'webbrowser', 'concurrent.futures', 'sqlite3', 'pandas',
+      'numpy', 'matplotlib']),
+    ('import Velociraptor', ['-c', 'import Velociraptor'],
+     ['matplotlib', 'numpy', 'pandas']),
+]
+
+
+def parse_importtime(stderr):
+    """Return a dictionary mapping the name of each imported module to its
+    self and cumulative import times in microseconds."""
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules[name.strip()] = {'self_us': self_us,
+                                 'cumulative_us': cumulative_us,
+                                 'depth': depth}
+    return modules
+
+
+def seed_database(home):
+    """Write a few rides to the ride database in *home*.  Durations are in
+    hours."""
+    with open(os.path.join(home, '.bikerides'), 'w') as db_file:
+        for day in range(1, 29):
+            db_file.write('2020-02-{:02d} 08:00:00,{},{},,\r\n'.format(
+                day, 20 + day, 0.5 + day % 3))
+
+
+def run_check(name, args, forbidden, home):
+    """Run one check and return its results as a dictionary.  The command is
+    run once beforehand so that helper files are already written."""
+    env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+    subprocess.run([sys.executable] + args, cwd=ROOT, env=env,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    modules = parse_importtime(result.stderr)
+    total_us = sum(module['cumulative_us'] for module in modules.values()
+                   if module['depth'] == 0)
+    slowest = sorted(modules.items(), key=lambda item: -item[1]['self_us'])
+    return {'name': name,
+            'total_ms': total_us / 1000,
+            'num_modules': len(modules),
+            'slowest': [{'module': module, 'self_ms': times['self_us'] / 1000}
+                        for module, times in slowest[:10]],
+            'forbidden_imports': sorted(
+                module for module in modules
+                if any(module == f or module.startswith(f + '.')
+                       for f in forbidden))}
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='fail if the import time of a check exceeds '
+                        'this budget')
+    parser.add_argument('-o', '--output', help='write the JSON results to a '
+                        'file instead of the standard output')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as home:
+        seed_database(home)
+        checks = [run_check(name, check_args, forbidden, home)
+                  for name, check_args, forbidden in CHECKS]
+    failures = []
+    for check in checks:
+        if check['forbidden_imports']:
+            failures.append('{}: imports {}'.format(
+                check['name'], ', '.join(check['forbidden_imports'])))
+        if args.budget_ms is not None and check['total_ms'] > args.budget_ms:
+            failures.append('{}: {:.1f} ms over the {:.1f} ms budget'.format(
+                check['name'], check['total_ms'], args.budget_ms))
+    results = {'benchmark': 'startup', 'checks': checks,
+               'failures': failures}
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
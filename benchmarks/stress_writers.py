@@ -0,0 +1,153 @@
+"""Stress test of concurrent writers of the rides database.
+
+Many processes add rides at the same time, half of them with timestamps in the
+past so that the file is rewritten while others append to it, and a reader
+process keeps reading the database.  The test is run with the write lock and
+without it, to show what the lock costs and what it prevents: without it,
+appends that land while the file is being rewritten are lost, and writes and
+reads fail on the corrupted file.  Failures are counted, not raised.
+
+Usage::
+
+    python -m benchmarks.stress_writers [--processes N] [--rides M] [-o FILE]
+
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import bike
+
+
+def _init_worker(ridedb, locked):
+    bike.RIDEDB = ridedb
+    bike.BACKEND = 'csv'
+    if not locked:
+        bike._write_lock = contextlib.nullcontext
+
+
+def _write(worker, num_rides):
+    """Add ``num_rides`` rides one at a time and return the time it took and
+    the number of writes that failed."""
+    rng = random.Random(worker)
+    failed = 0
+    start = time.perf_counter()
+    for i in range(num_rides):
+        if worker % 2:
+            # In the past, forces a rewrite of the file.
+            timestamp = datetime.datetime(2000, 1, 1) + datetime.timedelta(
+                minutes=rng.randrange(10 ** 6))
+        else:
+            timestamp = datetime.datetime.now()
+        try:
+            bike.add_rides([(timestamp, 10.0 + worker, 0.5,
+                             'worker {} ride {}'.format(worker, i), '')])
+        except Exception:
+            failed += 1
+    return time.perf_counter() - start, failed
+
+
+def _read(stop_path):
+    """Read the database until the file ``stop_path`` exists and return the
+    number of reads and the number of reads that failed or saw rides
+    disappear."""
+    reads = errors = 0
+    previous = 0
+    while not os.path.exists(stop_path):
+        try:
+            num_rides = len(bike.read_db_file(year='all'))
+        except Exception:
+            errors += 1
+            continue
+        if num_rides < previous:
+            errors += 1
+        previous = num_rides
+        reads += 1
+    return reads, errors
+
+
+def run_scenario(num_processes, num_rides, locked):
+    """Run the stress test and return its results as a dictionary."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ridedb = os.path.join(tmpdir, 'bikerides')
+        stop_path = os.path.join(tmpdir, 'stop')
+        open(ridedb, 'w').close()
+        with concurrent.futures.ProcessPoolExecutor(
+                num_processes + 1, initializer=_init_worker,
+                initargs=(ridedb, locked)) as executor:
+            start = time.perf_counter()
+            reader = executor.submit(_read, stop_path)
+            try:
+                writers = [executor.submit(_write, worker, num_rides)
+                           for worker in range(num_processes)]
+                durations = []
+                failed_writes = 0
+                for writer in writers:
+                    try:
+                        duration, failed = writer.result()
+                    except Exception:
+                        # The whole process failed.
+                        duration, failed = 0.0, num_rides
+                    durations.append(duration)
+                    failed_writes += failed
+                elapsed = time.perf_counter() - start
+            finally:
+                # Otherwise the reader never stops and the executor waits for
+                # it forever.
+                open(stop_path, 'w').close()
+            reads, read_errors = reader.result()
+        _init_worker(ridedb, True)
+        try:
+            stored = len(bike.read_db_file(year='all'))
+        except Exception:
+            # The file is corrupted, no ride can be read.
+            stored = 0
+    expected = num_processes * num_rides
+    return {'locked': locked,
+            'seconds': elapsed,
+            'writes_per_second': expected / elapsed,
+            'mean_write_ms': 1000 * sum(durations) / expected,
+            'expected_rides': expected,
+            'failed_writes': failed_writes,
+            'stored_rides': stored,
+            'lost_rides': expected - stored,
+            'reads': reads,
+            'read_errors': read_errors}
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=8,
+                        help='number of concurrent writer processes')
+    parser.add_argument('--rides', type=int, default=25,
+                        help='number of rides added by each process')
+    parser.add_argument('-o', '--output', help='write the JSON results to a '
+                        'file instead of the standard output')
+    args = parser.parse_args(argv)
+
+    locked = run_scenario(args.processes, args.rides, True)
+    unlocked = run_scenario(args.processes, args.rides, False)
+    results = {'benchmark': 'stress_writers',
+               'processes': args.processes,
+               'rides_per_process': args.rides,
+               'locked': locked,
+               'unlocked': unlocked,
+               'lock_overhead': locked['seconds'] / unlocked['seconds']}
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
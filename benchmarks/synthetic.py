@@ -0,0 +1,117 @@
+"""Synthetic ride histories.
+
+Generate ``.bikerides`` files of any size, with a few rides per day, comments
+that need quoting (commas, quotes, accents) and URLs, and Wahoo CSV files of
+any length, so that benchmarks do not depend on anybody's real rides.
+
+Usage::
+
+    python -m benchmarks.synthetic NUM_RIDES FILE [--seed SEED]
+
+"""
+
+import argparse
+import csv
+import datetime
+import random
+import sys
+import time
+
+import bike
+
+COMMENTS = [
+    '',
+    '',
+    '',
+    'Tour du lac',
+    'Sortie club, groupe A',
+    'Col de la Croix-de-Fer, "dur" mais beau',
+    'Vent de face à l\'aller, pluie au retour',
+    'Recovery ride',
+    'Intervals: 5x5 min, 3 min rest',
+    'Boulot',
+]
+
+URLS = [
+    '',
+    '',
+    'https://www.strava.com/activities/{}',
+    'https://example.org/rides?id={}&map=1',
+]
+
+
+def generate_rides(num_rides, seed=0, num_years=30):
+    """Yield ``num_rides`` ``(timestamp, distance, duration, comment, url)``
+    tuples in chronological order, spread over the ``num_years`` years that
+    end today.  The same ``seed`` always gives the same rides, as long as the
+    day does not change."""
+    rng = random.Random(seed)
+    end = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    timestamp = datetime.datetime(end.year - num_years + 1, 1, 1)
+    # A little below the mean so that the last rides are not in the future.
+    mean_gap = 0.98 * (end - timestamp).total_seconds() / max(num_rides, 1)
+    for i in range(num_rides):
+        timestamp += datetime.timedelta(
+            seconds=max(1, int(rng.uniform(0.5, 1.5) * mean_gap)))
+        duration = round(rng.uniform(0.2, 6.0), 3)
+        distance = round(duration * rng.uniform(12.0, 35.0), 2)
+        comment = rng.choice(COMMENTS)
+        url = rng.choice(URLS).format(1000000 + i)
+        yield timestamp.replace(microsecond=0), distance, duration, comment, url
+
+
+def write_rides(filename, num_rides, seed=0, num_years=30):
+    """Write a rides database file of ``num_rides`` rides to ``filename`` in the
+    format used by :mod:`bike`, and return the list of years it covers."""
+    years = set()
+    with open(filename, 'w', encoding='utf-8', newline='') as db_file:
+        rides_writer = csv.writer(db_file, delimiter=',', quotechar='"',
+                                  quoting=csv.QUOTE_MINIMAL)
+        for timestamp, distance, duration, comment, url in generate_rides(
+                num_rides, seed, num_years):
+            years.add(timestamp.year)
+            rides_writer.writerow([timestamp.strftime(bike.TIMESTR),
+                                   str(distance), str(duration), comment, url])
+    return sorted(years)
+
+
+def write_wahoo_csv(filename, num_samples, seed=0, end=None):
+    """Write a Wahoo CSV file of ``num_samples`` one second samples, a few of
+    them paused, to ``filename``.  The ride ends at the ``end`` POSIX
+    timestamp, by default now."""
+    rng = random.Random(seed)
+    if end is None:
+        end = time.time()
+    start_ms = int(1000 * (end - num_samples))
+    distance = 0.0
+    with open(filename, 'w', encoding='utf-8', newline='') as wahoo_file:
+        wahoo_writer = csv.writer(wahoo_file)
+        wahoo_writer.writerow(['Timestamp', 'HeartRate', 'Cadence', 'Speed',
+                               'Power', 'WorkoutActive', 'TotalDistance'])
+        for i in range(num_samples):
+            active = rng.random() > 0.02
+            speed = rng.uniform(4.0, 11.0) if active else 0.0
+            distance += speed
+            wahoo_writer.writerow([start_ms + 1000 * i, rng.randrange(90, 180),
+                                   rng.randrange(60, 100), round(speed, 3),
+                                   rng.randrange(80, 300),
+                                   'true' if active else 'false',
+                                   round(distance, 3)])
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('num_rides', type=int, help='number of rides')
+    parser.add_argument('filename', help='file to write')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the random generator')
+    parser.add_argument('--years', type=int, default=30,
+                        help='number of years covered by the rides')
+    args = parser.parse_args(argv)
+    years = write_rides(args.filename, args.num_rides, args.seed, args.years)
+    print('Wrote {} rides from {} to {}'.format(args.num_rides, years[0],
+                                                 years[-1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -23,17 +23,114 @@ The timestamp is the date and time at which the ride was added to the database.
 It is added automatically by the script but can be modified as needed using any
 text editor.
 
+To speed things up, ``bike`` keeps a few helper files next to ``.bikerides``.
+They are rebuilt automatically whenever ``.bikerides`` changes and can safely be
+deleted at any time:
+
+``.bikerides.cache``
+    The already parsed rides, validated against the size, modification time and
+    content hash of ``.bikerides``.
+
+``.bikerides.idx``
+    The byte offset of every ride in ``.bikerides`` and, for each year, the
+    ranges of lines holding its rides, so that a single year or a single ride
+    can be read without parsing the whole file.
+
+``.bikerides.agg``
+    For each year, the number of rides, the total distance, the total duration
+    and the sum of the speeds, so that ``bike stats`` does not have to read
+    ``.bikerides`` at all.
+
+``.bikerides.search``
+    The words of the comments and URLs and the rides using each of them, for
+    ``bike search``.
+
+``.bikerides.search.log``
+    The words added and removed by ``bike`` since ``.bikerides.search`` was
+    last stored, which is only rewritten once the log grows large.
+
+``.bikerides.appends``
+    The rides appended to ``.bikerides`` by ``bike`` since the files above were
+    last updated, so that they are brought up to date rather than rebuilt.
+
+Edits and deletions of rides are not written to ``.bikerides`` right away.
+They are appended to ``.bikerides.journal`` and applied when the rides are
+read. Unlike the helper files above, the journal must not be deleted. It is
+folded back into ``.bikerides`` once it grows large, or on demand with ``bike
+compact``.
+
+``bike`` and Velociraptor can safely run at the same time: writers serialize on
+an advisory lock on ``.bikerides.lock`` and replace files atomically, while
+readers work on a consistent snapshot without waiting for writers.
+
+The rides can also be stored in an SQLite database, ``.bikerides.sqlite``,
+indexed on the timestamp and the year. Run ``bike migrate --to sqlite`` to copy
+the rides there and set the ``BIKE_BACKEND`` environment variable to ``sqlite``
+to use it. ``bike migrate --to csv`` copies them back.
+
+``bike export`` writes the rides of the given years, every year by default,
+with their average speed, to the standard output or to the file given with
+``-o``. ``--format`` selects CSV, the default, NDJSON, a JSON array or Parquet,
+which requires pyarrow. Rides are streamed from the database to the output, so
+memory use does not depend on how many are exported.
+
+``bike query EXPRESSION`` prints the rides matching an expression such as
+``distance>50 and duration<3 and comment~"commute" and date>=2021-04``, their
+statistics with ``--stats`` or exports them with ``--format``. Fields are
+``date``, ``distance``, ``duration``, ``speed``, ``comment`` and ``url``, ``~``
+tests whether a text contains another, ignoring case, and dates may be
+truncated to a year, a month or a day. ``bike rides``, ``bike stats`` and
+``bike export`` accept the same expressions with ``-q``. The expression is
+checked on the fields of each line before it is parsed, and only the years its
+dates allow are read.
+
+``bike search TERMS`` finds the rides whose comment or URL has a word starting
+with each of the terms, ignoring case and accents, so that ``bike search ete``
+finds "Été". It uses an inverted index of the words, stored next to the rides
+and updated along with them, so the time it takes depends on the number of
+rides found rather than on the size of the database. Velociraptor has a search
+box built on the same index, which shows the matching rides as you type.
+
+``bike trends`` prints the distance and duration of the last 7, 30 and 365
+days, the best such windows, the longest streak of consecutive days with rides
+and records such as the fastest ride of at least 20, 50 or 100 km. They are
+computed by ``bike.rolling_stats`` in a single pass over the rides, and
+Velociraptor can plot the rolling totals instead of the cumulative distance.
+
+Rides are read as ``bike.Ride`` records with ``__slots__``, which keep the
+timestamp as a number of seconds and only build its ``datetime`` when it is
+used, so that a million rides take about 290 MiB rather than 470 MiB.  They
+still behave as dictionaries: ``ride['distance']`` is ``ride.distance``.
+
+To find out where the time goes, run a command with ``bike --profile``, or set
+the ``BIKE_TRACE`` environment variable to ``1``, which also works for
+Velociraptor. The time spent in each phase of the command (parsing, sorting,
+formatting...), the number of rows handled and the peak memory use are printed
+on the standard error. With ``--profile-output FILE``, or if ``BIKE_TRACE`` is
+set to a file name, they are written to that file as JSON instead.
+
 """
 
 
 from __future__ import print_function
-import argparse
-from datetime import datetime
+from contextlib import closing, contextmanager, nullcontext
+from collections.abc import Mapping
+from datetime import date, datetime, timedelta, timezone
 import csv
-import locale
+import functools
+import gc
+import io
+import itertools
 import os
+import pickle
 import sys
-import webbrowser
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __author__ = "Loïc Séguin-C. <loicseguin@gmail.com>"
 __license__ = "BSD"
@@ -45,6 +142,37 @@ TIMESTR = "%Y-%m-%d %H:%M:%S"
 MINUTES_PER_HOUR = 60.
 SECONDS_PER_HOUR = 3600.
 KILO = 1000.
+CACHE_SUFFIX = '.cache'
+CACHE_VERSION = 3
+INDEX_SUFFIX = '.idx'
+INDEX_VERSION = 4
+AGGREGATES_SUFFIX = '.agg'
+AGGREGATES_VERSION = 3
+JOURNAL_SUFFIX = '.journal'
+APPENDS_SUFFIX = '.appends'
+SEARCH_SUFFIX = '.search'
+SEARCH_LOG_SUFFIX = '.search.log'
+SEARCH_VERSION = 1
+COMPACT_THRESHOLD = 1000
+# Number of bytes before the end of the part of RIDEDB already read that are
+# checked to tell whether the file was only appended to since.
+FOLLOW_CHECK_SIZE = 4096
+SQLITE_SUFFIX = '.sqlite'
+LOCK_SUFFIX = '.lock'
+BACKEND = os.environ.get('BIKE_BACKEND', 'csv')
+TRACE = os.environ.get('BIKE_TRACE', '')
+PERIODS = ('week', 'month', 'year')
+# Lengths in days of the rolling windows and minimum distances in km of the
+# speed records of ``bike trends``.
+ROLLING_WINDOWS = (7, 30, 365)
+RECORD_DISTANCES = (20, 50, 100)
+EXPORT_FORMATS = ('csv', 'ndjson', 'json', 'parquet')
+EXPORT_COLUMNS = ('id', 'timestamp', 'distance', 'duration', 'speed',
+                  'comment', 'url')
+# Number of rides formatted before each write of the ride listings and of the
+# text exports, and in each row group of the Parquet exports.
+WRITE_BATCH_SIZE = 1024
+PARQUET_BATCH_SIZE = 65536
 
 
 FR_DICT = {
@@ -66,6 +194,9 @@ FR_DICT = {
     "Duration": "Durée",
     "Comment": "Commentaire",
     "Speed": "Vitesse",
+    "Period": "Période",
+    "Rides": "Randos",
+    "group statistics by period": "regrouper les statistiques par période",
     "yyyy-mm-dd hh:mm": "aaaa-mm-jj hh:mm",
     "Error: no URL for ride {}": "Erreur: pas d'URL pour la randonnée {}",
     "Opened %s": "Ouverture de %s",
@@ -73,7 +204,100 @@ FR_DICT = {
     "database.": "L'usager a interrompu le programme, aucun changement "
                  "enregistré dans la base de données.",
     "No rides for year(s): ": "Aucune randonnée pour ",
-    "Error: no ride with index {}": "Erreur: aucune randonnée avec indice {}"
+    "Error: no ride with index {}": "Erreur: aucune randonnée avec indice {}",
+    "add the rides listed in a CSV file (- for standard input)":
+    "ajouter les randonnées d'un fichier CSV (- pour l'entrée standard)",
+    "line {}: {}": "ligne {} : {}",
+    "Added {} rides": "{} randonnées ajoutées",
+    "{} is not a Wahoo CSV file": "{} n'est pas un fichier CSV Wahoo",
+    "no active samples in {}": "aucune donnée active dans {}",
+    "line {} of {} is truncated": "la ligne {} de {} est tronquée",
+    "cannot read {}: {}": "impossible de lire {} : {}",
+    "imported": "importé",
+    "duplicate": "doublon",
+    "no ride with index {}": "aucune randonnée avec indice {}",
+    "unknown storage backend {}": "type de stockage inconnu {}",
+    "storage backend to migrate to": "type de stockage cible",
+    "Migrated {} rides to the {} backend, set BIKE_BACKEND={} to use it.":
+    "{} randonnées migrées vers le stockage {}, définir BIKE_BACKEND={} "
+    "pour l'utiliser.",
+    "compact": "compact",
+    "fold edits and deletions into rides file":
+    "intégrer les modifications au fichier des randonnées",
+    "Added {} rides from {} files in {:.2f} s ({:.1f} files/s)":
+    "{} randonnées ajoutées à partir de {} fichiers en {:.2f} s "
+    "({:.1f} fichiers/s)",
+    "a file name or --dir is required":
+    "un nom de fichier ou --dir est requis",
+    "import every Wahoo csv file of a directory":
+    "importer tous les fichiers csv Wahoo d'un répertoire",
+    "report where the time goes": "indiquer où le temps est passé",
+    "write the profile as JSON to a file":
+    "écrire le profil en JSON dans un fichier",
+    "export": "export",
+    "export rides for other programs":
+    "exporter les randonnées pour d'autres programmes",
+    "output format": "format de sortie",
+    "trends": "trends",
+    "print rolling totals, streaks and records":
+    "imprimer les totaux glissants, les séries et les records",
+    "Rolling totals on {}": "Totaux glissants au {}",
+    "Window": "Période",
+    "{} days": "{} jours",
+    "Best {} days:": "Meilleurs {} jours :",
+    "{:.1f} km, ending on {}": "{:.1f} km, jusqu'au {}",
+    "Longest streak:": "Plus longue série :",
+    "Last streak:": "Dernière série :",
+    "{} days, from {}": "{} jours, à partir du {}",
+    "Longest ride:": "Plus longue randonnée :",
+    "Longest duration:": "Plus longue durée :",
+    "Fastest over {} km:": "Plus rapide sur {} km :",
+    "{:.1f} km on {}": "{:.1f} km le {}",
+    "{:.1f} h on {}": "{:.1f} h le {}",
+    "{:.1f} km/h on {}": "{:.1f} km/h le {}",
+    "year or list of years, all by default":
+    "année ou liste d'années, toutes par défaut",
+    "write to a file instead of the standard output":
+    "écrire dans un fichier plutôt que sur la sortie standard",
+    "the parquet format requires pyarrow":
+    "le format parquet nécessite pyarrow",
+    "query": "query",
+    "print the rides matching an expression":
+    "imprimer les randonnées correspondant à une expression",
+    "conditions on date, distance, duration, speed, comment and url, such "
+    "as \"distance>50 and comment~commute and date>=2021-04\"":
+    "conditions sur date, distance, duration, speed, comment et url, comme "
+    "\"distance>50 and comment~boulot and date>=2021-04\"",
+    "only keep the rides matching EXPRESSION, such as \"distance>50 and "
+    "comment~commute and date>=2021-04\", of every year unless years are "
+    "given":
+    "ne garder que les randonnées correspondant à EXPRESSION, comme "
+    "\"distance>50 and comment~boulot and date>=2021-04\", de toutes les "
+    "années sauf si des années sont données",
+    "print statistics instead": "imprimer plutôt les statistiques",
+    "export the rides in this format instead":
+    "exporter plutôt les randonnées dans ce format",
+    "export to a file instead of the standard output":
+    "exporter dans un fichier plutôt que sur la sortie standard",
+    "No rides match: ": "Aucune randonnée ne correspond à : ",
+    "No rides": "Aucune randonnée",
+    "invalid query {}: {}": "requête {} invalide : {}",
+    "syntax error": "erreur de syntaxe",
+    "unexpected end": "fin inattendue",
+    "unknown field {}": "champ inconnu {}",
+    "{} can only be compared with =, != or ~":
+    "{} ne peut être comparé qu'avec =, != ou ~",
+    "~ only applies to comment and url":
+    "~ ne s'applique qu'à comment et url",
+    "invalid number {}": "nombre invalide {}",
+    "invalid date {}": "date invalide {}",
+    "search": "search",
+    "find rides by the words of their comment or URL":
+    "trouver des randonnées par les mots de leur commentaire ou URL",
+    "beginning of a word, accents and case are ignored":
+    "début d'un mot, sans égard aux accents et à la casse",
+    "the {} must fit on a single line":
+    "le champ {} doit tenir sur une seule ligne",
     }
 TRANS_DICT = {}
 
@@ -87,6 +311,7 @@ except NameError:
 
 def init_locale():
     """Set the locale to the user's preference."""
+    import locale
     locale.setlocale(locale.LC_ALL, '')
     lang = locale.getlocale()[0][:2]
     global TRANS_DICT
@@ -128,14 +353,2339 @@ def parse_duration(duration_str):
     return duration
 
 
+class Profile(object):
+    """Timings, row counts and peak memory of the phases of a command.
+
+    Phases nest, the name under which a phase is recorded is the ``/``
+    separated path of the phases it runs in.  The time of a phase includes
+    the time of the phases it contains.  Each thread has its own stack of
+    phases, so that the phases of the background threads of Velociraptor do
+    not nest in those of the main thread.
+
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def stack(self):
+        """The ``[name, rows]`` of the phases the current thread is in."""
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    @contextmanager
+    def phase(self, name):
+        """Record the time spent in the body of the ``with`` statement as
+        ``name``."""
+        self.stack.append([name, 0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(time.perf_counter() - start)
+
+    def iterate(self, name, iterable):
+        """Yield the items of ``iterable``, recording the time spent getting
+        them and their number as ``name``."""
+        iterator = iter(iterable)
+        elapsed = 0.0
+        rows = 0
+        try:
+            while True:
+                self.stack.append([name, 0])
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                    self.stack.pop()
+                rows += 1
+                yield item
+        finally:
+            self.stack.append([name, rows])
+            self._record(elapsed)
+
+    def rows(self, num_rows):
+        """Add ``num_rows`` to the row count of the current phase."""
+        if self.stack:
+            self.stack[-1][1] += num_rows
+
+    def _record(self, elapsed):
+        """Record a call of the current phase that took ``elapsed`` seconds
+        and leave it."""
+        stack = self.stack
+        path = '/'.join(name for name, rows in stack)
+        name, rows = stack.pop()
+        with self._lock:
+            phase = self.phases.setdefault(
+                path, {'calls': 0, 'seconds': 0.0, 'rows': 0,
+                       'max_rss_mib': None})
+            phase['calls'] += 1
+            phase['seconds'] += elapsed
+            phase['rows'] += rows
+            phase['max_rss_mib'] = _max_rss_mib()
+
+    def results(self):
+        """Return the results as a dictionary.  The ``self_seconds`` of a phase
+        is the time spent in the phase but not in the phases it contains."""
+        phases = [dict(phase, name=path, self_seconds=phase['seconds'])
+                  for path, phase in sorted(self.phases.items())]
+        by_name = {phase['name']: phase for phase in phases}
+        for phase in phases:
+            parent = by_name.get(phase['name'].rpartition('/')[0])
+            if parent is not None:
+                parent['self_seconds'] -= phase['seconds']
+        return {'argv': sys.argv,
+                'seconds': time.perf_counter() - self.start,
+                'max_rss_mib': _max_rss_mib(),
+                'phases': phases}
+
+    def report(self, output=None):
+        """Print the results on the standard error, or write them as JSON to
+        the file ``output``."""
+        results = self.results()
+        if output:
+            import json
+            with open(output, 'w') as output_file:
+                json.dump(results, output_file, indent=2)
+                output_file.write('\n')
+            return
+        row_format = '{:32s}  {:>6}  {:>10}  {:>10}  {:>9}  {:>9}'
+        print(row_format.format('phase', 'calls', 'time (ms)', 'self (ms)',
+                                'rows', 'RSS (MiB)'), file=sys.stderr)
+        for phase in results['phases']:
+            depth = phase['name'].count('/')
+            name = '  ' * depth + phase['name'].rpartition('/')[2]
+            print(row_format.format(
+                name, phase['calls'], '{:.2f}'.format(phase['seconds'] * KILO),
+                '{:.2f}'.format(phase['self_seconds'] * KILO), phase['rows'],
+                _format_mib(phase['max_rss_mib'])), file=sys.stderr)
+        print(row_format.format(
+            'total', '', '{:.2f}'.format(results['seconds'] * KILO), '', '',
+            _format_mib(results['max_rss_mib'])), file=sys.stderr)
+
+
+def _max_rss_mib():
+    """Return the peak resident memory of the process in MiB, or ``None`` if
+    it is not known."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+def _format_mib(mib):
+    return '{:.1f}'.format(mib) if mib is not None else '?'
+
+
+_profile = None
+_NO_PHASE = nullcontext()
+
+
+def start_profile():
+    """Start recording the phases of the commands and return the
+    :class:`Profile` they are recorded in."""
+    global _profile
+    _profile = Profile()
+    return _profile
+
+
+def stop_profile():
+    """Stop recording the phases of the commands and return the
+    :class:`Profile` they were recorded in, if any."""
+    global _profile
+    profile, _profile = _profile, None
+    return profile
+
+
+def trace_enabled():
+    """Return whether the ``BIKE_TRACE`` environment variable asks for the
+    commands to be profiled."""
+    return TRACE not in ('', '0')
+
+
+def report_profile(output=None):
+    """Stop profiling and report the results, as JSON to the file ``output``
+    or to the one named by ``BIKE_TRACE``, or else on the standard error."""
+    profile = stop_profile()
+    if profile is None:
+        return
+    if not output and TRACE not in ('', '0', '1', 'stderr'):
+        output = TRACE
+    profile.report(output)
+
+
+def _phase(name):
+    """Return a context manager recording the time spent in its body as the
+    phase ``name`` when profiling, and doing nothing otherwise."""
+    if _profile is None:
+        return _NO_PHASE
+    return _profile.phase(name)
+
+
+def _rows(num_rows):
+    """Add ``num_rows`` to the row count of the current phase when
+    profiling."""
+    if _profile is not None:
+        _profile.rows(num_rows)
+
+
+def _iterate(name, iterable):
+    """Return ``iterable``, recording the time spent getting its items as the
+    phase ``name`` when profiling."""
+    if _profile is None:
+        return iterable
+    return _profile.iterate(name, iterable)
+
+
+def profiled(func):
+    """Decorator recording the calls of ``func`` as a phase named after it
+    when profiling."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _profile is None:
+            return func(*args, **kwargs)
+        with _profile.phase(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _normalize_years(year):
+    """Turn the ``year`` argument accepted by :func:`read_db_file` into either
+    ``'all'`` or a container of years."""
+    if not year:
+        return [datetime.now().year]
+    elif year == 'all':
+        return 'all'
+    elif not hasattr(year, '__contains__'):
+        return [year]
+    return year
+
+
+def _validate_ride(timestamp, distance, duration, comment='', url=''):
+    """Check and convert the fields of a ride given either as values or as
+    strings, and return them as a
+    ``(timestamp, distance, duration, comment, url)`` tuple.
+
+    Each ride takes a single line of the CSV file, which the index and the
+    journal rely on, so the comment and the URL may not hold line breaks.
+
+    """
+    if isinstance(timestamp, str):
+        timestamp = datetime.strptime(timestamp.strip(), TIMESTR)
+    distance = float(distance)
+    if isinstance(duration, str):
+        duration = parse_duration(duration)
+    for name, value in (('comment', comment), ('url', url)):
+        if value and ('\n' in value or '\r' in value):
+            raise ValueError(_('the {} must fit on a single line').format(
+                name))
+    return (timestamp, distance, float(duration), comment or '', url or '')
+
+
+def _parse_row(ride_row):
+    """Convert a row of the CSV file to a
+    ``(timestamp, distance, duration, comment, url)`` tuple."""
+    return (datetime.strptime(ride_row[0], TIMESTR),
+            float(ride_row[1]), float(ride_row[2]), ride_row[3], ride_row[4])
+
+
+# Origin and unit of Ride.epoch, timestamps are in local time.
+_EPOCH = datetime(1970, 1, 1)
+_SECOND = timedelta(seconds=1)
+
+
+class Ride(Mapping):
+    """A ride, as returned by :func:`read_db_file` and the other readers.
+
+    Rather than a dictionary, which would cost several hundred bytes for each
+    of the many rides read, a ride is a record with ``__slots__`` holding its
+    ``distance``, ``duration``, ``comment``, ``url`` and ``id``, and its
+    timestamp as ``epoch``, the number of seconds since 1970-01-01 in local
+    time.  The :attr:`timestamp` datetime is only built when first used.
+
+    Rides are also mappings with the keys ``KEYS``, which can be assigned, so
+    that ``ride['distance']`` keeps working.  Attributes are faster and are
+    used in loops over every ride.
+
+    """
+
+    __slots__ = ('epoch', 'distance', 'duration', 'comment', 'url', 'id',
+                 '_timestamp')
+    KEYS = ('timestamp', 'distance', 'duration', 'comment', 'url', 'id')
+
+    def __init__(self, timestamp, distance, duration, comment='', url='',
+                 id=None):
+        self.timestamp = timestamp
+        self.distance = distance
+        self.duration = duration
+        self.comment = comment
+        self.url = url
+        self.id = id
+
+    @classmethod
+    def from_epoch(cls, epoch, distance, duration, comment, url, id):
+        """Build a ride from its ``epoch`` rather than its timestamp, as
+        stored in the cache, which is faster."""
+        ride = cls.__new__(cls)
+        ride.epoch = epoch
+        ride.distance = distance
+        ride.duration = duration
+        ride.comment = comment
+        ride.url = url
+        ride.id = id
+        ride._timestamp = None
+        return ride
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None:
+            self._timestamp = _EPOCH + timedelta(0, self.epoch)
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self.epoch = (timestamp - _EPOCH) // _SECOND
+        # Timestamps read are whole seconds, others are kept as is.
+        self._timestamp = timestamp if timestamp.microsecond else None
+
+    @property
+    def year(self):
+        """The year of the ride, found without keeping a datetime."""
+        if self._timestamp is not None:
+            return self._timestamp.year
+        return (_EPOCH + timedelta(0, self.epoch)).year
+
+    @property
+    def speed(self):
+        """The average speed, ``nan`` if the duration is 0."""
+        if self.duration != 0:
+            return self.distance / self.duration
+        return float('nan')
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return 'Ride({})'.format(', '.join(
+            '{}={!r}'.format(key, self[key]) for key in self.KEYS))
+
+
+def _make_ride(row, id):
+    """Build the :class:`Ride` stored in ``row``."""
+    return Ride(row[0], row[1], row[2], row[3], row[4], id)
+
+
+def _ride_order(ride):
+    """Key sorting rides by timestamp, then by id, which is the order of the
+    rides read by :meth:`CSVBackend.read`."""
+    return ride.epoch, ride.id
+
+
+def _cache_row(row):
+    """Convert a ``(timestamp, distance, duration, comment, url)`` row to the
+    form stored in the cache, with the timestamp as a :attr:`Ride.epoch`."""
+    return ((row[0] - _EPOCH) // _SECOND, float(row[1]), float(row[2]),
+            row[3], row[4])
+
+
+@contextmanager
+def _gc_paused():
+    """Pause the cyclic garbage collector while many rides are built.
+
+    Unlike dictionaries of plain values, rides are tracked by the collector,
+    which would otherwise run over every ride already built many times.
+
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _format_row(row):
+    """Return the line of the CSV file, encoded, for the
+    ``(timestamp, distance, duration, comment, url)`` ``row``."""
+    line = io.StringIO()
+    rides_writer = csv.writer(line, delimiter=',', quotechar='"',
+                              quoting=csv.QUOTE_MINIMAL)
+    rides_writer.writerow(
+        [row[0].strftime(TIMESTR), str(row[1]), str(row[2]), row[3], row[4]])
+    return line.getvalue().encode('utf-8')
+
+
+class Query(object):
+    """A filter on rides, compiled from an expression such as::
+
+        distance>50 and duration<3 and comment~"commute" and date>=2021-04
+
+    Terms compare a field, ``date``, ``distance``, ``duration``, ``speed``,
+    ``comment`` or ``url``, to a value with ``=``, ``!=``, ``<``, ``<=``,
+    ``>`` or ``>=``, or, for the comment and the URL, test with ``~`` whether
+    they contain a text, ignoring case.  Values holding spaces or operators
+    are quoted.  Dates may be truncated, ``date>=2021-04`` keeps the rides
+    from April 2021 on and ``date=2021`` those of 2021.  Terms are combined
+    with ``and``, ``or``, ``not`` and parentheses.
+
+    The expression is compiled once into three Python functions.
+    :meth:`match_line` works on the fields of a line of the CSV file, as
+    strings, and compares dates as strings, so that rides are discarded
+    before any timestamp is parsed.  :meth:`match_row` works on parsed
+    ``(timestamp, distance, duration, comment, url)`` rows and
+    :meth:`match_epoch` on the same rows with the timestamp as a
+    :attr:`Ride.epoch`, as in the cache.  The operands of
+    ``and`` are reordered so that the cheapest are checked first.  ``years``
+    is the range of the years the matching rides can be of, or ``'all'``, so
+    that readers only read those years.
+
+    """
+
+    FIELDS = ('date', 'distance', 'duration', 'comment', 'url', 'speed')
+    OPERATORS = {'=': '==', '!=': '!=', '<': '<', '<=': '<=', '>': '>',
+                 '>=': '>='}
+    # Cost of checking a term on each field, cheapest first.
+    COSTS = {'date': 0, 'comment': 1, 'url': 1, 'distance': 2,
+             'duration': 2, 'speed': 3}
+
+    def __init__(self, expression):
+        import re
+        self.expression = expression
+        self._tokens = re.findall(
+            r'\s*(?:([()])|("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|'
+            r'(<=|>=|!=|=|<|>|~)|([^\s()<>=!~"\']+))', expression)
+        if ''.join(''.join(token) for token in self._tokens).replace(
+                ' ', '') != expression.replace(' ', ''):
+            self._error()
+        self._tokens = [next(part for part in token if part)
+                        for token in self._tokens]
+        self._position = 0
+        tree = self._parse_or()
+        if self._position != len(self._tokens):
+            self._error()
+        self.constants = []
+        namespace = {'_c': self.constants, '_speed': self._speed}
+        self.match_line = eval('lambda r: ' + self._compile(tree, True),
+                               namespace)
+        self.match_row = eval('lambda r: ' + self._compile(tree, False),
+                              namespace)
+        self.match_epoch = eval(
+            'lambda r: ' + self._compile(tree, False, epoch=True), namespace)
+        first, last = self._years(tree)
+        if first == 1 and last == 9999:
+            self.years = 'all'
+        else:
+            self.years = range(first, last + 1)
+
+    def __call__(self, ride):
+        """Tell whether the :class:`Ride` ``ride`` matches."""
+        return self.match_epoch((ride.epoch, ride.distance, ride.duration,
+                                 ride.comment, ride.url))
+
+    def restrict(self, years):
+        """Return the ``years``, ``'all'`` or a container of years, that may
+        hold matching rides."""
+        if self.years == 'all':
+            return years
+        if years == 'all':
+            return self.years
+        return [year for year in years if year in self.years]
+
+    @staticmethod
+    def _speed(distance, duration):
+        return distance / duration if duration else float('nan')
+
+    def _error(self, message=None):
+        raise ValueError(_('invalid query {}: {}').format(
+            repr(self.expression), message or _('syntax error')))
+
+    def _next(self):
+        if self._position == len(self._tokens):
+            self._error(_('unexpected end'))
+        self._position += 1
+        return self._tokens[self._position - 1]
+
+    def _peek(self):
+        if self._position < len(self._tokens):
+            return self._tokens[self._position].lower()
+        return None
+
+    def _parse_or(self):
+        operands = [self._parse_and()]
+        while self._peek() == 'or':
+            self._next()
+            operands.append(self._parse_and())
+        return ('or', operands) if len(operands) > 1 else operands[0]
+
+    def _parse_and(self):
+        operands = [self._parse_not()]
+        while self._peek() == 'and':
+            self._next()
+            operands.append(self._parse_not())
+        return ('and', operands) if len(operands) > 1 else operands[0]
+
+    def _parse_not(self):
+        token = self._next()
+        if token.lower() == 'not':
+            return ('not', self._parse_not())
+        if token == '(':
+            node = self._parse_or()
+            if self._next() != ')':
+                self._error()
+            return node
+        field = token.lower()
+        if field not in self.FIELDS:
+            self._error(_('unknown field {}').format(token))
+        operator = self._next()
+        if operator not in self.OPERATORS and operator != '~':
+            self._error()
+        value = self._next()
+        if value[0] in '"\'':
+            import re
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        if field in ('comment', 'url'):
+            if operator not in ('=', '!=', '~'):
+                self._error(_('{} can only be compared with =, != or ~')
+                            .format(field))
+            return ('term', field, operator, value)
+        if operator == '~':
+            self._error(_('~ only applies to comment and url'))
+        if field == 'date':
+            return ('term', field, operator, self._parse_date(value))
+        try:
+            number = float(value)
+        except ValueError:
+            number = float('nan')
+        # Neither nan nor infinities, which would not compile.
+        if not abs(number) < float('inf'):
+            self._error(_('invalid number {}').format(value))
+        return ('term', field, operator, number)
+
+    def _parse_date(self, value):
+        """Return the ``TIMESTR`` prefix matching the possibly truncated date
+        ``value``, and the first and the next moments of the period it
+        designates."""
+        import re
+        match = re.match(r'(\d{4})(?:-(\d\d)(?:-(\d\d)(?:[ T](\d\d)'
+                         r'(?::(\d\d)(?::(\d\d))?)?)?)?)?$', value)
+        if match is None:
+            self._error(_('invalid date {}').format(value))
+        prefix = value.replace('T', ' ')
+        parts = [part for part in match.groups() if part is not None]
+        try:
+            start = datetime.strptime(prefix, TIMESTR[:len(prefix) - 2])
+            if len(parts) == 1:
+                end = start.replace(year=start.year + 1)
+            elif len(parts) == 2:
+                end = (start.replace(year=start.year + 1, month=1)
+                       if start.month == 12 else
+                       start.replace(month=start.month + 1))
+            else:
+                end = start + timedelta(**{('days', 'hours', 'minutes',
+                                            'seconds')[len(parts) - 3]: 1})
+        except (ValueError, OverflowError):
+            self._error(_('invalid date {}').format(value))
+        return prefix, start, end
+
+    def _cost(self, node):
+        if node[0] == 'term':
+            return self.COSTS[node[1]]
+        if node[0] == 'not':
+            return self._cost(node[1])
+        return max(self._cost(operand) for operand in node[1])
+
+    def _constant(self, value):
+        self.constants.append(value)
+        return '_c[{}]'.format(len(self.constants) - 1)
+
+    def _compile(self, node, raw, epoch=False):
+        """Return the source of the Python expression testing ``node`` on
+        ``r``, the fields of a line if ``raw`` is true, or a parsed row, with
+        the timestamp as an epoch if ``epoch`` is true."""
+        if node[0] == 'not':
+            return 'not ({})'.format(self._compile(node[1], raw, epoch))
+        if node[0] in ('and', 'or'):
+            operands = node[1]
+            if node[0] == 'and':
+                operands = sorted(operands, key=self._cost)
+            return '({})'.format(' {} '.format(node[0]).join(
+                '({})'.format(self._compile(operand, raw, epoch))
+                for operand in operands))
+        field, operator, value = node[1:]
+        if field == 'date':
+            prefix, start, end = value
+            if raw:
+                return 'r[0][:{}] {} {!r}'.format(
+                    len(prefix), self.OPERATORS[operator], prefix)
+            if epoch:
+                start = (start - _EPOCH) // _SECOND
+                end = (end - _EPOCH) // _SECOND
+            start, end = self._constant(start), self._constant(end)
+            return {'=': '{0} <= r[0] < {1}', '!=': 'not {0} <= r[0] < {1}',
+                    '<': 'r[0] < {0}', '<=': 'r[0] < {1}',
+                    '>': 'r[0] >= {1}', '>=': 'r[0] >= {0}'}[operator].format(
+                        start, end)
+        if field in ('comment', 'url'):
+            column = 'r[{}]'.format(self.FIELDS.index(field))
+            if operator == '~':
+                return '{!r} in {}.lower()'.format(value.lower(), column)
+            return '{} {} {!r}'.format(column, self.OPERATORS[operator],
+                                       value)
+        if field == 'speed':
+            column = ('_speed(float(r[1]), float(r[2]))' if raw else
+                      '_speed(r[1], r[2])')
+        else:
+            column = 'r[{}]'.format(self.FIELDS.index(field))
+            if raw:
+                column = 'float({})'.format(column)
+        return '{} {} {!r}'.format(column, self.OPERATORS[operator], value)
+
+    def _years(self, node):
+        """Return the first and the last year the rides matching ``node``
+        can be of."""
+        if node[0] == 'and':
+            bounds = [self._years(operand) for operand in node[1]]
+            return (max(first for first, last in bounds),
+                    min(last for first, last in bounds))
+        if node[0] == 'or':
+            bounds = [self._years(operand) for operand in node[1]]
+            return (min(first for first, last in bounds),
+                    max(last for first, last in bounds))
+        if node[0] == 'not' or node[1] != 'date' or node[2] == '!=':
+            return 1, 9999
+        prefix, start, end = node[3]
+        return {'=': (start.year, start.year), '<': (1, start.year),
+                '<=': (1, end.year), '>': (end.year, 9999),
+                '>=': (start.year, 9999)}[node[2]]
+
+
+def _tokenize(text):
+    """Return the words of ``text``, lowercased and stripped of their accents
+    so that, as in French dictionaries, ``Été``, ``été`` and ``ete`` are the
+    same word.  Elisions are split, ``l'aller`` gives ``l`` and ``aller``."""
+    import re
+    text = text.casefold()
+    if not text.isascii():
+        import unicodedata
+        text = unicodedata.normalize(
+            'NFKD', text.replace('œ', 'oe').replace('æ', 'ae'))
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+    return re.findall(r'\w+', text)
+
+
+class SearchIndex(object):
+    """Inverted index of the words of the comments and URLs of the rides.
+
+    ``terms`` maps each word, as returned by :func:`_tokenize`, to the sorted
+    array of the ids of the rides using it, or to the bytes of the array
+    until it is first used, which makes loading the index much faster.
+    ``version`` is the
+    :func:`db_version` of the database the index was built for.  The index is
+    stored next to ``RIDEDB`` and kept up to date by :func:`add_ride`,
+    :func:`add_rides`, :func:`update_ride`, :func:`delete_ride` and
+    :func:`update_db`, which append their changes to a log rather than store
+    the index again.  ``pending`` is the number of changes replayed from the
+    log when the index was loaded.  When the rides are renumbered otherwise,
+    it is built again on the next search.
+
+    """
+
+    def __init__(self, version=None, terms=None):
+        self.version = version
+        self.terms = terms if terms is not None else {}
+        self.pending = 0
+        # Sorted words, for prefix searches, built on the first search.
+        self._words = None
+
+    @classmethod
+    def build(cls, rides, version=None, ids=None):
+        """Return the index of ``rides``, which must hold every ride of the
+        database at ``version``.  ``ids`` are the ids of the rides, by
+        default their ``id``."""
+        from array import array
+        terms = {}
+        words = {}
+        if ids is None:
+            rides = ((ride['id'], ride) for ride in rides)
+        else:
+            rides = zip(ids, rides)
+        with _phase('index words'):
+            for ride_id, ride in rides:
+                for text in (ride['comment'], ride['url']):
+                    if not text:
+                        continue
+                    # Comments are often repeated, only split them once.
+                    if text not in words:
+                        words[text] = _tokenize(text)
+                    for word in words[text]:
+                        postings = terms.get(word)
+                        if postings is None:
+                            postings = terms[word] = array('I')
+                        if not postings or postings[-1] != ride_id:
+                            postings.append(ride_id)
+            # Ids are only in order if the rides were.
+            for postings in terms.values():
+                if any(a >= b for a, b in zip(postings, postings[1:])):
+                    postings[:] = array('I', sorted(set(postings)))
+        return cls(version, terms)
+
+    @classmethod
+    def load(cls, version):
+        """Return the stored index, with the changes logged since replayed,
+        or ``None`` if it is missing or cannot be brought up to the database
+        at ``version``."""
+        sidecar = _read_sidecar(SEARCH_SUFFIX, SEARCH_VERSION)
+        if sidecar is None:
+            return None
+        index = cls(sidecar['db'], sidecar['terms'])
+        for before, after, changes in _read_search_log():
+            # Entries logged before the index was stored are skipped.
+            if before != index.version:
+                continue
+            for added, ride_id, comment, url in changes:
+                if added:
+                    index.add(ride_id, comment, url)
+                else:
+                    index.remove(ride_id, comment, url)
+            index.version = after
+            index.pending += len(changes)
+        if index.version != version:
+            return None
+        return index
+
+    def save(self):
+        """Store the index next to ``RIDEDB`` and clear the log of
+        changes."""
+        terms = {word: postings if isinstance(postings, bytes) else
+                 postings.tobytes() for word, postings in self.terms.items()}
+        try:
+            _atomic_write(_sidecar_path(SEARCH_SUFFIX), pickle.dumps(
+                {'version': SEARCH_VERSION, 'db': self.version,
+                 'terms': terms}, protocol=pickle.HIGHEST_PROTOCOL))
+            # Changes logged meanwhile are lost, the index is then built
+            # again rather than used out of date.
+            os.remove(_sidecar_path(SEARCH_LOG_SUFFIX))
+        except OSError:
+            pass
+        self.pending = 0
+
+    def postings(self, word):
+        """Return the sorted array of the ids of the rides using ``word``, or
+        ``None`` if there is none."""
+        from array import array
+        postings = self.terms.get(word)
+        if isinstance(postings, bytes):
+            postings = self.terms[word] = array('I', postings)
+        return postings
+
+    def add(self, ride_id, comment, url):
+        """Index the words of the ``comment`` and ``url`` of the ride
+        ``ride_id``."""
+        import bisect
+        from array import array
+        for word in set(_tokenize(comment) + _tokenize(url)):
+            postings = self.postings(word)
+            if postings is None:
+                postings = self.terms[word] = array('I')
+                if self._words is not None:
+                    bisect.insort(self._words, word)
+            i = bisect.bisect_left(postings, ride_id)
+            if i == len(postings) or postings[i] != ride_id:
+                postings.insert(i, ride_id)
+
+    def remove(self, ride_id, comment, url):
+        """Forget the words of the ``comment`` and ``url`` the ride
+        ``ride_id`` had."""
+        import bisect
+        for word in set(_tokenize(comment) + _tokenize(url)):
+            postings = self.postings(word)
+            if postings is None:
+                continue
+            i = bisect.bisect_left(postings, ride_id)
+            if i < len(postings) and postings[i] == ride_id:
+                del postings[i]
+            if not postings:
+                del self.terms[word]
+                if self._words is not None:
+                    del self._words[bisect.bisect_left(self._words, word)]
+
+    def search(self, text):
+        """Return the sorted ids of the rides whose comment or URL has, for
+        each word of ``text``, a word starting with it, so that results can
+        be shown as the words are typed."""
+        import bisect
+        if self._words is None:
+            self._words = sorted(self.terms)
+        # For each word of text, the postings of the words starting with it.
+        matches = []
+        for token in set(_tokenize(text)):
+            first = bisect.bisect_left(self._words, token)
+            last = bisect.bisect_left(self._words, token + '\U0010ffff',
+                                      first)
+            matches.append([self.postings(word)
+                            for word in self._words[first:last]])
+        if not matches:
+            return []
+        # Start from the fewest rides, only they are then looked up.
+        matches.sort(key=lambda postings: sum(map(len, postings)))
+        if len(matches) == 1 and len(matches[0]) == 1:
+            return list(matches[0][0])
+        found = set().union(*matches[0])
+        for postings in matches[1:]:
+            if len(found) * 32 < sum(map(len, postings)):
+                # Few rides are left, look them up rather than going
+                # through every id of the postings.
+                found = {ride_id for ride_id in found
+                         if any(self._holds(ids, ride_id) for ids in postings)}
+            else:
+                found = set().union(*(found.intersection(ids)
+                                      for ids in postings))
+            if not found:
+                break
+        return sorted(found)
+
+    @staticmethod
+    def _holds(postings, ride_id):
+        import bisect
+        i = bisect.bisect_left(postings, ride_id)
+        return i < len(postings) and postings[i] == ride_id
+
+
+def _sidecar_path(suffix):
+    """Return the path of the helper file with ``suffix`` that sits next to
+    ``RIDEDB``."""
+    return RIDEDB + suffix
+
+
+def _atomic_write(path, data):
+    """Replace the content of the file at ``path`` with the bytes ``data``.
+
+    The data is written to a temporary file which is then renamed over
+    ``path``, so readers see either the old or the new content, never a
+    partially written file.
+
+    """
+    import tempfile
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=name + '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+_thread_lock = threading.RLock()
+_lock_file = None
+_lock_depth = 0
+_lock_owner = None
+
+
+@contextmanager
+def _write_lock():
+    """Hold the advisory lock that serializes the processes and threads writing
+    to the database.  The lock is reentrant.
+
+    Readers never take the lock, they rely on :class:`_Snapshot` instead.
+
+    The lock between processes uses ``fcntl.flock``, which is not available
+    on Windows.  There, only the threads of a process are serialized, and a
+    warning is issued the first time the lock is taken.
+
+    """
+    global _lock_file, _lock_depth, _lock_owner
+    with _thread_lock:
+        if _lock_depth == 0:
+            lock_file = open(_sidecar_path(LOCK_SUFFIX), 'ab')
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                import warnings
+                warnings.warn('fcntl is not available, bike processes '
+                              'writing to the rides at the same time are not '
+                              'serialized', RuntimeWarning, stacklevel=3)
+            _lock_file = lock_file
+            _lock_owner = threading.get_ident()
+        _lock_depth += 1
+        try:
+            yield
+        finally:
+            _lock_depth -= 1
+            if _lock_depth == 0:
+                # Closing the file releases the lock.
+                _lock_file.close()
+                _lock_file = None
+                _lock_owner = None
+
+
+def _appending(rides_file, stat):
+    """Tell whether a writer may still be appending to the open
+    ``rides_file``, described by the ``os.stat`` result ``stat`` when it was
+    opened: another thread or process holds the write lock, or the file grew
+    since."""
+    lock_file = None
+    if _lock_owner != threading.get_ident():
+        if fcntl is None:
+            if _lock_depth:
+                return True
+        else:
+            try:
+                lock_file = open(_sidecar_path(LOCK_SUFFIX), 'ab')
+            except OSError:
+                pass
+            else:
+                try:
+                    fcntl.flock(lock_file.fileno(),
+                                fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except OSError:
+                    lock_file.close()
+                    return True
+    try:
+        # Holding the lock, no writer can start appending meanwhile.
+        return os.fstat(rides_file.fileno()).st_size != stat.st_size
+    finally:
+        if lock_file is not None:
+            lock_file.close()
+
+
+def _same_file(stat, other):
+    """Tell whether two ``os.stat`` results describe the same file."""
+    return (stat.st_ino, stat.st_dev) == (other.st_ino, other.st_dev)
+
+
+class _Snapshot(object):
+    """A consistent, read-only view of ``RIDEDB`` and of the journal entries
+    that apply to it.
+
+    Writers only ever append whole lines to ``RIDEDB`` or replace it
+    atomically, so the file opened by the snapshot never changes but for the
+    lines appended after it was taken, which are ignored.  A last line with
+    no newline is ignored as well if a writer may still be appending it, and
+    read otherwise, as when the file was edited by hand.  Journal entries are
+    tagged with the inode of the file they apply to.  If the file is replaced
+    while the journal is read, the snapshot is taken again.
+
+    """
+
+    def __init__(self):
+        while True:
+            self.file = open(RIDEDB, 'rb')
+            self.stat = os.fstat(self.file.fileno())
+            self.journal, self.journal_size, self.journal_entries = (
+                _load_journal(self.stat))
+            try:
+                if _same_file(self.stat, os.stat(RIDEDB)):
+                    break
+            except FileNotFoundError:
+                pass
+            self.file.close()
+        self.size = self._complete_size()
+
+    def _complete_size(self):
+        """Return the size of the file up to the end of its last complete
+        line."""
+        end = self.stat.st_size
+        if end == 0 or not self.unterminated(end) or not _appending(
+                self.file, self.stat):
+            return end
+        while end > 0:
+            start = max(0, end - 4096)
+            self.file.seek(start)
+            newline = self.file.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+        return 0
+
+    def unterminated(self, size):
+        """Tell whether the first ``size`` bytes of the file do not end
+        with a newline."""
+        if size == 0:
+            return False
+        self.file.seek(size - 1)
+        return self.file.read(1) != b'\n'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def read(self):
+        """Return the content of the file."""
+        self.file.seek(0)
+        return self.file.read(self.size)
+
+    def lines(self):
+        """Yield the lines of the file."""
+        self.file.seek(0)
+        pos = 0
+        for line in self.file:
+            pos += len(line)
+            if pos > self.size:
+                break
+            yield line
+
+
+def _read_sidecar(suffix, version):
+    """Return the content of the helper file with ``suffix``, or ``None`` if it
+    is missing, unreadable or of another version."""
+    try:
+        with open(_sidecar_path(suffix), 'rb') as sidecar_file:
+            sidecar = pickle.load(sidecar_file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError, IndexError):
+        return None
+    if not isinstance(sidecar, dict) or sidecar.get('version') != version:
+        return None
+    return sidecar
+
+
+def _stamp(stat):
+    """Return the size, modification time and inode of the ``os.stat``
+    result ``stat``, which identify a version of ``RIDEDB``."""
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def _write_sidecar(suffix, sidecar, stat):
+    """Store the ``sidecar`` dictionary in the helper file with ``suffix``,
+    stamped with the version of ``RIDEDB`` described by the ``os.stat``
+    result ``stat``."""
+    sidecar['stamp'] = _stamp(stat)
+    try:
+        _atomic_write(_sidecar_path(suffix),
+                      pickle.dumps(sidecar, protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError:
+        # Helper files are only an optimization, never fail because of them.
+        pass
+
+
+def _load_cache(snapshot):
+    """Return the list of parsed ride rows stored in the cache, or ``None`` if
+    the cache is missing or does not match the content of the ``snapshot``.
+
+    Each row is an ``(epoch, distance, duration, comment, url)`` tuple in
+    file order, see :func:`_cache_row`.
+
+    """
+    cache = _read_sidecar(CACHE_SUFFIX, CACHE_VERSION)
+    if cache is None:
+        return None
+    if cache['stamp'][0] == snapshot.size:
+        if cache['stamp'] != _stamp(snapshot.stat):
+            # The file was touched, only trust the cache if the content is
+            # unchanged.
+            import hashlib
+            if hashlib.sha1(snapshot.read()).hexdigest() != cache['hash']:
+                return None
+            if snapshot.size == snapshot.stat.st_size:
+                # Stamp it again so that the file is not hashed on every
+                # read.
+                _write_sidecar(CACHE_SUFFIX, cache, snapshot.stat)
+        return cache['rows']
+    lines = _appended_lines(snapshot, cache['stamp'])
+    if lines is None:
+        return None
+    rows = cache['rows']
+    rows.extend(_cache_row(row) for row in _parse_lines(lines))
+    _write_cache(rows, snapshot.stat, snapshot.read())
+    return rows
+
+
+def _write_cache(rows, stat, content):
+    """Store the parsed ride ``rows`` in the cache along with the hash of the
+    ``content`` of the version of ``RIDEDB`` described by ``stat``."""
+    import hashlib
+    _write_sidecar(CACHE_SUFFIX, {'version': CACHE_VERSION,
+                                  'hash': hashlib.sha1(content).hexdigest(),
+                                  'rows': rows}, stat)
+
+
+def _parse_db_file(snapshot, sep=','):
+    """Parse every line of the ``snapshot`` and return the rows as tuples.
+
+    When profiling, the lines are split into fields and the fields converted
+    in two passes, so that both can be timed.
+
+    """
+    with _phase('read'):
+        content = snapshot.read().decode('utf-8')
+    rides_reader = csv.reader(io.StringIO(content, newline=''),
+                              delimiter=sep, quotechar='"')
+    if _profile is None:
+        return [_parse_row(ride_row) for ride_row in rides_reader]
+    with _phase('csv'):
+        ride_rows = list(rides_reader)
+        _rows(len(ride_rows))
+    with _phase('convert'):
+        return [_parse_row(ride_row) for ride_row in ride_rows]
+
+
+def _log_append(old_stat, new_stat, num_lines):
+    """Record in the log of appends that :meth:`CSVBackend.add` turned the
+    version of ``RIDEDB`` described by ``old_stat`` into the one described by
+    ``new_stat``, of ``num_lines`` lines.
+
+    Rather than being rewritten on every append, helper files built for an
+    older version are brought up to date from the lines appended since, as
+    found from the log, when they are next used.
+
+    """
+    entry = _stamp(old_stat) + _stamp(new_stat) + [num_lines]
+    try:
+        with open(_sidecar_path(APPENDS_SUFFIX), 'a') as appends_file:
+            appends_file.write(' '.join(map(str, entry)) + '\n')
+    except OSError:
+        pass
+
+
+def _load_appends():
+    """Return the log of appends as a dictionary mapping the stamp of each
+    version of ``RIDEDB`` that was appended to, as a tuple, to the stamp of
+    the version after the append and its number of lines."""
+    try:
+        with open(_sidecar_path(APPENDS_SUFFIX), 'rb') as appends_file:
+            content = appends_file.read()
+    except OSError:
+        return {}
+    appends = {}
+    # Ignore an entry that is still being written.
+    for entry in content.split(b'\n')[:-1]:
+        try:
+            values = [int(value) for value in entry.split()]
+        except ValueError:
+            continue
+        if len(values) == 7:
+            appends[tuple(values[:3])] = (values[3:6], values[6])
+    return appends
+
+
+def _counted_lines(snapshot):
+    """Return the number of lines of the ``snapshot`` if the log of appends
+    recorded it, or else ``None``.  Only the last entry is read."""
+    try:
+        with open(_sidecar_path(APPENDS_SUFFIX), 'rb') as appends_file:
+            appends_file.seek(0, os.SEEK_END)
+            appends_file.seek(max(0, appends_file.tell() - 256))
+            content = appends_file.read()
+    except OSError:
+        return None
+    entries = content.split(b'\n')
+    if len(entries) < 2:
+        return None
+    try:
+        values = [int(value) for value in entries[-2].split()]
+    except ValueError:
+        return None
+    if len(values) != 7 or values[3:6] != _stamp(snapshot.stat):
+        return None
+    return values[6]
+
+
+def _appended_lines(snapshot, stamp):
+    """Return the lines appended by :meth:`CSVBackend.add` to the version of
+    ``RIDEDB`` with ``stamp`` to give the ``snapshot``, or ``None`` if it was
+    changed otherwise, according to the log of appends."""
+    current = _stamp(snapshot.stat)
+    if stamp == current:
+        return []
+    size = stamp[0]
+    appends = _load_appends()
+    while stamp != current:
+        # Entries are popped so that a cycle cannot loop forever.
+        entry = appends.pop(tuple(stamp), None)
+        if entry is None:
+            return None
+        stamp = entry[0]
+    snapshot.file.seek(size)
+    return list(io.BytesIO(snapshot.file.read(snapshot.size - size)))
+
+
+def _parse_lines(lines):
+    """Parse the encoded ``lines`` of the CSV file and return the rows."""
+    return [_parse_row(ride_row) for ride_row in csv.reader(
+        (line.decode('utf-8') for line in lines), delimiter=',',
+        quotechar='"')]
+
+
+def _index_append(index, key, end):
+    """Record in ``index`` a new line that ends at byte offset ``end`` for a
+    ride whose timestamp, formatted with ``TIMESTR`` and encoded, is
+    ``key``."""
+    id = len(index['offsets']) - 1
+    index['offsets'].append(end)
+    if key < index['last']:
+        index['sorted'] = False
+    else:
+        index['last'] = key
+    year = int(key[:4])
+    ranges = index['years'].setdefault(year, [])
+    if ranges and ranges[-1][1] == id:
+        ranges[-1][1] = id + 1
+    else:
+        ranges.append([id, id + 1])
+
+
+def _build_index(snapshot):
+    """Scan the ``snapshot`` and build the index of its lines.
+
+    The index holds the array of the byte offsets at which each line starts
+    (the id of a ride is its line number) followed by the size of the file,
+    as well as, for each year, the list of ``[first_id, last_id)`` ranges of
+    consecutive lines holding rides of that year.  It also records whether
+    the lines are in chronological order.  No timestamp is parsed, they are
+    compared as strings.
+
+    """
+    from array import array
+    index = {'version': INDEX_VERSION, 'offsets': array('Q', [0]),
+             'years': {}, 'sorted': True, 'last': b''}
+    pos = 0
+    for line in snapshot.lines():
+        pos += len(line)
+        _index_append(index, line[:19], pos)
+    _write_index(index, snapshot.stat)
+    return index
+
+
+def _write_index(index, stat):
+    """Store the ``index`` of the version of ``RIDEDB`` described by the
+    ``os.stat`` result ``stat``.
+
+    The offsets are written as raw integers after the rest of the index, so
+    that :func:`_index_line` can read those of a single line.
+
+    """
+    header = {key: value for key, value in index.items() if key != 'offsets'}
+    header['num_offsets'] = len(index['offsets'])
+    header['stamp'] = _stamp(stat)
+    try:
+        _atomic_write(_sidecar_path(INDEX_SUFFIX),
+                      pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL) +
+                      index['offsets'].tobytes())
+    except OSError:
+        pass
+
+
+def _read_index_header(index_file):
+    """Return the index stored in the open ``index_file`` but for its
+    offsets, which are left to read, or ``None`` if it is of another
+    version."""
+    header = pickle.load(index_file)
+    if not isinstance(header, dict) or header.get('version') != INDEX_VERSION:
+        return None
+    return header
+
+
+def _load_index(snapshot):
+    """Return the index of the ``snapshot``, updated with the lines appended
+    since it was built, or ``None`` if it is missing or stale."""
+    from array import array
+    try:
+        with open(_sidecar_path(INDEX_SUFFIX), 'rb') as index_file:
+            index = _read_index_header(index_file)
+            if index is None:
+                return None
+            offsets = array('Q')
+            offsets.frombytes(index_file.read())
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+            AttributeError, ImportError, IndexError):
+        return None
+    if len(offsets) != index.pop('num_offsets'):
+        return None
+    index['offsets'] = offsets
+    lines = _appended_lines(snapshot, index['stamp'])
+    if lines is None:
+        return None
+    if lines:
+        end = offsets[-1]
+        for line in lines:
+            end += len(line)
+            _index_append(index, line[:19], end)
+        _write_index(index, snapshot.stat)
+    if offsets[-1] != snapshot.size:
+        return None
+    return index
+
+
+def _index_line(snapshot, ride_id):
+    """Return the byte offsets of the start and of the end of the line
+    ``ride_id`` of the ``snapshot``, reading only them from the stored index,
+    or ``None`` if the index is missing or stale or does not hold the line
+    yet."""
+    from array import array
+    try:
+        with open(_sidecar_path(INDEX_SUFFIX), 'rb') as index_file:
+            index = _read_index_header(index_file)
+            if index is None or not 0 <= ride_id < index['num_offsets'] - 1:
+                return None
+            index_file.seek(ride_id * array('Q').itemsize, os.SEEK_CUR)
+            line = array('Q')
+            line.frombytes(index_file.read(2 * line.itemsize))
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+            AttributeError, ImportError, IndexError):
+        return None
+    # Lines appended since are not in the index, but do not move the others.
+    if _appended_lines(snapshot, index['stamp']) is None:
+        return None
+    return line[0], line[1]
+
+
+def _read_lines(snapshot, index, ranges):
+    """Read the lines of the ``snapshot`` covered by the
+    ``[first_id, last_id)`` ``ranges`` of ``index`` one at a time and yield
+    ``(id, ride_row)`` pairs."""
+    offsets = index['offsets']
+    rides_file = snapshot.file
+    for first, last in ranges:
+        rides_file.seek(offsets[first])
+        lines = (line.decode('utf-8') for line in
+                 itertools.islice(rides_file, last - first))
+        rides_reader = csv.reader(lines, delimiter=',', quotechar='"')
+        for id, ride_row in enumerate(rides_reader, first):
+            yield id, ride_row
+
+
+def _year_ranges(index, years):
+    """Return the sorted ``[first_id, last_id)`` ranges of lines of ``index``
+    holding the rides of ``years``."""
+    return sorted(r for year, ranges in index['years'].items()
+                  if year in years for r in ranges)
+
+
+def _aggregate_add(aggregates, timestamp, distance, duration, sign=1):
+    """Add a ride to the per year ``aggregates``, or remove it if ``sign`` is
+    -1."""
+    sums = aggregates['years'].setdefault(timestamp.year, [0, 0.0, 0.0, 0.0])
+    sums[0] += sign
+    sums[1] += sign * distance
+    sums[2] += sign * duration
+    if duration != 0:
+        sums[3] += sign * distance / duration
+    if sums[0] == 0:
+        del aggregates['years'][timestamp.year]
+
+
+def _load_aggregates(snapshot):
+    """Return the per year aggregates of the ``snapshot``, updated with the
+    lines appended since they were computed, or ``None`` if they are missing
+    or stale."""
+    aggregates = _read_sidecar(AGGREGATES_SUFFIX, AGGREGATES_VERSION)
+    if (aggregates is None or
+            aggregates['journal'] != snapshot.journal_size):
+        return None
+    lines = _appended_lines(snapshot, aggregates['stamp'])
+    if lines is None:
+        return None
+    if lines:
+        for row in _parse_lines(lines):
+            _aggregate_add(aggregates, row[0], row[1], row[2])
+        _write_aggregates(aggregates, snapshot.stat, snapshot.journal_size)
+    return aggregates
+
+
+def _write_aggregates(aggregates, stat, journal_size):
+    """Store the per year ``aggregates`` of the version of ``RIDEDB``
+    described by ``stat`` and a journal of ``journal_size`` bytes."""
+    aggregates['journal'] = journal_size
+    _write_sidecar(AGGREGATES_SUFFIX, aggregates, stat)
+
+
+def _build_aggregates(rides, stat, journal_size):
+    """Compute and store the per year aggregates of ``rides``, which must hold
+    every ride of the database.
+
+    For each year, the aggregates hold the number of rides, the total distance,
+    the total duration and the sum of the speeds of the rides.
+
+    """
+    aggregates = {'version': AGGREGATES_VERSION, 'years': {}}
+    for ride in rides:
+        _aggregate_add(aggregates, ride['timestamp'], ride['distance'],
+                       ride['duration'])
+    _write_aggregates(aggregates, stat, journal_size)
+    return aggregates
+
+
+def _journal_size():
+    """Return the size of the journal of edits and deletions, 0 if there is
+    none."""
+    try:
+        return os.path.getsize(_sidecar_path(JOURNAL_SUFFIX))
+    except OSError:
+        return 0
+
+
+def _load_journal(stat):
+    """Read the journal of edits and deletions.
+
+    Return a dictionary mapping the id of every edited ride to its new
+    ``(timestamp, distance, duration, comment, url)`` row, or to ``None`` if
+    the ride was deleted, along with the size of the journal and the number
+    of complete entries it holds.  Later entries override earlier ones.  Only
+    the entries that apply to the version of ``RIDEDB`` described by the
+    ``os.stat`` result ``stat`` are kept.
+
+    """
+    try:
+        with open(_sidecar_path(JOURNAL_SUFFIX), 'rb') as journal_file:
+            content = journal_file.read()
+    except FileNotFoundError:
+        return {}, 0, 0
+    return (_parse_journal(content, stat.st_ino), len(content),
+            content.count(b'\n'))
+
+
+def _parse_journal(content, inode):
+    """Return the dictionary of the edits recorded in the journal ``content``
+    for the version of ``RIDEDB`` with ``inode``, as :func:`_load_journal`
+    does."""
+    journal = {}
+    # Ignore an entry that is still being written.
+    complete = content[:content.rfind(b'\n') + 1].decode('utf-8')
+    generation = str(inode)
+    journal_reader = csv.reader(io.StringIO(complete, newline=''),
+                                delimiter=',', quotechar='"')
+    for entry in journal_reader:
+        if not entry or entry[1] != generation:
+            continue
+        if entry[0] == 'D':
+            journal[int(entry[2])] = None
+        else:
+            journal[int(entry[2])] = _parse_row(entry[3:])
+    return journal
+
+
+def _journal_tail(offset, inode):
+    """Return the edits appended to the journal after byte ``offset`` for the
+    version of ``RIDEDB`` with ``inode``, and the offset of the end of the
+    last complete entry, or ``(None, None)`` if the journal was removed or
+    truncated since."""
+    try:
+        journal_file = open(_sidecar_path(JOURNAL_SUFFIX), 'rb')
+    except FileNotFoundError:
+        return ({}, 0) if offset == 0 else (None, None)
+    with journal_file:
+        if os.fstat(journal_file.fileno()).st_size < offset:
+            return None, None
+        journal_file.seek(offset)
+        content = journal_file.read()
+    return (_parse_journal(content, inode),
+            offset + content.rfind(b'\n') + 1)
+
+
+def _follow_check(rides_file, size):
+    """Return the hash of the ``FOLLOW_CHECK_SIZE`` bytes of the open
+    ``rides_file`` that end at offset ``size``."""
+    import hashlib
+    start = max(0, size - FOLLOW_CHECK_SIZE)
+    rides_file.seek(start)
+    return hashlib.sha1(rides_file.read(size - start)).hexdigest()
+
+
+def _journal_append(stat, ride_id, row=None):
+    """Record in the journal that the ride ``ride_id`` of the version of
+    ``RIDEDB`` described by ``stat`` was replaced by ``row``, or deleted if
+    ``row`` is ``None``."""
+    line = io.StringIO()
+    journal_writer = csv.writer(line, delimiter=',', quotechar='"',
+                                quoting=csv.QUOTE_MINIMAL)
+    if row is None:
+        journal_writer.writerow(['D', stat.st_ino, ride_id])
+    else:
+        journal_writer.writerow(
+            ['U', stat.st_ino, ride_id, row[0].strftime(TIMESTR), str(row[1]),
+             str(row[2]), row[3], row[4]])
+    with open(_sidecar_path(JOURNAL_SUFFIX), 'ab') as journal_file:
+        journal_file.write(line.getvalue().encode('utf-8'))
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+
+class CSVBackend(object):
+    """Store the rides in the plain text CSV file ``RIDEDB``.
+
+    The id of a ride is the number of the line holding it.  Helper files next
+    to ``RIDEDB`` hold the parsed rides, the byte offset index of the lines
+    and the per year aggregates.  Edits and deletions are appended to a
+    journal which is folded back into the file by :meth:`compact`.
+
+    Writers hold an advisory lock and either append whole lines to the file
+    or replace it atomically, while readers work on a :class:`_Snapshot` and
+    never wait for writers.
+
+    """
+
+    name = 'csv'
+
+    @staticmethod
+    def _snapshot():
+        """Take a snapshot of the file, creating it if it does not exist."""
+        try:
+            return _Snapshot()
+        except FileNotFoundError:
+            open(RIDEDB, 'a', encoding='utf-8').close()
+            return _Snapshot()
+
+    @staticmethod
+    def _index(snapshot):
+        """Return the index of the ``snapshot``, building it if needed."""
+        with _phase('index'):
+            return _load_index(snapshot) or _build_index(snapshot)
+
+    def read(self, years, sep=',', query=None):
+        """Return the rides of ``years``, or of every year if ``years`` is
+        ``'all'``, sorted by timestamp, keeping only those matching the
+        :class:`Query` ``query`` if given.
+
+        Parsed rides are kept in a cache next to the data file which is
+        rebuilt automatically whenever the data file changes.  When only some
+        years are requested, the byte offset index is used to parse only the
+        lines of those years, and ``query`` is checked on the fields of each
+        line before its timestamp is parsed.
+
+        """
+        with self._snapshot() as snapshot:
+            return self._read(snapshot, years, sep, query)
+
+    def _read(self, snapshot, years, sep=',', query=None):
+        rides = []
+        journal = snapshot.journal
+        if years != 'all' and sep == ',':
+            index = self._index(snapshot)
+            match_line = query.match_line if query is not None else None
+            with _phase('parse'), _gc_paused():
+                for id, ride_row in _read_lines(snapshot, index,
+                                                 _year_ranges(index, years)):
+                    if id not in journal and (match_line is None or
+                                              match_line(ride_row)):
+                        rides.append(_make_ride(_parse_row(ride_row), id))
+                for id, row in journal.items():
+                    if (row is not None and row[0].year in years and
+                            (query is None or query.match_row(row))):
+                        rides.append(_make_ride(row, id))
+                _rows(len(rides))
+            with _phase('sort'):
+                # Edited rides come last, put them back in id order.
+                rides.sort(key=_ride_order)
+            return rides
+        rows = None
+        if sep == ',':
+            with _phase('load cache'):
+                rows = _load_cache(snapshot)
+        if rows is None:
+            with _phase('parse'):
+                rows = [_cache_row(row)
+                        for row in _parse_db_file(snapshot, sep)]
+            if sep == ',':
+                with _phase('write cache'):
+                    _write_cache(rows, snapshot.stat, snapshot.read())
+        from_epoch = Ride.from_epoch
+        with _phase('filter'), _gc_paused():
+            for id, row in enumerate(rows):
+                if id in journal:
+                    row = journal[id]
+                    if row is None or (query is not None and
+                                       not query.match_row(row)):
+                        continue
+                    ride = _make_ride(row, id)
+                else:
+                    if query is not None and not query.match_epoch(row):
+                        continue
+                    ride = from_epoch(row[0], row[1], row[2], row[3], row[4],
+                                      id)
+                if years != 'all' and ride.year not in years:
+                    continue
+                rides.append(ride)
+            _rows(len(rides))
+        with _phase('sort'):
+            rides.sort(key=lambda ride: ride.epoch)
+        return rides
+
+    def get(self, ride_id):
+        """Return the ride with id ``ride_id`` or ``None`` if there is no such
+        ride.  Only the line holding the ride is read and parsed."""
+        with self._snapshot() as snapshot:
+            return self._get(snapshot, ride_id)
+
+    def _get(self, snapshot, ride_id):
+        # Journal entries are only written for rides that exist.
+        if ride_id in snapshot.journal:
+            row = snapshot.journal[ride_id]
+            return _make_ride(row, ride_id) if row is not None else None
+        line = _index_line(snapshot, ride_id)
+        if line is None:
+            offsets = self._index(snapshot)['offsets']
+            if not 0 <= ride_id < len(offsets) - 1:
+                return None
+            line = offsets[ride_id], offsets[ride_id + 1]
+        snapshot.file.seek(line[0])
+        return _make_ride(
+            _parse_lines([snapshot.file.read(line[1] - line[0])])[0], ride_id)
+
+    def get_many(self, ride_ids):
+        """Return the rides with the sorted ids ``ride_ids``, sorted by
+        timestamp.  Only the lines holding them are read and parsed."""
+        with self._snapshot() as snapshot:
+            index = self._index(snapshot)
+            journal = snapshot.journal
+            ranges = []
+            for ride_id in ride_ids:
+                if (ride_id in journal or
+                        not 0 <= ride_id < len(index['offsets']) - 1):
+                    continue
+                if ranges and ranges[-1][1] == ride_id:
+                    ranges[-1][1] += 1
+                else:
+                    ranges.append([ride_id, ride_id + 1])
+            rides = [_make_ride(_parse_row(ride_row), id) for id, ride_row
+                     in _read_lines(snapshot, index, ranges)]
+            rides.extend(_make_ride(journal[ride_id], ride_id)
+                         for ride_id in ride_ids
+                         if journal.get(ride_id) is not None)
+        rides.sort(key=lambda ride: ride.epoch)
+        return rides
+
+    def iter(self, years, query=None):
+        """Yield the rides of ``years`` matching the :class:`Query` ``query``,
+        if given, in chronological order.
+
+        When the file is known to be sorted, which is the case unless it was
+        edited by hand or a ride was added with a timestamp in the past, the
+        rides are read lazily in file order.  Deleted rides are skipped and
+        the rides edited since the last compaction, of which there are fewer
+        than ``COMPACT_THRESHOLD``, are merged in at their place.
+        Otherwise, :meth:`read` is used.
+
+        """
+        import heapq
+        with self._snapshot() as snapshot:
+            journal = snapshot.journal
+            index = self._index(snapshot)
+            if not index['sorted']:
+                for ride in self._read(snapshot, years, query=query):
+                    yield ride
+                return
+            if years == 'all':
+                ranges = [(0, len(index['offsets']) - 1)]
+            else:
+                ranges = _year_ranges(index, years)
+            edited = sorted(
+                (_make_ride(row, id) for id, row in journal.items()
+                 if row is not None and
+                 (years == 'all' or row[0].year in years) and
+                 (query is None or query.match_row(row))),
+                key=_ride_order)
+            match_line = query.match_line if query is not None else None
+
+            def stored():
+                for id, ride_row in _read_lines(snapshot, index, ranges):
+                    if id not in journal and (match_line is None or
+                                              match_line(ride_row)):
+                        yield _make_ride(_parse_row(ride_row), id)
+            for ride in heapq.merge(stored(), edited, key=_ride_order):
+                yield ride
+
+    def add(self, rows, merge=False):
+        """Add the ``(timestamp, distance, duration, comment, url)`` ``rows``.
+
+        They are appended to the file with a single write.  If ``merge`` is
+        true, ``rows`` must be sorted and, if the first row is older than the
+        last ride of the file, the rows are merged with the existing rides and
+        the file is rewritten once instead.
+
+        Return the list of the ids of the new rides, or ``None`` if the file
+        was rewritten, in which case every ride was renumbered.
+
+        Helper files are not touched, the append is recorded in the log of
+        appends and they are brought up to date when next used.  The number
+        of lines, which gives the ids of the new rides, is taken from the log
+        as well, so that the index is only loaded when merging.
+
+        """
+        with _write_lock(), self._snapshot() as snapshot:
+            first_id = None if merge else _counted_lines(snapshot)
+            if first_id is None:
+                index = self._index(snapshot)
+                if merge and (not index['sorted'] or
+                              _format_row(rows[0])[:19] < index['last']):
+                    self.rewrite(self._read(snapshot, 'all') +
+                                 [_make_ride(row, None) for row in rows])
+                    return None
+                first_id = len(index['offsets']) - 1
+            data = b''.join(_format_row(row) for row in rows)
+            old_stat = snapshot.stat
+            with open(RIDEDB, 'ab') as rides_file:
+                if snapshot.unterminated(snapshot.size):
+                    # End a last line edited by hand first.  Helper files
+                    # stamped before are built again, those stamped after
+                    # are brought up to date from the log.
+                    rides_file.write(b'\n')
+                    rides_file.flush()
+                    old_stat = os.fstat(rides_file.fileno())
+                rides_file.write(data)
+                rides_file.flush()
+                os.fsync(rides_file.fileno())
+            _log_append(old_stat, os.stat(RIDEDB), first_id + len(rows))
+        return list(range(first_id, first_id + len(rows)))
+
+    def change(self, ride_id, row):
+        """Replace the ride ``ride_id`` by ``row``, or delete it if ``row`` is
+        ``None``, by appending to the journal.  The journal is folded back
+        into the file once it holds ``COMPACT_THRESHOLD`` entries."""
+        with _write_lock():
+            with self._snapshot() as snapshot:
+                old_ride = self._get(snapshot, ride_id)
+                if old_ride is None:
+                    raise ValueError(
+                        _('no ride with index {}').format(ride_id))
+                aggregates = _load_aggregates(snapshot)
+                _journal_append(snapshot.stat, ride_id, row)
+                # No other writer can append to the journal meanwhile.
+                num_entries = snapshot.journal_entries + 1
+                if aggregates is not None:
+                    _aggregate_add(aggregates, old_ride['timestamp'],
+                                   old_ride['distance'], old_ride['duration'],
+                                   sign=-1)
+                    if row is not None:
+                        _aggregate_add(aggregates, row[0], row[1], row[2])
+                    _write_aggregates(aggregates, snapshot.stat,
+                                      _journal_size())
+            if num_entries >= COMPACT_THRESHOLD:
+                self.compact()
+
+    def rewrite(self, rides):
+        """Atomically replace the file with the content of ``rides``, sorted
+        by timestamp.  Since ``rides`` holds every ride, the journal is
+        discarded."""
+        with _phase('sort'):
+            rides.sort(key=lambda x: x['timestamp'])
+        with _phase('format'):
+            rows = [_cache_row((ride['timestamp'], ride['distance'],
+                                ride['duration'], ride['comment'],
+                                ride['url'])) for ride in rides]
+            data = b''.join(_format_row((ride['timestamp'], ride['distance'],
+                                         ride['duration'], ride['comment'],
+                                         ride['url']))
+                            for ride in rides)
+            _rows(len(rows))
+        with _write_lock():
+            with _phase('write'):
+                _atomic_write(RIDEDB, data)
+            # Entries of the journal and of the log of appends are tagged
+            # with the inode of the file they apply to, readers ignore them
+            # from now on.
+            for suffix in (JOURNAL_SUFFIX, APPENDS_SUFFIX):
+                try:
+                    os.remove(_sidecar_path(suffix))
+                except FileNotFoundError:
+                    pass
+            with _Snapshot() as snapshot, _phase('helper files'):
+                _write_cache(rows, snapshot.stat, data)
+                _build_index(snapshot)
+                _build_aggregates(rides, snapshot.stat, 0)
+
+    def year_sums(self, years):
+        """Return the number of rides, the total distance, the total duration
+        and the sum of the speeds of the rides of ``years``, from the per year
+        aggregates."""
+        with self._snapshot() as snapshot:
+            aggregates = _load_aggregates(snapshot)
+            if aggregates is None:
+                aggregates = _build_aggregates(
+                    self._read(snapshot, 'all'), snapshot.stat,
+                    snapshot.journal_size)
+        if years == 'all':
+            years = aggregates['years']
+        totals = [0, 0.0, 0.0, 0.0]
+        for year in set(years):
+            for i, value in enumerate(aggregates['years'].get(year, ())):
+                totals[i] += value
+        return totals
+
+    def compact(self):
+        """Fold the journal of edits and deletions back into the file.  The
+        rides are renumbered in chronological order."""
+        with _write_lock():
+            if os.path.exists(_sidecar_path(JOURNAL_SUFFIX)):
+                self.rewrite(self.read('all'))
+
+    def version(self):
+        """Return ``(generation, state)`` where ``state`` changes whenever the
+        rides change and ``generation`` whenever they are renumbered, that is
+        whenever the file is replaced."""
+        try:
+            stat = os.stat(RIDEDB)
+        except FileNotFoundError:
+            return None, None
+        return stat.st_ino, (_stamp(stat), _journal_size())
+
+    def files(self):
+        """Return the paths of the files holding the rides."""
+        return [RIDEDB, _sidecar_path(JOURNAL_SUFFIX)]
+
+    def follow(self, position=None):
+        """Return the rides added and edited since ``position``.
+
+        ``position`` is the one returned by a previous call.  Return
+        ``(position, rides, edits)`` where ``rides`` is the list of the rides
+        appended to the file since and ``edits`` maps the id of each ride
+        edited since to its new ``(timestamp, distance, duration, comment,
+        url)`` row, or to ``None`` if it was deleted.  Only the new lines and
+        journal entries are parsed.
+
+        If ``position`` is ``None``, or if the file was replaced or changed
+        other than by appending lines, which is told by its inode and a hash
+        of the last bytes read, every ride is read instead and ``edits`` is
+        ``None``.
+
+        """
+        if position is not None:
+            changes = self._tail(position)
+            if changes is not None:
+                return changes
+        with self._snapshot() as snapshot:
+            rides = self._read(snapshot, 'all')
+            index = self._index(snapshot)
+            stat = snapshot.stat
+            position = {'file': [stat.st_ino, stat.st_dev],
+                        'size': snapshot.size,
+                        'mtime': stat.st_mtime_ns,
+                        'check': _follow_check(snapshot.file, snapshot.size),
+                        'rides': len(index['offsets']) - 1,
+                        'journal': snapshot.journal_size}
+        return position, rides, None
+
+    @staticmethod
+    def _tail(position):
+        """Return the changes since ``position`` as :meth:`follow` does, or
+        ``None`` if every ride must be read again."""
+        # Read the journal first, its entries only refer to lines written
+        # before them.
+        inode, device = position['file']
+        edits, journal_end = _journal_tail(position['journal'], inode)
+        if edits is None:
+            return None
+        try:
+            rides_file = open(RIDEDB, 'rb')
+        except FileNotFoundError:
+            return None
+        with rides_file:
+            stat = os.fstat(rides_file.fileno())
+            size = position['size']
+            if ([stat.st_ino, stat.st_dev] != position['file'] or
+                    stat.st_size < size or
+                    (stat.st_size == size and
+                     stat.st_mtime_ns != position['mtime']) or
+                    _follow_check(rides_file, size) != position['check']):
+                return None
+            rides_file.seek(size)
+            data = rides_file.read(stat.st_size - size)
+            # Leave a line still being written for the next call.
+            data = data[:data.rfind(b'\n') + 1]
+            end = size + len(data)
+            if data.startswith(b'\n'):
+                # The newline ending a last line edited by hand, which was
+                # already read.
+                data = data[1:]
+            check = _follow_check(rides_file, end)
+        rides_reader = csv.reader(io.StringIO(data.decode('utf-8'),
+                                              newline=''),
+                                  delimiter=',', quotechar='"')
+        first_id = position['rides']
+        rides = [_make_ride(_parse_row(ride_row), id)
+                 for id, ride_row in enumerate(rides_reader, first_id)]
+        position = dict(position, size=end, mtime=stat.st_mtime_ns,
+                        check=check, rides=first_id + len(rides),
+                        journal=journal_end)
+        return position, rides, edits
+
+
+class SQLiteBackend(object):
+    """Store the rides in an SQLite database next to ``RIDEDB``.
+
+    The rides table is indexed on the timestamp and on the year, so reading
+    some years, looking up a ride by id and computing statistics are indexed
+    queries, and edits and deletions only touch a single row.
+
+    """
+
+    name = 'sqlite'
+    columns = 'id, timestamp, distance, duration, comment, url'
+
+    def _connect(self):
+        """Open the database, creating the rides table if needed."""
+        import sqlite3
+        connection = sqlite3.connect(_sidecar_path(SQLITE_SUFFIX),
+                                     timeout=60)
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS rides ('
+            'id INTEGER PRIMARY KEY, timestamp TEXT NOT NULL, '
+            'year INTEGER NOT NULL, distance REAL NOT NULL, '
+            'duration REAL NOT NULL, comment TEXT NOT NULL, '
+            'url TEXT NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS rides_timestamp '
+                           'ON rides (timestamp)')
+        connection.execute('CREATE INDEX IF NOT EXISTS rides_year '
+                           'ON rides (year, timestamp)')
+        return connection
+
+    @staticmethod
+    def _where(years):
+        """Return the ``WHERE`` clause and its parameters selecting the rides
+        of ``years``."""
+        if years == 'all':
+            return '', ()
+        if isinstance(years, range):
+            return 'WHERE year BETWEEN ? AND ?', (years.start, years.stop - 1)
+        years = sorted(set(years))
+        return ('WHERE year IN ({})'.format(', '.join('?' * len(years))),
+                tuple(years))
+
+    @staticmethod
+    def _ride(record):
+        """Build the :class:`Ride` of a database record."""
+        return _make_ride((datetime.fromisoformat(record[1]),) + record[2:],
+                          record[0])
+
+    @staticmethod
+    def _record(row):
+        """Return the values of the columns, but the id, for ``row``."""
+        return (row[0].strftime(TIMESTR), row[0].year, float(row[1]),
+                float(row[2]), row[3], row[4])
+
+    def read(self, years, sep=',', query=None):
+        """Return the rides of ``years``, or of every year if ``years`` is
+        ``'all'``, sorted by timestamp, keeping only those matching the
+        :class:`Query` ``query`` if given."""
+        return list(self.iter(years, query))
+
+    def get(self, ride_id):
+        """Return the ride with id ``ride_id`` or ``None`` if there is no such
+        ride."""
+        with closing(self._connect()) as connection:
+            record = connection.execute(
+                'SELECT {} FROM rides WHERE id = ?'.format(self.columns),
+                (ride_id,)).fetchone()
+        return self._ride(record) if record is not None else None
+
+    def get_many(self, ride_ids):
+        """Return the rides with the ids ``ride_ids``, sorted by timestamp."""
+        rides = []
+        ride_ids = list(ride_ids)
+        with closing(self._connect()) as connection:
+            # Stay below the limit on the number of parameters of a query.
+            for i in range(0, len(ride_ids), 500):
+                chunk = ride_ids[i:i + 500]
+                rides.extend(self._ride(record) for record in
+                             connection.execute(
+                                 'SELECT {} FROM rides WHERE id IN ({})'
+                                 .format(self.columns,
+                                         ', '.join('?' * len(chunk))),
+                                 chunk))
+        rides.sort(key=lambda ride: (ride.epoch, ride.id))
+        return rides
+
+    def iter(self, years, query=None):
+        """Yield the rides of ``years`` matching the :class:`Query` ``query``,
+        if given, in chronological order.  ``query`` is checked on the
+        records, before their timestamp is parsed."""
+        where, params = self._where(years)
+        match_line = query.match_line if query is not None else None
+        with closing(self._connect()) as connection:
+            for record in connection.execute(
+                    'SELECT {} FROM rides {} ORDER BY timestamp, id'.format(
+                        self.columns, where), params):
+                if match_line is None or match_line(record[1:]):
+                    yield self._ride(record)
+
+    def add(self, rows, merge=False):
+        """Add the ``(timestamp, distance, duration, comment, url)``
+        ``rows`` in a single transaction and return the list of their
+        ids."""
+        with closing(self._connect()) as connection, connection:
+            return [connection.execute(
+                        'INSERT INTO rides (timestamp, year, distance, '
+                        'duration, comment, url) VALUES (?, ?, ?, ?, ?, ?)',
+                        self._record(row)).lastrowid
+                    for row in rows]
+
+    def change(self, ride_id, row):
+        """Replace the ride ``ride_id`` by ``row``, or delete it if ``row`` is
+        ``None``."""
+        with closing(self._connect()) as connection, connection:
+            if row is None:
+                cursor = connection.execute('DELETE FROM rides WHERE id = ?',
+                                            (ride_id,))
+            else:
+                cursor = connection.execute(
+                    'UPDATE rides SET timestamp = ?, year = ?, distance = ?, '
+                    'duration = ?, comment = ?, url = ? WHERE id = ?',
+                    self._record(row) + (ride_id,))
+        if cursor.rowcount == 0:
+            raise ValueError(_('no ride with index {}').format(ride_id))
+
+    def rewrite(self, rides):
+        """Replace the content of the database with ``rides``, numbered in
+        chronological order."""
+        rides.sort(key=lambda x: x['timestamp'])
+        with closing(self._connect()) as connection, connection:
+            generation = connection.execute('PRAGMA user_version').fetchone()[0]
+            connection.execute('PRAGMA user_version = {:d}'.format(
+                generation + 1))
+            connection.execute('DELETE FROM rides')
+            connection.executemany(
+                'INSERT INTO rides (id, timestamp, year, distance, duration, '
+                'comment, url) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((id,) + self._record((ride['timestamp'], ride['distance'],
+                                       ride['duration'], ride['comment'],
+                                       ride['url']))
+                 for id, ride in enumerate(rides)))
+
+    def year_sums(self, years):
+        """Return the number of rides, the total distance, the total duration
+        and the sum of the speeds of the rides of ``years``."""
+        where, params = self._where(years)
+        with closing(self._connect()) as connection:
+            return list(connection.execute(
+                'SELECT COUNT(*), TOTAL(distance), TOTAL(duration), '
+                'TOTAL(CASE WHEN duration != 0 THEN distance / duration '
+                'ELSE 0 END) FROM rides {}'.format(where), params).fetchone())
+
+    def compact(self):
+        """Reclaim the space left by deleted rides."""
+        with closing(self._connect()) as connection:
+            connection.execute('VACUUM')
+
+    def version(self):
+        """Return ``(generation, state)`` where ``state`` changes whenever the
+        rides change and ``generation`` whenever they are renumbered, which
+        :meth:`rewrite` records in the ``user_version`` of the database."""
+        with closing(self._connect()) as connection:
+            generation = connection.execute('PRAGMA user_version').fetchone()[0]
+        return generation, _stamp(os.stat(_sidecar_path(SQLITE_SUFFIX)))
+
+    def files(self):
+        """Return the paths of the files holding the rides."""
+        return [_sidecar_path(SQLITE_SUFFIX)]
+
+    def follow(self, position=None):
+        """Return ``(position, rides, edits)`` as :meth:`CSVBackend.follow`
+        does.  Which rows changed is not recorded, so every ride is read
+        again whenever the database changed since ``position``."""
+        version = self.version()
+        if position is not None and position == version:
+            return position, [], {}
+        return version, self.read('all'), None
+
+
+BACKENDS = {CSVBackend.name: CSVBackend, SQLiteBackend.name: SQLiteBackend}
+
+
+def get_backend(name=None):
+    """Return the storage backend called ``name``, by default the one selected
+    by ``BACKEND``."""
+    name = name or BACKEND
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise ValueError(_('unknown storage backend {}').format(name))
+
+
+class _SearchChanges(object):
+    """Changes to the :class:`SearchIndex`, recorded through the same
+    :meth:`add` and :meth:`remove` methods."""
+
+    def __init__(self):
+        self.changes = []
+
+    def add(self, ride_id, comment, url):
+        self.changes.append((True, ride_id, comment, url))
+
+    def remove(self, ride_id, comment, url):
+        self.changes.append((False, ride_id, comment, url))
+
+
+def _read_search_log():
+    """Return the entries of the log of changes to the search index, each
+    ``(before, after, changes)`` where ``changes`` turned the rides at version
+    ``before`` into those at version ``after``.  An entry cut short by a
+    crash ends the log."""
+    entries = []
+    try:
+        with open(_sidecar_path(SEARCH_LOG_SUFFIX), 'rb') as log_file:
+            while True:
+                entries.append(pickle.load(log_file))
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError,
+            IndexError):
+        pass
+    return entries
+
+
+@contextmanager
+def _updating_search_index():
+    """Hold the write lock and yield an object with the ``add`` and
+    ``remove`` methods of :class:`SearchIndex`, or ``None`` if no index is
+    stored, for the body of the ``with`` statement to change the rides and
+    the index alike.  The changes are then appended to the log of the index,
+    unless the rides were renumbered, so that neither the index nor the log
+    is read."""
+    with _write_lock():
+        if not os.path.exists(_sidecar_path(SEARCH_SUFFIX)):
+            yield None
+            return
+        before = db_version()
+        changes = _SearchChanges()
+        yield changes
+        after = db_version()
+        if after[0] == before[0]:
+            try:
+                with open(_sidecar_path(SEARCH_LOG_SUFFIX), 'ab') as log_file:
+                    log_file.write(pickle.dumps(
+                        (before, after, changes.changes),
+                        protocol=pickle.HIGHEST_PROTOCOL))
+            except OSError:
+                pass
+
+
 def add_ride(timestamp, distance, duration, comment='', url=''):
-    """Add a ride to the database."""
-    with open(RIDEDB, 'a', newline='\n', encoding='utf-8') as rides_file:
-        rides_writer = csv.writer(rides_file, delimiter=',', quotechar='"',
-                                  quoting=csv.QUOTE_MINIMAL)
-        rides_writer.writerow(
-            [timestamp.strftime(TIMESTR),
-             str(distance), str(duration), comment, url])
+    """Add a ride to the database and return its id."""
+    row = _validate_ride(timestamp, distance, duration, comment, url)
+    with _updating_search_index() as index:
+        ride_id = get_backend().add([row])[0]
+        if index is not None:
+            index.add(ride_id, row[3], row[4])
+    return ride_id
+
+
+def add_rides(rides):
+    """Add many rides to the database at once.
+
+    ``rides`` is an iterable of ``(timestamp, distance, duration, comment,
+    url)`` sequences, where the comment and the URL are optional.  Fields may
+    be strings, in which case the timestamp must follow ``TIMESTR`` and the
+    duration may use any format accepted by :func:`parse_duration`.  Every
+    ride is validated before anything is written.
+
+    With the CSV backend, when all the rides are more recent than the last
+    ride of the database, they are appended with a single write.  Otherwise,
+    they are merged with the existing rides and the database is rewritten
+    once.  Return the number of rides added.
+
+    """
+    rows = [_validate_ride(*ride) for ride in rides]
+    if not rows:
+        return 0
+    rows.sort(key=lambda row: row[0])
+    with _updating_search_index() as index:
+        ids = get_backend().add(rows, merge=True)
+        # Unless every ride was renumbered.
+        if index is not None and ids is not None:
+            for ride_id, row in zip(ids, rows):
+                index.add(ride_id, row[3], row[4])
+    return len(rows)
+
+
+@profiled
+def read_db_file(sep=',', year=False, query=None):
+    """Read ride data file and return the rides as a list of :class:`Ride`.  By
+    default, return only rides for the current year.  If ``year`` is set to a
+    single year or a list of years, return rides for the specified years.  If
+    ``query`` is given, a :class:`Query`, only the matching rides are returned
+    and only the years they can be of are read.
+
+    """
+    years = _normalize_years(year)
+    if query is not None:
+        years = query.restrict(years)
+    rides = get_backend().read(years, sep, query)
+    _rows(len(rides))
+    return rides
+
+
+def get_ride(ride_id):
+    """Return the ride with id ``ride_id`` or ``None`` if there is no such
+    ride."""
+    return get_backend().get(ride_id)
+
+
+def get_rides(ride_ids):
+    """Return the rides with the sorted ids ``ride_ids``, sorted by timestamp.
+    Ids of rides that do not exist are ignored."""
+    return get_backend().get_many(ride_ids)
+
+
+def search_index(rides=None, version=None):
+    """Return the :class:`SearchIndex` of the rides.  The stored index is used
+    if it is up to date, otherwise it is built, from ``rides`` if given,
+    which must then hold every ride of the database at ``version``, and
+    stored.  The log of changes is folded into the stored index once it
+    holds ``COMPACT_THRESHOLD`` changes.
+
+    The index is only stored if the database is still at ``version`` once
+    the write lock is held, since storing it clears the log, where the
+    changes of the writers that came in between are.
+
+    """
+    if version is None:
+        version = db_version()
+    index = SearchIndex.load(version)
+    if index is None:
+        if rides is None:
+            rides = iter_rides('all')
+        index = SearchIndex.build(rides, version)
+    elif index.pending < COMPACT_THRESHOLD:
+        return index
+    # Store the index built, or fold the log into the stored index once it
+    # grows large.
+    with _write_lock():
+        if db_version() == index.version:
+            index.save()
+    return index
+
+
+@profiled
+def search_rides(text):
+    """Return the sorted ids of the rides whose comment or URL has, for each
+    word of ``text``, a word starting with it, ignoring case and accents."""
+    return search_index().search(text)
+
+
+def iter_rides(years='all', predicate=None, query=None):
+    """Yield the rides of the given ``years``, in chronological order, one at
+    a time.  ``years`` is interpreted as the ``year`` argument of
+    :func:`read_db_file`.  If ``predicate`` is given, only the rides for which
+    it returns true are yielded.  Unlike ``predicate``, the :class:`Query`
+    ``query`` is checked by the backend before the rides are built.
+
+    Whenever possible, rides are read lazily so that memory use does not
+    depend on the size of the database.
+
+    """
+    years = _normalize_years(years)
+    if query is not None:
+        years = query.restrict(years)
+    for ride in get_backend().iter(years, query):
+        if predicate is None or predicate(ride):
+            yield ride
+
+
+@profiled
+def update_db(rides):
+    """Rewrite the database file with the content of rides.  Since the rides
+    are renumbered, the search index, if any, is built again from
+    ``rides``."""
+    with _write_lock():
+        get_backend().rewrite(rides)
+        if os.path.exists(_sidecar_path(SEARCH_SUFFIX)):
+            SearchIndex.build(rides, db_version(), itertools.count()).save()
+
+
+def update_ride(ride_id, timestamp, distance, duration, comment='', url=''):
+    """Replace the ride with id ``ride_id``.
+
+    Only the changed ride is written, so the cost does not depend on the size
+    of the database.
+
+    """
+    row = _validate_ride(timestamp, distance, duration, comment, url)
+    with _updating_search_index() as index:
+        old = get_ride(ride_id) if index is not None else None
+        get_backend().change(ride_id, row)
+        if old is not None:
+            index.remove(ride_id, old['comment'], old['url'])
+            index.add(ride_id, row[3], row[4])
+
+
+def delete_ride(ride_id):
+    """Delete the ride with id ``ride_id``.
+
+    Only the deletion is written, so the cost does not depend on the size of
+    the database.
+
+    """
+    with _updating_search_index() as index:
+        old = get_ride(ride_id) if index is not None else None
+        get_backend().change(ride_id, None)
+        if old is not None:
+            index.remove(ride_id, old['comment'], old['url'])
+
+
+def compact(args=None):
+    """Fold pending edits and deletions into the database."""
+    get_backend().compact()
+
+
+def db_version():
+    """Return ``(generation, state)`` where ``state`` changes whenever the
+    rides change and ``generation`` whenever their ids change.  Programs that
+    keep rides in memory can compare it with the value they last saw to tell
+    whether the database was changed by another program."""
+    return get_backend().version()
+
+
+def db_files():
+    """Return the paths of the files holding the rides, which change whenever
+    the rides do."""
+    return get_backend().files()
+
+
+def follow_rides(position=None):
+    """Return ``(position, rides, edits)``, the rides added and the rides
+    edited since ``position``, or every ride if ``position`` is ``None`` or
+    the database was rewritten, in which case ``edits`` is ``None``.  Pass
+    the returned ``position`` to the next call to follow the database as it
+    changes.  See :meth:`CSVBackend.follow`."""
+    return get_backend().follow(position)
+
+
+@profiled
+def get_year_stats(year=False):
+    """Compute summary statistics for the rides of the given years, as
+    :func:`get_stats` would, but without reading every ride when the backend
+    keeps per year totals."""
+    return summarize(*get_backend().year_sums(_normalize_years(year)))
 
 
 def add_ride_interactive(args):
@@ -145,6 +2695,9 @@ def add_ride_interactive(args):
     optional comment.
 
     """
+    if args.batch:
+        add_rides_batch(args)
+        return
     timestamp = datetime.now()
     distance = float(input(_("Enter distance: ")))
     duration = parse_duration(input(_("Enter duration: ")))
@@ -153,128 +2706,647 @@ def add_ride_interactive(args):
     add_ride(timestamp, distance, duration, comment, url)
 
 
-def read_wahoo_csv(args):
-    """Get a ride information from a Wahoo csv file and add it to the
-    database.
+def add_rides_batch(args):
+    """Add the rides listed in the CSV file ``args.batch``, or on the standard
+    input if it is ``-``, to the database.
+
+    Each line holds the timestamp, the distance, the duration and optionally a
+    comment and a URL, as in the database file, except that the duration may
+    use any format accepted by :func:`parse_duration`.
+
+    """
+    if args.batch == '-':
+        rows = list(csv.reader(sys.stdin, delimiter=',', quotechar='"'))
+    else:
+        with open(args.batch, encoding='utf-8', newline='') as batch_file:
+            rows = list(csv.reader(batch_file, delimiter=',', quotechar='"'))
+    rides = []
+    for line_num, row in enumerate(rows, 1):
+        if not row:
+            continue
+        try:
+            rides.append(_validate_ride(*row))
+        except (TypeError, ValueError) as e:
+            raise ValueError(_('line {}: {}').format(line_num, e))
+    print(_('Added {} rides').format(add_rides(rides)))
+
+
+def parse_wahoo_csv(filename):
+    """Read a Wahoo CSV file and return the ``(timestamp, distance,
+    duration)`` of the ride it holds.
+
+    The file is streamed and only the ``Timestamp``, ``WorkoutActive`` and
+    ``TotalDistance`` columns of the first and last active samples are kept,
+    so memory use does not depend on the length of the ride.  The timestamp is
+    the (UTC) time of the last active sample.  Files that cannot be read or
+    are cut short raise ``ValueError`` too.
 
     """
     try:
-        import pandas as pd
-    except ImportError as e:
-        print(_("Pandas must be installed to be able to import Wahoo "
-                "CSV files."))
-        return
+        with open(filename, encoding='utf-8', newline='') as wahoo_file:
+            wahoo_reader = csv.reader(wahoo_file)
+            header = next(wahoo_reader, [])
+            try:
+                time_col = header.index('Timestamp')
+                active_col = header.index('WorkoutActive')
+                distance_col = header.index('TotalDistance')
+            except ValueError:
+                raise ValueError(
+                    _('{} is not a Wahoo CSV file').format(filename))
+            first = last = None
+            try:
+                for row in wahoo_reader:
+                    if row[active_col].strip().lower() not in ('true', '1'):
+                        continue
+                    sample = (row[time_col], row[distance_col])
+                    if first is None:
+                        first = sample
+                    last = sample
+            except IndexError:
+                raise ValueError(_('line {} of {} is truncated').format(
+                    wahoo_reader.line_num, filename))
+    except (OSError, csv.Error) as e:
+        raise ValueError(_('cannot read {}: {}').format(
+            filename, getattr(e, 'strerror', None) or e))
+    if first is None:
+        raise ValueError(_('no active samples in {}').format(filename))
+    start = float(first[0]) / KILO
+    end = float(last[0]) / KILO
+    timestamp = datetime.fromtimestamp(end, timezone.utc).replace(tzinfo=None)
+    duration = (end - start) / SECONDS_PER_HOUR
+    distance = (float(last[1]) - float(first[1])) / KILO
+    return timestamp, distance, duration
+
+
+def _timed_parse_wahoo_csv(filename):
+    """Parse a Wahoo CSV file in a worker process.
+
+    Return ``(filename, ride, error, elapsed, size)`` where ``ride`` is the
+    result of :func:`parse_wahoo_csv`, or ``None`` if the file could not be
+    parsed, in which case ``error`` holds the reason.
 
-    ride_info = pd.read_csv(args.filename)
-    ride_info = ride_info[ride_info['WorkoutActive'] == True].iloc[[0, -1]]
-    ride_info['Timestamp'] = pd.to_datetime(ride_info['Timestamp'], unit='ms')
-    begining = ride_info.iloc[0]
-    end = ride_info.iloc[-1]
-    duration = (end['Timestamp'] -
-                begining['Timestamp']).seconds / SECONDS_PER_HOUR
-    distance = (end['TotalDistance'] - begining['TotalDistance']) / KILO
-    timestamp = end['Timestamp'].to_datetime()
-    if args.comment:
-        comment = ' '.join(args.comment)
-    else:
-        comment = 'Imported from Wahoo'
-    add_ride(timestamp, distance, duration, comment)
+    """
+    start = time.perf_counter()
+    ride = error = None
+    size = 0
+    try:
+        # The file may vanish before it is parsed.
+        size = os.path.getsize(filename)
+        ride = parse_wahoo_csv(filename)
+    except (OSError, ValueError) as e:
+        error = str(e) or e.__class__.__name__
+    return filename, ride, error, time.perf_counter() - start, size
 
 
-def read_db_file(sep=',', year=False):
-    """Read ride data file and store information in a list of dictionaries.  By
-    default, return only rides for the current year.  If ``year`` is set to a
-    single year or a list of years, return rides for the specified years.
+def _ride_fingerprint(timestamp, distance, duration):
+    """Return a key identifying a ride regardless of floating point noise, used
+    to detect rides that were already imported."""
+    return (timestamp.strftime(TIMESTR), round(distance, 3),
+            round(duration, 4))
+
+
+def import_wahoo_dir(dirname, comment):
+    """Import every Wahoo CSV file of ``dirname`` into the database.
+
+    The files are parsed concurrently in a process pool.  Rides that are
+    already in the database, or that appear more than once in the directory,
+    are skipped.  The new rides are then added with a single write.  Return
+    the list of ``(filename, ride, error, elapsed, size)`` results, with
+    ``error`` set to the translation of ``'duplicate'`` for skipped rides, and
+    the number of rides added.
 
     """
-    rides = []
-    if not year:
-        years = [datetime.now().year]
-    elif year == 'all':
-        years = 'all'
-    elif not hasattr(year, '__contains__'):
-        years = [year]
+    import concurrent.futures
+    filenames = sorted(os.path.join(dirname, name)
+                       for name in os.listdir(dirname)
+                       if name.lower().endswith('.csv'))
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        results = list(executor.map(_timed_parse_wahoo_csv, filenames))
+
+    seen = set(_ride_fingerprint(ride['timestamp'], ride['distance'],
+                                 ride['duration'])
+               for ride in read_db_file(year='all'))
+    new_rides = []
+    for i, (filename, ride, error, elapsed, size) in enumerate(results):
+        if ride is None:
+            continue
+        fingerprint = _ride_fingerprint(*ride)
+        if fingerprint in seen:
+            results[i] = (filename, ride, _('duplicate'), elapsed, size)
+            continue
+        seen.add(fingerprint)
+        new_rides.append(ride + (comment, ''))
+    return results, add_rides(new_rides)
+
+
+def read_wahoo_csv(args):
+    """Get a ride information from a Wahoo csv file and add it to the
+    database.
+
+    With ``--dir``, import every Wahoo csv file of a directory and report how
+    long each one took to parse.
+
+    """
+    words = list(args.comment)
+    if args.dir and args.filename:
+        # No file name is given with --dir, the first word of the comment was
+        # taken for one.
+        words.insert(0, args.filename)
+    if words:
+        comment = ' '.join(words)
     else:
-        years = year
+        comment = 'Imported from Wahoo'
+    if args.dir:
+        start = time.perf_counter()
+        results, num_added = import_wahoo_dir(args.dir, comment)
+        elapsed = time.perf_counter() - start
+        for filename, ride, error, file_elapsed, size in results:
+            status = error if error else _('imported')
+            print('{:40s}  {:8.1f} ms  {:8.1f} MB/s  {}'.format(
+                os.path.basename(filename), file_elapsed * KILO,
+                size / file_elapsed / KILO ** 2 if file_elapsed else 0,
+                status))
+        print(_('Added {} rides from {} files in {:.2f} s '
+                '({:.1f} files/s)').format(
+                    num_added, len(results), elapsed,
+                    len(results) / elapsed if elapsed else 0))
+        return
+    if not args.filename:
+        raise ValueError(_('a file name or --dir is required'))
+    timestamp, distance, duration = parse_wahoo_csv(args.filename)
+    add_ride(timestamp, distance, duration, comment)
 
+
+def _import_numpy():
+    """Return the numpy module, or ``None`` if it is not installed."""
     try:
-        with open(RIDEDB, encoding='utf-8') as rides_file:
-            rides_reader = csv.reader(rides_file, delimiter=sep, quotechar='"')
-            for id, ride_row in enumerate(rides_reader):
-                ride = {'timestamp': datetime.strptime(ride_row[0], TIMESTR),
-                        'distance': float(ride_row[1]),
-                        'duration': float(ride_row[2]),
-                        'comment': ride_row[3],
-                        'url': ride_row[4],
-                        'id': id}
-                if years != 'all':
-                    if ride['timestamp'].year in years:
-                        rides.append(ride)
-                else:
-                    rides.append(ride)
-        rides.sort(key=lambda x: x['timestamp'])
-    except FileNotFoundError:
-        open(RIDEDB, 'w', encoding='utf-8').close()
-    return rides
+        import numpy
+    except ImportError:
+        return None
+    return numpy
 
 
-def update_db(rides):
-    """Rewrite the database file with the content of rides."""
-    rides.sort(key=lambda x: x['timestamp'])
-    with open(RIDEDB, 'w', newline='\n', encoding='utf-8') as rides_file:
-        rides_writer = csv.writer(rides_file, delimiter=',', quotechar='"',
-                                  quoting=csv.QUOTE_MINIMAL)
-        for ride in rides:
-            rides_writer.writerow(
-                [ride['timestamp'].strftime(TIMESTR),
-                 str(ride['distance']), str(ride['duration']), ride['comment'],
-                 ride['url']])
+def rides_columns(rides):
+    """Return the rides as a dictionary of columns.
 
+    The ``timestamp``, ``distance``, ``duration`` and ``speed`` columns are
+    numpy arrays when numpy is available and plain lists otherwise.  The speed
+    of a ride with a zero duration is ``nan``.
 
-def get_stats(rides):
-    """Compute summary statistics for the rides."""
-    tot_distance = 0.0
-    tot_duration = 0.0
-    tot_speed = 0.0
+    """
+    np = _import_numpy()
+    if np is None:
+        distance = [ride.distance for ride in rides]
+        duration = [ride.duration for ride in rides]
+        return {'timestamp': [ride.timestamp for ride in rides],
+                'distance': distance,
+                'duration': duration,
+                'speed': [dist / dur if dur != 0 else float('nan')
+                          for dist, dur in zip(distance, duration)]}
     num_rides = len(rides)
-    for ride in rides:
-        tot_distance += ride['distance']
-        tot_duration += ride['duration']
-        if tot_duration != 0:
-            tot_speed += ride['distance'] / ride['duration']
+    distance = np.fromiter((ride.distance for ride in rides), float,
+                           num_rides)
+    duration = np.fromiter((ride.duration for ride in rides), float,
+                           num_rides)
+    # The epochs of the rides are already what numpy stores, no datetime is
+    # built.
+    timestamp = np.fromiter((ride.epoch for ride in rides), np.int64,
+                            num_rides).astype('datetime64[s]')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(duration != 0, distance / duration, np.nan)
+    return {'timestamp': timestamp,
+            'distance': distance,
+            'duration': duration,
+            'speed': speed}
+
+
+def summarize(num_rides, tot_distance, tot_duration, tot_speed):
+    """Build the statistics dictionary, as returned by :func:`get_stats`, from
+    the number of rides and the sums of their distances, durations and
+    speeds."""
+    num_rides = int(num_rides)
     mean_distance = tot_distance / num_rides if num_rides > 0 else 0
     mean_duration = tot_duration / num_rides if num_rides > 0 else 0
     speed = tot_speed / num_rides if num_rides > 0 else 0
-    stats = {'mean_distance': mean_distance,
-             'mean_duration': mean_duration,
-             'speed': speed,
-             'tot_distance': tot_distance,
-             'tot_duration': tot_duration}
+    stats = {'num_rides': num_rides,
+             'mean_distance': float(mean_distance),
+             'mean_duration': float(mean_duration),
+             'speed': float(speed),
+             'tot_distance': float(tot_distance),
+             'tot_duration': float(tot_duration)}
     return stats
 
 
+@profiled
+def get_stats(rides):
+    """Compute summary statistics for the rides."""
+    np = _import_numpy()
+    if np is None:
+        tot_distance = 0.0
+        tot_duration = 0.0
+        tot_speed = 0.0
+        for ride in rides:
+            tot_distance += ride.distance
+            tot_duration += ride.duration
+            if ride.duration != 0:
+                tot_speed += ride.distance / ride.duration
+        return summarize(len(rides), tot_distance, tot_duration, tot_speed)
+    columns = rides_columns(rides)
+    return summarize(len(rides), columns['distance'].sum(),
+                      columns['duration'].sum(),
+                      np.nansum(columns['speed']))
+
+
+def _period_label(date, by):
+    """Return the label of the ``by`` period (week, month or year) that
+    contains ``date``."""
+    if by == 'year':
+        return '{:04d}'.format(date.year)
+    elif by == 'month':
+        return '{:04d}-{:02d}'.format(date.year, date.month)
+    iso_year, iso_week = date.isocalendar()[:2]
+    return '{:04d}-W{:02d}'.format(iso_year, iso_week)
+
+
+@profiled
+def group_stats(rides, by='month'):
+    """Compute summary statistics for each week, month or year covered by the
+    rides, in a single pass.
+
+    Return a list of ``(period, stats)`` pairs sorted by period, where
+    ``period`` is a label such as ``2021-W07``, ``2021-02`` or ``2021``, and
+    ``stats`` is a dictionary as returned by :func:`get_stats`.
+
+    """
+    if by not in PERIODS:
+        raise ValueError('Invalid period: {}'.format(by))
+    np = _import_numpy()
+    if np is None:
+        sums = {}
+        for ride in rides:
+            period = _period_label(ride.timestamp, by)
+            period_sums = sums.setdefault(period, [0, 0.0, 0.0, 0.0])
+            period_sums[0] += 1
+            period_sums[1] += ride.distance
+            period_sums[2] += ride.duration
+            if ride.duration != 0:
+                period_sums[3] += ride.distance / ride.duration
+        return [(period, summarize(*period_sums))
+                for period, period_sums in sorted(sums.items())]
+
+    columns = rides_columns(rides)
+    days = columns['timestamp'].astype('datetime64[D]')
+    if by == 'year':
+        keys = days.astype('datetime64[Y]')
+    elif by == 'month':
+        keys = days.astype('datetime64[M]')
+    else:
+        # Day 0 of the epoch is a Thursday, bring each day back to the Monday
+        # that starts its ISO week.
+        weekday = (days.astype(np.int64) + 3) % 7
+        keys = days - weekday.astype('timedelta64[D]')
+    periods, inverse = np.unique(keys, return_inverse=True)
+    size = len(periods)
+    counts = np.bincount(inverse, minlength=size)
+    tot_distance = np.bincount(inverse, weights=columns['distance'],
+                               minlength=size)
+    tot_duration = np.bincount(inverse, weights=columns['duration'],
+                               minlength=size)
+    tot_speed = np.bincount(inverse, weights=np.nan_to_num(columns['speed']),
+                            minlength=size)
+    return [(_period_label(period.astype('datetime64[D]').item(), by),
+             summarize(counts[i], tot_distance[i], tot_duration[i],
+                        tot_speed[i]))
+            for i, period in enumerate(periods)]
+
+
+def _streaks(active):
+    """Return the longest and the last runs of consecutive true values of
+    ``active``, as ``(length, index of the first value)`` pairs."""
+    longest = last = (0, None)
+    run = 0
+    for index, value in enumerate(active):
+        if value:
+            run += 1
+            last = (run, index - run + 1)
+            if run > longest[0]:
+                longest = last
+        else:
+            run = 0
+    return longest, last
+
+
+@profiled
+def rolling_stats(rides, windows=ROLLING_WINDOWS, distances=RECORD_DISTANCES,
+                  end=None, years=None):
+    """Compute rolling totals, streaks and records of the chronologically
+    sorted ``rides``.
+
+    The distances and durations are summed per day, from the day of the first
+    ride to ``end``, by default the day of the last ride, in a single pass
+    over the rides that also finds the records.  The total of a window is
+    then the difference of two running sums, so that the cost does not depend
+    on the length of the windows.
+
+    If ``years`` is given, the best windows, the streaks and the records are
+    only looked for in the days and the rides of ``years``, of which there
+    must be at least one, the other rides only count in the totals of the
+    windows holding them.
+
+    Return ``None`` if there are no rides, and otherwise a dictionary holding:
+
+    ``days``
+        the list of those days;
+    ``distance`` and ``duration``
+        for each length in days of ``windows``, the list of the total
+        distance and duration of the rides of the window of that length that
+        ends on each day;
+    ``best``
+        for each length of ``windows``, the ``(distance, last day)`` of the
+        window with the longest total distance;
+    ``longest_streak`` and ``last_streak``
+        the ``(number of days, first day)`` of the longest run of consecutive
+        days with rides and of the last one;
+    ``longest_ride`` and ``longest_duration``
+        the rides with the longest distance and duration;
+    ``fastest``
+        for each distance in km of ``distances``, the ride at least that long
+        with the highest average speed, or ``None``.
+
+    """
+    if not rides:
+        return None
+    first = rides[0].timestamp.toordinal()
+    last = rides[-1].timestamp.toordinal()
+    if end is not None:
+        last = max(last, end.toordinal())
+    num_days = last - first + 1
+    dates = [date.fromordinal(first + day) for day in range(num_days)]
+    if years is None:
+        in_years = [True] * num_days
+    else:
+        in_years = [day.year in years for day in dates]
+    np = _import_numpy()
+    if np is None:
+        day_distance = [0.0] * num_days
+        day_duration = [0.0] * num_days
+        active = [False] * num_days
+        longest_ride = longest_duration = None
+        fastest = dict.fromkeys(distances)
+        best_speeds = dict.fromkeys(distances, -1.0)
+        # Days are counted from the epoch rather than by building datetimes.
+        first_day = first - _EPOCH.toordinal()
+        for ride in rides:
+            day = ride.epoch // 86400 - first_day
+            distance, duration = ride.distance, ride.duration
+            day_distance[day] += distance
+            day_duration[day] += duration
+            if not in_years[day]:
+                continue
+            active[day] = True
+            if longest_ride is None or distance > longest_ride.distance:
+                longest_ride = ride
+            if (longest_duration is None or
+                    duration > longest_duration.duration):
+                longest_duration = ride
+            if duration != 0:
+                speed = distance / duration
+                for min_distance in distances:
+                    if (distance >= min_distance and
+                            speed > best_speeds[min_distance]):
+                        best_speeds[min_distance] = speed
+                        fastest[min_distance] = ride
+
+        def rolling(values, window):
+            sums = [0.0] + list(itertools.accumulate(values))
+            return [sums[day + 1] - sums[max(0, day + 1 - window)]
+                    for day in range(num_days)]
+    else:
+        columns = rides_columns(rides)
+        days = columns['timestamp'].astype('datetime64[D]').astype(np.int64)
+        days -= days[0]
+        day_distance = np.bincount(days, weights=columns['distance'],
+                                   minlength=num_days)
+        day_duration = np.bincount(days, weights=columns['duration'],
+                                   minlength=num_days)
+        shown = np.array(in_years)[days]
+        active = (np.bincount(days, weights=shown, minlength=num_days) >
+                  0).tolist()
+        # Rides of other years are never records.
+        longest_ride = rides[int(np.argmax(
+            np.where(shown, columns['distance'], -1.0)))]
+        longest_duration = rides[int(np.argmax(
+            np.where(shown, columns['duration'], -1.0)))]
+        speeds = np.where(shown, np.nan_to_num(columns['speed'], nan=-1.0),
+                          -1.0)
+        fastest = {}
+        for min_distance in distances:
+            candidates = np.where(columns['distance'] >= min_distance, speeds,
+                                  -1.0)
+            index = int(np.argmax(candidates))
+            fastest[min_distance] = (rides[index] if candidates[index] >= 0
+                                     else None)
+
+        def rolling(values, window):
+            sums = np.concatenate(([0.0], np.cumsum(values)))
+            ends = np.arange(1, num_days + 1)
+            return sums[ends] - sums[np.maximum(0, ends - window)]
+
+    shown_days = [day for day in range(num_days) if in_years[day]]
+    trends = {'days': dates, 'distance': {}, 'duration': {}, 'best': {},
+              'longest_ride': longest_ride,
+              'longest_duration': longest_duration, 'fastest': fastest}
+    for window in windows:
+        distance = rolling(day_distance, window)
+        best = max(shown_days, key=distance.__getitem__)
+        trends['best'][window] = (float(distance[best]), dates[best])
+        trends['distance'][window] = list(distance)
+        trends['duration'][window] = list(rolling(day_duration, window))
+    for name, streak in zip(('longest_streak', 'last_streak'),
+                            _streaks(active)):
+        trends[name] = (streak[0], dates[streak[1]])
+    return trends
+
+
+def _print_no_rides(year, query=None):
+    """Tell the user that there are no rides for ``year``, or none matching
+    ``query``."""
+    if query is not None:
+        print(_("No rides match: ") + query.expression)
+        return
+    years = _normalize_years(year)
+    if years == 'all':
+        print(_("No rides"))
+        return
+    print(_("No rides for year(s): ") + ', '.join(map(str, years)))
+
+
+def _args_query(args):
+    """Return the years and the :class:`Query` given by the command line
+    ``args``.  When a query is given but no year, every year is searched."""
+    if not getattr(args, 'query', None):
+        return args.year, None
+    return (args.year if isinstance(args.year, list) else 'all',
+            Query(args.query))
+
+
+def _args_rides(args):
+    """Return the years, the :class:`Query` and an iterator over the rides
+    given by the command line ``args``.
+
+    Rides are streamed from the database, unless there is a query.  The
+    matching rides are then read at once with :func:`read_db_file`, which
+    checks the query on the cache, rather than on each line parsed.
+
+    """
+    years, query = _args_query(args)
+    if query is None:
+        rides = iter_rides(years)
+    else:
+        rides = iter(read_db_file(year=years, query=query))
+    return years, query, _iterate('read', rides)
+
+
 def print_stats(args):
     """Print statistics about the rides."""
-    rides = read_db_file(year=args.year)
-    if len(rides) == 0:
-        print(_("No rides for year(s): ") + ', '.join(map(str, args.year)))
+    years, query = _args_query(args)
+    if getattr(args, 'by', None):
+        rides = read_db_file(year=years, query=query)
+        if len(rides) == 0:
+            _print_no_rides(years, query)
+            return
+        print_group_stats(group_stats(rides, args.by))
+        return
+    if query is None:
+        stats = get_year_stats(years)
+    else:
+        stats = get_stats(read_db_file(year=years, query=query))
+    if stats['num_rides'] == 0:
+        _print_no_rides(years, query)
         return
-    stats = get_stats(rides)
     print(_("Distance:      %8.2f km") % stats['tot_distance'])
     print(_("Duration:      %8.2f h") % stats['tot_duration'])
     print(_("Average speed: %8.2f km/h") % stats['speed'])
 
 
+def print_trends(args):
+    """Print the rolling totals of the rides as of today, or as of the last
+    ride if it is not of one of the years asked for, the best windows, the
+    streaks and the records.
+
+    The windows ending early in a year also hold the rides of the end of the
+    year before, which are read as well, but only count in their totals.
+
+    """
+    years = _normalize_years(args.year)
+    if years == 'all':
+        rides = shown = read_db_file(year='all')
+    else:
+        lookback = timedelta(max(ROLLING_WINDOWS) - 1)
+        rides = read_db_file(year=sorted(
+            {year for asked in years
+             for year in range((date(asked, 1, 1) - lookback).year,
+                               asked + 1)}))
+        shown = [ride for ride in rides if ride.year in years]
+    if len(shown) == 0:
+        _print_no_rides(args.year)
+        return
+    today = date.today()
+    if years == 'all' or today.year in years:
+        end = today
+    else:
+        end = shown[-1].timestamp.date()
+    trends = rolling_stats(rides, end=end,
+                           years=None if years == 'all' else years)
+    # With several years, rides of the years in between may follow the end.
+    last = (end - trends['days'][0]).days
+    print(_('Rolling totals on {}').format(trends['days'][last]))
+    row_format = '{0:8s}  {1:>%ds}  {2:>%ds}' % (len(_('Distance')),
+                                                len(_('Duration')))
+    totals_format = '{0:8s}  {1:%d.1f}  {2:%d.1f}' % (len(_('Distance')),
+                                                     len(_('Duration')))
+    print(row_format.format(_('Window'), _('Distance'), _('Duration')))
+    print(row_format.format('', '(km)', '(h)'))
+    print(row_format.format('=' * 8, '=' * len(_('Distance')),
+                            '=' * len(_('Duration'))))
+    for window in ROLLING_WINDOWS:
+        print(totals_format.format(_('{} days').format(window),
+                                   trends['distance'][window][last],
+                                   trends['duration'][window][last]))
+    print()
+    lines = []
+    for window in ROLLING_WINDOWS:
+        lines.append((_('Best {} days:').format(window),
+                      _('{:.1f} km, ending on {}').format(
+                          *trends['best'][window])))
+    for name, label in (('longest_streak', _('Longest streak:')),
+                        ('last_streak', _('Last streak:'))):
+        lines.append((label, _('{} days, from {}').format(*trends[name])))
+    ride = trends['longest_ride']
+    lines.append((_('Longest ride:'), _('{:.1f} km on {}').format(
+        ride['distance'], ride['timestamp'].date())))
+    ride = trends['longest_duration']
+    lines.append((_('Longest duration:'), _('{:.1f} h on {}').format(
+        ride['duration'], ride['timestamp'].date())))
+    for min_distance in RECORD_DISTANCES:
+        ride = trends['fastest'][min_distance]
+        if ride is not None:
+            lines.append((_('Fastest over {} km:').format(min_distance),
+                          _('{:.1f} km/h on {}').format(
+                              ride['distance'] / ride['duration'],
+                              ride['timestamp'].date())))
+    label_width = max(len(label) for label, value in lines)
+    for label, value in lines:
+        print('{0:{1}s}  {2}'.format(label, label_width, value))
+
+
+def print_group_stats(grouped_stats):
+    """Print one line of statistics for each period of ``grouped_stats``."""
+    row_format = '{0:8s}  {1:>%ds}  {2:>%ds}  {3:>%ds}  {4:>%ds}' % (
+            len(_('Rides')), len(_('Distance')), len(_('Duration')),
+            len(_('Speed')))
+    stats_format = '{0:8s}  {1:%dd}  {2:%d.1f}  {3:%d.1f}  {4:%d.1f}' % (
+            len(_('Rides')), len(_('Distance')), len(_('Duration')),
+            len(_('Speed')))
+    print(row_format.format(_('Period'), _('Rides'), _('Distance'),
+                            _('Duration'), _('Speed')))
+    print(row_format.format('', '', '(km)', '(h)', '(km/h)'))
+    print(row_format.format(*['=' * len(h) for h in
+                              ['        ', _('Rides'), _('Distance'),
+                               _('Duration'), _('Speed')]]))
+    for period, stats in grouped_stats:
+        print(stats_format.format(period, stats['num_rides'],
+                                  stats['tot_distance'],
+                                  stats['tot_duration'], stats['speed']))
+
+
+@profiled
 def print_rides(args):
     """Print rides in database.  By default, only print rides for the current
     year. If ``year`` is set to a single year of a list of years, print rides
     for the specified years.
 
+    Rides are printed as they are read from the database, in batches of
+    ``WRITE_BATCH_SIZE`` lines.
+
     """
-    rides = read_db_file(year=args.year)
-    if len(rides) == 0:
-        print(_("No rides for year(s): ") + ', '.join(map(str, args.year)))
-        return
+    years, query, rides = _args_rides(args)
+    if not _write_rides(rides):
+        _print_no_rides(years, query)
+
+
+@profiled
+def search(args):
+    """Print the rides whose comment or URL has, for each of ``args.terms``, a
+    word starting with it, found with the search index."""
+    text = ' '.join(args.terms)
+    if not _write_rides(iter(get_rides(search_rides(text)))):
+        print(_("No rides match: ") + text)
+
+
+def _write_rides(rides):
+    """Print a table of the rides of the iterator ``rides`` and return
+    whether there were any."""
     comment_width = 30
     header_format = '{id:4s}  {0:16s}  {1:%ds}  {2:%ds}  {3:%ds}  {4:%ds}  {5:3s}' % (
             len(_('Distance')), len(_('Duration')), len(_('Speed')),
@@ -285,54 +3357,198 @@ def print_rides(args):
     sep_format = '{id:=<4s}  {0:=<16s}  {1:=<%ds}  {2:=<%ds}  {3:=<%ds}  {4:=<%ds}  {5:=<3s}' % (
             len(_('Distance')), len(_('Duration')), len(_('Speed')),
             comment_width)
-    print(header_format.format(
-        _('Date'), _('Distance'), _('Duration'), _('Speed'), _('Comment'),
-        _('URL'), id='id'))
-    print(header_format.format(
-        _('yyyy-mm-dd hh:mm'), '(km)', '(h)', '(km/h)', '', '', id=''))
-    time_str_format = '%Y-%m-%d %H:%M'
-    print(sep_format.format('', '', '', '', '', '', id=''))
-
-    for id, ride in enumerate(rides):
-        if ride['duration'] != 0:
-            speed = '{:.1f}'.format(ride['distance'] / ride['duration'])
+    date_str_format = '%Y-%m-%d '
+
+    first_ride = next(rides, None)
+    if first_ride is None:
+        return False
+    header = [
+        header_format.format(_('Date'), _('Distance'), _('Duration'),
+                             _('Speed'), _('Comment'), _('URL'), id='id'),
+        header_format.format(_('yyyy-mm-dd hh:mm'), '(km)', '(h)', '(km/h)',
+                             '', '', id=''),
+        sep_format.format('', '', '', '', '', '', id=''),
+        '']
+    sys.stdout.write('\n'.join(header))
+
+    # The timestamps are formatted from the epochs of the rides, without
+    # building their datetimes, and the dates are only formatted once a day.
+    dates = {}
+
+    def format_ride(ride):
+        if ride.duration != 0:
+            speed = '{:.1f}'.format(ride.distance / ride.duration)
         else:
             speed = 'nan'
-        elements = [ride['timestamp'].strftime(time_str_format),
-                    ride['distance'], ride['duration'], speed]
-        if len(ride['comment']) <= comment_width:
-            elements.append(ride['comment'])
+        day, minute = divmod(ride.epoch // 60, 1440)
+        date_str = dates.get(day)
+        if date_str is None:
+            date_str = dates[day] = (_EPOCH + timedelta(day)).strftime(
+                date_str_format)
+        elements = ['{}{:02d}:{:02d}'.format(date_str, *divmod(minute, 60)),
+                    ride.distance, ride.duration, speed]
+        if len(ride.comment) <= comment_width:
+            elements.append(ride.comment)
         else:
-            elements.append(ride['comment'][:comment_width - 3] + '...')
-        elements.append(ride['url'] != '')
-        print(ride_format.format(*elements, id=ride['id']))
+            elements.append(ride.comment[:comment_width - 3] + '...')
+        elements.append(ride.url != '')
+        return ride_format.format(*elements, id=ride.id) + '\n'
+
+    # Lines are written in batches rather than printed one at a time.
+    for batch in _batches(itertools.chain([first_ride], rides)):
+        sys.stdout.write(''.join(map(format_ride, batch)))
+    return True
+
+
+def _batches(iterable, size=WRITE_BATCH_SIZE):
+    """Yield lists of up to ``size`` consecutive items of ``iterable``."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _export_record(ride):
+    """Return the values of the ``EXPORT_COLUMNS`` for ``ride``.  The speed
+    is ``None`` if the duration is 0."""
+    duration = ride.duration
+    return (ride.id, ride.timestamp, ride.distance, duration,
+            ride.distance / duration if duration else None,
+            ride.comment, ride.url)
+
+
+def _export_csv(rides, output):
+    """Write the ``rides`` to the text stream ``output`` as CSV, with a
+    header line."""
+    lines = io.StringIO()
+    writer = csv.writer(lines, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in _batches(rides):
+        for record in map(_export_record, batch):
+            writer.writerow(record[:1] + (record[1].isoformat(),) +
+                            record[2:])
+        output.write(lines.getvalue())
+        lines.seek(0)
+        lines.truncate()
+    output.write(lines.getvalue())
+
+
+def _json_objects(rides):
+    """Yield the JSON objects describing each of the ``rides``."""
+    import json
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    for record in map(_export_record, rides):
+        yield encode(dict(zip(EXPORT_COLUMNS, record[:1] +
+                              (record[1].isoformat(),) + record[2:])))
+
+
+def _export_ndjson(rides, output):
+    """Write the ``rides`` to the text stream ``output`` as JSON objects, one
+    per line."""
+    for batch in _batches(_json_objects(rides)):
+        output.write('\n'.join(batch) + '\n')
+
+
+def _export_json(rides, output):
+    """Write the ``rides`` to the text stream ``output`` as a JSON array of
+    objects, without ever holding all of them."""
+    output.write('[')
+    separator = '\n'
+    for batch in _batches(_json_objects(rides)):
+        output.write(separator + ',\n'.join(batch))
+        separator = ',\n'
+    output.write('\n]\n')
+
+
+def _export_parquet(rides, output):
+    """Write the ``rides`` to ``output``, a file name or a binary stream, as
+    a Parquet file with one row group per ``PARQUET_BATCH_SIZE`` rides."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError(_('the parquet format requires pyarrow'))
+    schema = pyarrow.schema([
+        ('id', pyarrow.int64()), ('timestamp', pyarrow.timestamp('s')),
+        ('distance', pyarrow.float64()), ('duration', pyarrow.float64()),
+        ('speed', pyarrow.float64()), ('comment', pyarrow.string()),
+        ('url', pyarrow.string())])
+    with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+        for batch in _batches(rides, PARQUET_BATCH_SIZE):
+            columns = zip(*map(_export_record, batch))
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=field.type)
+                 for column, field in zip(columns, schema)], schema=schema))
+
+
+_EXPORTERS = {'csv': _export_csv, 'ndjson': _export_ndjson,
+              'json': _export_json}
+
+
+@profiled
+def export(args):
+    """Write the rides of ``args.year`` in ``args.format`` to the file
+    ``args.output``, or to the standard output if it is ``None``.
+
+    Each ride is exported with its id, timestamp, distance, duration, average
+    speed, which is empty or null if the duration is 0, comment and URL.
+    Rides are streamed from the database to the output in batches, so that
+    memory use does not depend on the number of rides, unless a query selects
+    them.
+
+    """
+    years, query, rides = _args_rides(args)
+    if args.format == 'parquet':
+        _export_parquet(rides, args.output or sys.stdout.buffer)
+    elif args.output is None:
+        _EXPORTERS[args.format](rides, sys.stdout)
+    else:
+        with open(args.output, 'w', encoding='utf-8',
+                  newline='') as output_file:
+            _EXPORTERS[args.format](rides, output_file)
+
+
+def run_query(args):
+    """Print the rides matching ``args.query``, their statistics if
+    ``args.stats`` is true, or export them in the ``args.format`` format if
+    it is set or a file is given."""
+    if args.format is not None or args.output is not None:
+        args.format = args.format or 'csv'
+        export(args)
+    elif args.stats:
+        print_stats(args)
+    else:
+        print_rides(args)
 
 
 def migrate(args):
-    """Migrate the database file to new version."""
-    rides = read_db_file()
-    new_time_str = "%Y-%m-%d %H:%M:%S"
-    with open(RIDEDB, 'w', encoding='utf-8') as rides_file:
-        rides_writer = csv.writer(rides_file, delimiter=',', quotechar='"',
-                                  quoting=csv.QUOTE_MINIMAL)
-        for ride in rides:
-            rides_writer.writerow(
-                [ride['timestamp'].strftime(new_time_str),
-                 str(ride['distance']), str(ride['duration']),
-                 ride['comment'], ride['url']])
+    """Migrate the database file to new version.
+
+    With ``--to``, copy every ride to another storage backend instead.
+
+    """
+    source = get_backend()
+    rides = source.read('all')
+    target = get_backend(args.to) if args.to else source
+    target.rewrite(rides)
+    if target.name != source.name:
+        print(_('Migrated {} rides to the {} backend, set BIKE_BACKEND={} to '
+                'use it.').format(len(rides), target.name, target.name))
 
 
 def view(args):
     """View ride URL in default browser."""
-    rides = read_db_file(year=args.year)
-    for ride in rides:
-        if ride['id'] == args.ride_id:
-            break
-    else:
+    years = _normalize_years(args.year)
+    ride = get_ride(args.ride_id)
+    if ride is None or (years != 'all' and
+                        ride['timestamp'].year not in years):
         print(_('Error: no ride with index {}').format(args.ride_id),
               file=sys.stderr)
         return
     if ride['url']:
+        import webbrowser
         print(_('Opened %s') % ride['url'])
         webbrowser.open(ride['url'])
     else:
@@ -340,54 +3556,170 @@ def view(args):
               file=sys.stderr)
 
 
+COMMANDS = ('stats', 'trends', 'add', 'rides', 'export', 'query', 'search',
+            'migrate', 'compact', 'view', 'import')
+
+
 def run(argv=sys.argv[1:]):
-    """Parse the command line arguments and run the appropriate command."""
+    """Parse the command line arguments and run the appropriate command.
+
+    When a command is given, only its parser is built.
+
+    With ``--profile``, or if the ``BIKE_TRACE`` environment variable is set,
+    the time spent in each phase of the command, the number of rows it
+    handled and the peak memory use are reported on the standard error, or
+    written as JSON to the file given by ``--profile-output`` or by
+    ``BIKE_TRACE`` if it is not ``1``.
+
+    """
+    import argparse
     clparser = argparse.ArgumentParser(
             description=_('Gather statistics about bike rides.'))
     clparser.add_argument('-v', '--version', action='version',
                           version='%(prog)s ' + __version__)
+    clparser.add_argument('--profile', action='store_true',
+                          help=_('report where the time goes'))
+    clparser.add_argument('--profile-output', metavar='FILE',
+                          help=_('write the profile as JSON to a file'))
 
     year_parser = argparse.ArgumentParser(add_help=False)
     year_parser.add_argument('year', help=_('year or list of years'),
                              nargs='*', default=datetime.now().year,
                              type=int)
+    query_parser = argparse.ArgumentParser(add_help=False)
+    query_parser.add_argument(
+        '-q', '--query', metavar='EXPRESSION',
+        help=_('only keep the rides matching EXPRESSION, such as '
+               '"distance>50 and comment~commute and date>=2021-04", of '
+               'every year unless years are given'))
+
+    # The command is the first argument that is neither an option nor the
+    # value of one.
+    command = None
+    for i, arg in enumerate(argv):
+        if not arg.startswith('-') and (
+                i == 0 or argv[i - 1] != '--profile-output'):
+            command = arg
+            break
+    if command not in [_(name) for name in COMMANDS]:
+        command = None
+
+    def wanted(name):
+        return command is None or command == _(name)
 
     subparsers = clparser.add_subparsers()
-    statsparser = subparsers.add_parser(_('stats'),
-                                        help=_('print statistics for all rides'),
-                                        parents=[year_parser])
-    statsparser.set_defaults(func=print_stats)
-
-    addparser = subparsers.add_parser(_('add'), help=_('add a new ride'))
-    addparser.set_defaults(func=add_ride_interactive)
-
-    printparser = subparsers.add_parser(_('rides'), help=_('print all rides'),
-                                        parents=[year_parser])
-    printparser.set_defaults(func=print_rides)
-
-    migrateparser = subparsers.add_parser(_('migrate'),
-                                          help=_('migrate rides file'))
-    migrateparser.set_defaults(func=migrate)
-
-    viewparser = subparsers.add_parser(_('view'),
-                                       help=_('view ride in web browser'),
-                                       parents=[year_parser])
-    viewparser.add_argument('ride_id', help='numerical id of the ride to view',
-                            type=int)
-    viewparser.set_defaults(func=view)
-
-    importparser = subparsers.add_parser(_('import'),
-                                         help=_('import ride from Wahoo csv'))
-    importparser.add_argument('filename', help='file name to import')
-    importparser.add_argument('comment', help='comment to add to ride',
-                              nargs=argparse.REMAINDER)
-    importparser.set_defaults(func=read_wahoo_csv)
+    if wanted('stats'):
+        statsparser = subparsers.add_parser(
+            _('stats'), help=_('print statistics for all rides'),
+            parents=[year_parser, query_parser])
+        statsparser.add_argument('--by', choices=PERIODS,
+                                 help=_('group statistics by period'))
+        statsparser.set_defaults(func=print_stats)
+
+    if wanted('trends'):
+        trendsparser = subparsers.add_parser(
+            _('trends'), help=_('print rolling totals, streaks and records'),
+            parents=[year_parser])
+        trendsparser.set_defaults(func=print_trends)
+
+    if wanted('add'):
+        addparser = subparsers.add_parser(_('add'), help=_('add a new ride'))
+        addparser.add_argument('--batch', metavar='FILE',
+                               help=_('add the rides listed in a CSV file '
+                                      '(- for standard input)'))
+        addparser.set_defaults(func=add_ride_interactive)
+
+    if wanted('rides'):
+        printparser = subparsers.add_parser(
+            _('rides'), help=_('print all rides'),
+            parents=[year_parser, query_parser])
+        printparser.set_defaults(func=print_rides)
+
+    if wanted('export'):
+        exportparser = subparsers.add_parser(
+            _('export'), help=_('export rides for other programs'),
+            parents=[query_parser])
+        exportparser.add_argument(
+            'year', help=_('year or list of years, all by default'),
+            nargs='*', default='all', type=int)
+        exportparser.add_argument('--format', choices=EXPORT_FORMATS,
+                                  default='csv', help=_('output format'))
+        exportparser.add_argument(
+            '-o', '--output', metavar='FILE',
+            help=_('write to a file instead of the standard output'))
+        exportparser.set_defaults(func=export)
+
+    if wanted('query'):
+        queryparser = subparsers.add_parser(
+            _('query'), help=_('print the rides matching an expression'))
+        queryparser.add_argument(
+            'query', metavar='expression',
+            help=_('conditions on date, distance, duration, speed, comment '
+                   'and url, such as "distance>50 and comment~commute and '
+                   'date>=2021-04"'))
+        queryparser.add_argument(
+            'year', help=_('year or list of years, all by default'),
+            nargs='*', default='all', type=int)
+        queryparser.add_argument('--stats', action='store_true',
+                                 help=_('print statistics instead'))
+        queryparser.add_argument('--format', choices=EXPORT_FORMATS,
+                                 help=_('export the rides in this format '
+                                        'instead'))
+        queryparser.add_argument(
+            '-o', '--output', metavar='FILE',
+            help=_('export to a file instead of the standard output'))
+        queryparser.set_defaults(func=run_query)
+
+    if wanted('search'):
+        searchparser = subparsers.add_parser(
+            _('search'), help=_('find rides by the words of their comment '
+                                'or URL'))
+        searchparser.add_argument(
+            'terms', nargs='+', metavar='term',
+            help=_('beginning of a word, accents and case are ignored'))
+        searchparser.set_defaults(func=search)
+
+    if wanted('migrate'):
+        migrateparser = subparsers.add_parser(_('migrate'),
+                                              help=_('migrate rides file'))
+        migrateparser.add_argument('--to', choices=sorted(BACKENDS),
+                                   help=_('storage backend to migrate to'))
+        migrateparser.set_defaults(func=migrate)
+
+    if wanted('compact'):
+        compactparser = subparsers.add_parser(
+            _('compact'), help=_('fold edits and deletions into rides file'))
+        compactparser.set_defaults(func=compact)
+
+    if wanted('view'):
+        viewparser = subparsers.add_parser(
+            _('view'), help=_('view ride in web browser'),
+            parents=[year_parser])
+        viewparser.add_argument('ride_id',
+                                help='numerical id of the ride to view',
+                                type=int)
+        viewparser.set_defaults(func=view)
+
+    if wanted('import'):
+        importparser = subparsers.add_parser(
+            _('import'), help=_('import ride from Wahoo csv'))
+        importparser.add_argument('filename', help='file name to import',
+                                  nargs='?')
+        importparser.add_argument('--dir',
+                                  help=_('import every Wahoo csv file of a '
+                                         'directory'))
+        importparser.add_argument('comment', help='comment to add to ride',
+                                  nargs=argparse.REMAINDER)
+        importparser.set_defaults(func=read_wahoo_csv)
 
     args = clparser.parse_args(argv)
     if 'func' not in args:
         clparser.error("You must specify one of 'add', 'rides', 'stats', "
-                       "'view' or 'import'.")
+                       "'trends', 'export', 'query', 'search', 'view' or "
+                       "'import'.")
 
+    if args.profile or args.profile_output or trace_enabled():
+        start_profile()
     try:
         args.func(args)
     except ValueError as e:
@@ -396,6 +3728,8 @@ def run(argv=sys.argv[1:]):
         print("\n" + _("User interrupted program, no changes were recorded "
                        "in the database."),
               file=sys.stderr)
+    finally:
+        report_profile(args.profile_output)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,33 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bike  # noqa: E402
+
+
+@pytest.fixture
+def ridedb(tmp_path, monkeypatch):
+    """Point ``bike.RIDEDB`` to an empty CSV database in a temporary
+    directory and return its path."""
+    path = str(tmp_path / 'bikerides')
+    open(path, 'w').close()
+    monkeypatch.setattr(bike, 'RIDEDB', path)
+    monkeypatch.setattr(bike, 'BACKEND', 'csv')
+    monkeypatch.setattr(bike, 'TRANS_DICT', {})
+    return path
+
+
+@pytest.fixture
+def rides(ridedb):
+    """Fill the database with a ride a day from 2021-12-01 to 2022-01-30 and
+    return the list of their ``(timestamp, distance, duration, comment,
+    url)`` rows."""
+    start = datetime(2021, 12, 1, 8, 30)
+    rows = [(start + timedelta(days=day), 10.0 + day, 0.5 + day / 100,
+             'Ride {}'.format(day), '') for day in range(61)]
+    bike.add_rides(rows)
+    return rows
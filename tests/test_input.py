@@ -0,0 +1,103 @@
+import os
+from datetime import datetime
+
+import pytest
+
+import bike
+
+
+def test_validate_strings():
+    assert bike._validate_ride('2021-05-01 08:00:00', '12.5', '1:30',
+                               'Comment', None) == (
+        datetime(2021, 5, 1, 8), 12.5, 1.5, 'Comment', '')
+
+
+@pytest.mark.parametrize('ride', [
+    ('2021-05-01', 10, 1),
+    ('2021-05-01 08:00:00', 'ten', 1),
+    ('2021-05-01 08:00:00', 10, 'long'),
+])
+def test_validate_invalid_fields(ride):
+    with pytest.raises(ValueError):
+        bike._validate_ride(*ride)
+
+
+@pytest.mark.parametrize('comment, url', [
+    ('First line\nsecond line', ''),
+    ('Carriage\rreturn', ''),
+    ('', 'https://example.org/\r\n'),
+])
+def test_validate_line_breaks(comment, url):
+    with pytest.raises(ValueError, match='single line'):
+        bike._validate_ride(datetime(2021, 5, 1), 10, 1, comment, url)
+
+
+def test_line_breaks_are_not_written(ridedb):
+    bike.add_ride(datetime(2021, 5, 1), 10, 1, 'Fine')
+    for add in (lambda: bike.add_ride(datetime(2021, 5, 2), 10, 1, 'a\nb'),
+                lambda: bike.add_rides([(datetime(2021, 5, 2), 10, 1, 'ok'),
+                                        (datetime(2021, 5, 3), 10, 1, 'a\rb')]),
+                lambda: bike.update_ride(0, datetime(2021, 5, 1), 10, 1,
+                                         '', 'x\ny')):
+        with pytest.raises(ValueError):
+            add()
+    with open(ridedb) as rides_file:
+        assert rides_file.read() == '2021-05-01 00:00:00,10.0,1.0,Fine,\n'
+    assert not os.path.exists(ridedb + bike.JOURNAL_SUFFIX)
+
+
+def write_wahoo(path, content):
+    with open(path, 'w') as wahoo_file:
+        wahoo_file.write(content)
+    return str(path)
+
+
+def test_parse_wahoo(tmp_path):
+    path = write_wahoo(tmp_path / 'ride.csv',
+                       'Timestamp,WorkoutActive,TotalDistance\n'
+                       '1600000000000,false,0\n'
+                       '1600000060000,true,100\n'
+                       '1600003660000,true,20100\n')
+    assert bike.parse_wahoo_csv(path) == (datetime(2020, 9, 13, 13, 27, 40),
+                                          20.0, 1.0)
+
+
+@pytest.mark.parametrize('content', [
+    '',
+    'Time,Distance\n1,2\n',
+    'Timestamp,WorkoutActive,TotalDistance\n1600000000000,false,0\n',
+    'Timestamp,WorkoutActive,TotalDistance\n1600000000000,true,0\n16000000',
+    'Timestamp,WorkoutActive,TotalDistance\n1600000000000,true,x\n',
+])
+def test_parse_wahoo_invalid(tmp_path, content):
+    with pytest.raises(ValueError):
+        bike.parse_wahoo_csv(write_wahoo(tmp_path / 'ride.csv', content))
+
+
+def test_parse_wahoo_unreadable(tmp_path):
+    with pytest.raises(ValueError):
+        bike.parse_wahoo_csv(str(tmp_path / 'missing.csv'))
+    with pytest.raises(ValueError):
+        bike.parse_wahoo_csv(str(tmp_path))
+    path = tmp_path / 'binary.csv'
+    path.write_bytes(b'\xff\xfe\x00')
+    with pytest.raises(ValueError):
+        bike.parse_wahoo_csv(str(path))
+
+
+def test_vanished_wahoo_file(tmp_path):
+    filename, ride, error, elapsed, size = bike._timed_parse_wahoo_csv(
+        str(tmp_path / 'missing.csv'))
+    assert ride is None and error and size == 0
+
+
+def test_import_dir_with_a_comment(ridedb, tmp_path):
+    wahoo_dir = tmp_path / 'wahoo'
+    wahoo_dir.mkdir()
+    write_wahoo(wahoo_dir / 'ride.csv',
+                'Timestamp,WorkoutActive,TotalDistance\n'
+                '1600000000000,true,0\n'
+                '1600003600000,true,20000\n')
+    bike.run(['import', '--dir', str(wahoo_dir), 'my', 'long', 'comment'])
+    assert [ride['comment'] for ride in bike.read_db_file(year='all')] == [
+        'my long comment']
@@ -0,0 +1,97 @@
+import csv
+from datetime import datetime
+
+import pytest
+
+import bike
+
+
+ROWS = [
+    (datetime(2020, 12, 31, 23, 0), 55.0, 2.0, 'Commute home', ''),
+    (datetime(2021, 4, 1, 7, 30), 12.5, 0.5, 'commute', 'https://x.org/a'),
+    (datetime(2021, 4, 15, 18, 0), 80.0, 4.0, 'Tour du lac', ''),
+    (datetime(2022, 1, 1, 10, 0), 30.0, 0.0, 'Say "hi" (again)', ''),
+]
+
+
+def matching(expression):
+    """Return the indexes of the ``ROWS`` matched by ``expression``, checking
+    that every way of matching a ride agrees."""
+    query = bike.Query(expression)
+    found = []
+    for i, row in enumerate(ROWS):
+        line = next(csv.reader([bike._format_row(row).decode('utf-8')]))
+        ride = bike.Ride(*row, id=i)
+        matches = {bool(query.match_line(line)), bool(query.match_row(row)),
+                   bool(query(ride))}
+        assert len(matches) == 1, (expression, row)
+        if matches.pop():
+            found.append(i)
+    return found
+
+
+@pytest.mark.parametrize('expression, expected', [
+    ('distance>50', [0, 2]),
+    ('distance>=12.5 and duration<1', [1, 3]),
+    ('comment~COMMUTE', [0, 1]),
+    ('comment="commute"', [1]),
+    ('comment~\'"hi"\'', [3]),
+    ('url!=""', [1]),
+    ('date=2021', [1, 2]),
+    ('date>=2021-04-15', [2, 3]),
+    ('date<2021-04-01T07:30', [0]),
+    ('speed>21', [0, 1]),
+    ('not (distance<20 or comment~lac)', [0, 3]),
+    ('distance>10 and not date=2021 or url~x.org', [0, 1, 3]),
+    ('DISTANCE > 50 AND Comment ~ tour', [2]),
+])
+def test_match(expression, expected):
+    assert matching(expression) == expected
+
+
+def test_zero_duration_has_no_speed():
+    assert matching('speed>=0') == [0, 1, 2]
+    assert matching('not speed>=0') == [3]
+
+
+@pytest.mark.parametrize('expression, years', [
+    ('distance>5', 'all'),
+    ('date=2021', range(2021, 2022)),
+    ('date>=2020-06 and date=2021', range(2021, 2022)),
+    ('date=2020 or date=2022', range(2020, 2023)),
+])
+def test_years(expression, years):
+    assert bike.Query(expression).years == years
+
+
+def test_restrict():
+    query = bike.Query('date>=2021')
+    assert query.restrict([2019, 2021, 2022]) == [2021, 2022]
+    assert query.restrict('all') == query.years
+
+
+@pytest.mark.parametrize('expression', [
+    '', '(distance>1', 'distance>1)', 'distance>', 'distance>x',
+    'weight>1', 'comment<a', 'distance~1', 'date=21', 'date=2021-13',
+    'distance>1 and', 'distance>1 or or duration<2',
+])
+def test_invalid(expression):
+    with pytest.raises(ValueError):
+        bike.Query(expression)
+
+
+@pytest.mark.parametrize('value', [
+    'nan', 'NaN', 'inf', '-inf', 'Infinity', '1e999',
+])
+def test_non_finite_numbers(value):
+    with pytest.raises(ValueError, match='invalid number'):
+        bike.Query('distance>{}'.format(value))
+
+
+def test_query_reads_only_matching_rides(rides):
+    query = bike.Query('date=2022 and distance>=60')
+    found = bike.read_db_file(year='all', query=query)
+    assert [ride['comment'] for ride in found] == [
+        'Ride {}'.format(day) for day in range(50, 61)]
+    assert [ride['id'] for ride in bike.iter_rides(query=query)] == [
+        ride['id'] for ride in found]
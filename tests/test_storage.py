@@ -0,0 +1,262 @@
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+import bike
+
+
+def read_all():
+    return [(ride['id'], ride['timestamp'], ride['distance'], ride['comment'])
+            for ride in bike.read_db_file(year='all')]
+
+
+def build_helper_files():
+    """Read every ride and their per year totals, which stores the helper
+    files."""
+    read_all()
+    bike.get_year_stats('all')
+
+
+def helper_files_agree(ridedb):
+    """Check that the helper files brought up to date match those built from
+    scratch."""
+    assert bike.get_year_stats('all') == pytest.approx(
+        bike.get_stats(bike.read_db_file(year='all')))
+    with bike._Snapshot() as snapshot:
+        index = bike._load_index(snapshot)
+        aggregates = bike._load_aggregates(snapshot)
+        cache = bike._load_cache(snapshot)
+        fresh_index = bike._build_index(snapshot)
+        fresh_aggregates = bike._build_aggregates(
+            bike.CSVBackend()._read(snapshot, 'all'), snapshot.stat,
+            snapshot.journal_size)
+    assert index['offsets'] == fresh_index['offsets']
+    assert index['years'] == fresh_index['years']
+    assert aggregates['years'].keys() == fresh_aggregates['years'].keys()
+    for year, sums in aggregates['years'].items():
+        assert sums == pytest.approx(fresh_aggregates['years'][year])
+    assert cache is not None
+
+
+def test_edits_go_to_the_journal(rides, ridedb):
+    build_helper_files()
+    before = read_all()
+    size = os.path.getsize(ridedb)
+    bike.update_ride(3, datetime(2021, 12, 4, 9), 42.0, 1.5, 'Edited')
+    bike.delete_ride(5)
+    assert os.path.getsize(ridedb) == size
+    assert os.path.exists(ridedb + bike.JOURNAL_SUFFIX)
+    expected = [entry for entry in before if entry[0] != 5]
+    expected[3] = (3, datetime(2021, 12, 4, 9), 42.0, 'Edited')
+    assert read_all() == expected
+    assert bike.get_ride(3)['comment'] == 'Edited'
+    assert bike.get_ride(5) is None
+    assert bike.get_rides([2, 3, 5]) == [bike.get_ride(2), bike.get_ride(3)]
+    assert list(bike.iter_rides('all'))[3]['distance'] == 42.0
+    helper_files_agree(ridedb)
+
+
+def test_missing_ride(rides):
+    for ride_id in (-1, len(rides), 10 ** 6):
+        assert bike.get_ride(ride_id) is None
+        with pytest.raises(ValueError):
+            bike.update_ride(ride_id, datetime(2022, 1, 1), 1, 1)
+    bike.delete_ride(0)
+    with pytest.raises(ValueError):
+        bike.delete_ride(0)
+
+
+def test_journal_is_compacted(rides, ridedb, monkeypatch):
+    monkeypatch.setattr(bike, 'COMPACT_THRESHOLD', 4)
+    build_helper_files()
+    for ride_id in range(3):
+        bike.update_ride(ride_id, rides[ride_id][0], 1.0, 1.0, 'Edit')
+    assert os.path.exists(ridedb + bike.JOURNAL_SUFFIX)
+    bike.delete_ride(10)
+    assert not os.path.exists(ridedb + bike.JOURNAL_SUFFIX)
+    found = read_all()
+    assert len(found) == len(rides) - 1
+    assert [entry[3] for entry in found[:3]] == ['Edit'] * 3
+    helper_files_agree(ridedb)
+
+
+def test_journal_ignores_a_partial_entry(rides, ridedb):
+    bike.update_ride(1, rides[1][0], 99.0, 1.0)
+    with open(ridedb + bike.JOURNAL_SUFFIX, 'ab') as journal_file:
+        journal_file.write(b'D,')
+    with bike._Snapshot() as snapshot:
+        assert snapshot.journal == {1: (rides[1][0], 99.0, 1.0, '', '')}
+        assert snapshot.journal_entries == 1
+
+
+def test_journal_entries_of_another_file_are_ignored(rides, ridedb):
+    bike.delete_ride(1)
+    bike.update_db(bike.read_db_file(year='all'))
+    with open(ridedb + bike.JOURNAL_SUFFIX, 'a') as journal_file:
+        journal_file.write('D,1,2\n')
+    assert len(read_all()) == len(rides) - 1
+
+
+@contextmanager
+def writing(ridedb):
+    """Hold the write lock as another process appending to ``ridedb``
+    would."""
+    fcntl = pytest.importorskip('fcntl')
+    with open(ridedb + bike.LOCK_SUFFIX, 'ab') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def test_snapshot_ignores_a_partial_line(rides, ridedb):
+    before = read_all()
+    with writing(ridedb):
+        with open(ridedb, 'ab') as rides_file:
+            rides_file.write(b'2022-02-01 08:00:00,12.0,0.')
+        with bike._Snapshot() as snapshot:
+            assert snapshot.read().endswith(b'\n')
+            assert snapshot.size < os.path.getsize(ridedb)
+        assert read_all() == before
+        assert bike.get_ride(len(rides)) is None
+        with open(ridedb, 'ab') as rides_file:
+            rides_file.write(b'5,,\n')
+    assert read_all()[-1] == (len(rides), datetime(2022, 2, 1, 8), 12.0, '')
+
+
+def test_last_line_without_newline(rides, ridedb):
+    build_helper_files()
+    with open(ridedb, 'ab') as rides_file:
+        rides_file.write(b'2022-02-01 08:00:00,7.5,0.5,By hand,')
+    assert read_all()[-1] == (len(rides), datetime(2022, 2, 1, 8), 7.5,
+                              'By hand')
+    build_helper_files()
+    position, _, _ = bike.follow_rides()
+    assert bike.add_ride(datetime(2022, 2, 2), 8, 1, 'Added') == len(rides) + 1
+    assert read_all()[-2:] == [
+        (len(rides), datetime(2022, 2, 1, 8), 7.5, 'By hand'),
+        (len(rides) + 1, datetime(2022, 2, 2), 8.0, 'Added')]
+    assert bike.get_ride(len(rides))['comment'] == 'By hand'
+    helper_files_agree(ridedb)
+    for suffix in (bike.CACHE_SUFFIX, bike.INDEX_SUFFIX,
+                   bike.AGGREGATES_SUFFIX):
+        os.remove(ridedb + suffix)
+    assert read_all()[-2:] == [
+        (len(rides), datetime(2022, 2, 1, 8), 7.5, 'By hand'),
+        (len(rides) + 1, datetime(2022, 2, 2), 8.0, 'Added')]
+    _, added, edits = bike.follow_rides(position)
+    assert [(ride.id, ride.comment) for ride in added] == [
+        (len(rides) + 1, 'Added')]
+    assert edits == {}
+
+
+def test_appends_are_folded_into_the_helper_files(rides, ridedb):
+    build_helper_files()
+    ids = [bike.add_ride(datetime(2022, 2, day, 8), day, 1.0, 'Added')
+           for day in range(1, 4)]
+    assert ids == list(range(len(rides), len(rides) + 3))
+    assert os.path.exists(ridedb + bike.APPENDS_SUFFIX)
+    assert bike.get_ride(ids[-1])['distance'] == 3.0
+    assert read_all()[-3:] == [
+        (ride_id, datetime(2022, 2, day, 8), float(day), 'Added')
+        for ride_id, day in zip(ids, range(1, 4))]
+    helper_files_agree(ridedb)
+
+
+def test_lines_appended_by_hand(rides, ridedb):
+    build_helper_files()
+    with open(ridedb, 'a') as rides_file:
+        rides_file.write('2022-02-01 08:00:00,7.5,0.5,By hand,\n')
+    assert bike.add_ride(datetime(2022, 2, 2), 8, 1) == len(rides) + 1
+    assert read_all()[-2][3] == 'By hand'
+    helper_files_agree(ridedb)
+
+
+def test_add_rides_in_the_past_are_merged(rides, ridedb):
+    build_helper_files()
+    bike.add_rides([(datetime(2021, 11, 30), 5, 1, 'Early')])
+    found = read_all()
+    assert found[0] == (0, datetime(2021, 11, 30), 5.0, 'Early')
+    assert [entry[0] for entry in found] == list(range(len(rides) + 1))
+    assert not os.path.exists(ridedb + bike.APPENDS_SUFFIX)
+    helper_files_agree(ridedb)
+
+
+def test_search_index_follows_changes(rides, ridedb):
+    assert bike.search_rides('ride 1') == bike.search_rides('1')
+    assert os.path.exists(ridedb + bike.SEARCH_SUFFIX)
+    stored = os.path.getmtime(ridedb + bike.SEARCH_SUFFIX)
+    ride_id = bike.add_ride(datetime(2022, 2, 1), 5, 1, 'Café crème')
+    bike.update_ride(2, rides[2][0], 1, 1, 'Cafe noir')
+    bike.delete_ride(3)
+    assert os.path.getmtime(ridedb + bike.SEARCH_SUFFIX) == stored
+    assert os.path.exists(ridedb + bike.SEARCH_LOG_SUFFIX)
+    assert bike.search_rides('CAFÉ') == [2, ride_id]
+    assert bike.search_rides('cafe cr') == [ride_id]
+    assert 3 not in bike.search_rides('ride')
+    rebuilt = bike.SearchIndex.build(bike.iter_rides('all'))
+    assert bike.search_rides('ride') == rebuilt.search('ride')
+
+
+def test_search_index_is_built_again_when_stale(rides, ridedb):
+    bike.search_rides('ride')
+    with open(ridedb, 'a') as rides_file:
+        rides_file.write('2022-02-01 08:00:00,7.5,0.5,Unindexed,\n')
+    assert bike.search_rides('unindexed') == [len(rides)]
+
+
+def test_tokenize():
+    assert bike._tokenize("Vent de face à l'aller, Œuvre ÉTÉ") == [
+        'vent', 'de', 'face', 'a', 'l', 'aller', 'oeuvre', 'ete']
+    assert bike._tokenize('') == []
+
+
+def test_iter_rides_streams_the_journal(rides, monkeypatch):
+    bike.update_ride(3, datetime(2022, 1, 10, 8, 30), 3.5, 1, 'Moved')
+    bike.update_ride(50, rides[50][0], 50.5, 1, 'Edited')
+    bike.delete_ride(20)
+    expected = {years: [(ride['id'], ride['distance'])
+                        for ride in bike.read_db_file(year=years)]
+                for years in ('all', 2022)}
+    assert expected['all'][9:11] == [(10, 20.0), (11, 21.0)]
+    assert (3, 3.5) in expected[2022]
+
+    def read(*args, **kwargs):
+        raise AssertionError('not streamed')
+    monkeypatch.setattr(bike.CSVBackend, '_read', read)
+    for years, found in expected.items():
+        assert [(ride['id'], ride['distance'])
+                for ride in bike.iter_rides(years)] == found
+    assert [ride.id for ride in bike.iter_rides(
+        'all', query=bike.Query('comment~ed'))] == [3, 50]
+
+
+def test_search_index_keeps_changes_logged_while_folding(rides, ridedb,
+                                                         monkeypatch):
+    monkeypatch.setattr(bike, 'COMPACT_THRESHOLD', 3)
+    bike.search_rides('ride')
+    ids = [bike.add_ride(datetime(2022, 2, day), 5, 1, 'Added')
+           for day in (1, 2, 3)]
+    load = bike.SearchIndex.load
+
+    def load_then_add(version):
+        # Another process adds a ride once the index was loaded.
+        index = load(version)
+        monkeypatch.setattr(bike.SearchIndex, 'load', load)
+        ids.append(bike.add_ride(datetime(2022, 2, 4), 5, 1, 'Added'))
+        return index
+    monkeypatch.setattr(bike.SearchIndex, 'load', load_then_add)
+    assert bike.search_rides('added') == ids[:3]
+    index = bike.SearchIndex.load(bike.db_version())
+    assert index is not None
+    assert index.search('added') == ids
+
+
+def test_cache_of_a_touched_file_is_stamped_again(rides, ridedb):
+    before = read_all()
+    stat = os.stat(ridedb)
+    os.utime(ridedb, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert read_all() == before
+    with bike._Snapshot() as snapshot:
+        assert bike._read_sidecar(bike.CACHE_SUFFIX, bike.CACHE_VERSION)[
+            'stamp'] == bike._stamp(snapshot.stat)
@@ -0,0 +1,70 @@
+import argparse
+from datetime import date, datetime
+
+import pytest
+
+import bike
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def numpy(request, monkeypatch):
+    """Run the test with numpy, if installed, and without."""
+    if request.param == 'python':
+        monkeypatch.setattr(bike, '_import_numpy', lambda: None)
+    elif bike._import_numpy() is None:
+        pytest.skip('numpy is not installed')
+    return request.param
+
+
+def make_rides(*rides):
+    return [bike.Ride(datetime(*day), distance, duration)
+            for day, distance, duration in rides]
+
+
+def test_windows_span_the_new_year(numpy):
+    rides = make_rides(((2021, 12, 20), 200, 8), ((2021, 12, 30), 20, 1),
+                       ((2021, 12, 31), 30, 1), ((2022, 1, 2), 10, 0.5),
+                       ((2022, 1, 3), 15, 0.5))
+    trends = bike.rolling_stats(rides, end=date(2022, 1, 5), years=[2022])
+    assert trends['days'][0] == date(2021, 12, 20)
+    last = trends['days'].index(date(2022, 1, 3))
+    assert trends['distance'][7][last] == pytest.approx(75)
+    assert trends['distance'][30][last] == pytest.approx(275)
+    assert trends['duration'][7][last] == pytest.approx(3)
+    # Only windows ending in 2022, though the best one ends in 2021.
+    assert trends['best'][7] == (pytest.approx(75), date(2022, 1, 3))
+    assert trends['best'][30] == (pytest.approx(275), date(2022, 1, 3))
+    assert trends['longest_streak'] == (2, date(2022, 1, 2))
+    assert trends['last_streak'] == (2, date(2022, 1, 2))
+    assert trends['longest_ride'].distance == 15
+
+
+def test_every_year(numpy):
+    rides = make_rides(((2021, 12, 20), 200, 8), ((2021, 12, 30), 20, 1),
+                       ((2021, 12, 31), 30, 1), ((2022, 1, 2), 10, 0.5))
+    trends = bike.rolling_stats(rides)
+    assert trends['days'][-1] == date(2022, 1, 2)
+    assert trends['best'][7] == (pytest.approx(200), date(2021, 12, 20))
+    assert trends['best'][30] == (pytest.approx(260), date(2022, 1, 2))
+    assert trends['longest_streak'] == (2, date(2021, 12, 30))
+    assert trends['last_streak'] == (1, date(2022, 1, 2))
+    assert trends['longest_ride'].distance == 200
+    assert trends['fastest'][20].distance == 30
+    assert trends['fastest'][50].distance == 200
+    assert trends['fastest'][100].distance == 200
+    assert bike.rolling_stats([]) is None
+
+
+def test_print_trends_reads_the_year_before(rides, capsys):
+    bike.print_trends(argparse.Namespace(year=[2022]))
+    output = capsys.readouterr().out
+    assert 'Rolling totals on 2022-01-30' in output
+    windows = {words[0]: words[2:4] for words in map(str.split,
+                                                     output.splitlines())
+               if words[1:2] == ['days']}
+    # Every ride of December 2021 counts in the last 365 days.
+    assert float(windows['365'][0]) == pytest.approx(
+        sum(row[1] for row in rides))
+    assert float(windows['30'][0]) == pytest.approx(
+        sum(row[1] for row in rides[-30:]))
+    assert 'ending on 2022-01-30' in output
@@ -0,0 +1,158 @@
+from datetime import datetime
+
+import pytest
+
+import bike
+
+pytest.importorskip('tkinter')
+import Velociraptor  # noqa: E402
+
+
+class Var(object):
+    """Stand-in for a Tk variable."""
+
+    def __init__(self, value=''):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+class RidesView(object):
+    """Stand-in for the rides list, recording the rides it shows."""
+
+    def set_rides(self, rides):
+        self.rides = rides
+
+    def removed(self, index):
+        pass
+
+    def inserted(self, index):
+        pass
+
+    def select(self, index):
+        pass
+
+
+@pytest.fixture
+def gui(rides):
+    """Return a window showing the rides of 2022, without its widgets."""
+    gui = Velociraptor.VelociraptorGui.__new__(Velociraptor.VelociraptorGui)
+    # Missing attributes are looked up on the Tcl interpreter.
+    gui.tk = None
+    gui.year = Var('2022')
+    gui.graph_kind = Var(Velociraptor.CUMULATIVE)
+    gui.stats_text = Var()
+    gui.search_text = Var()
+    gui.year_combo = {}
+    gui.rides_view = RidesView()
+    gui.graph_view = None
+    gui.searching = False
+    gui.loaded = True
+    gui.following = gui.follow_again = False
+    gui.reloads = 0
+
+    def reload():
+        gui.reloads += 1
+    gui.reload = reload
+    gui.load_data()
+    gui.update_rides_view()
+    gui._stats_computed('2022', bike.get_stats(list(gui.viewable_rides)))
+    return gui
+
+
+def follow(gui):
+    """Apply the changes made by other programs since the last read."""
+    gui._followed(gui.follow_position, Velociraptor.read_rides(
+        gui.follow_position))
+
+
+def test_remove_a_ride_changed_by_another_program(gui, rides):
+    ride_id = len(rides) - 1
+    stale = gui.rides_by_id[ride_id]
+    bike.update_ride(ride_id, rides[-1][0], 99.0, 1.0, 'Changed')
+    follow(gui)
+    assert gui.rides_by_id[ride_id].comment == 'Changed'
+    version = bike.db_version()
+    bike.delete_ride(ride_id)
+    gui.change_ride(version, stale, None)
+    assert gui.reloads == 0
+    assert ride_id not in gui.rides_by_id
+    assert gui.year_totals[2022] == pytest.approx(
+        sum(row[1] for row in rides[31:-1]))
+    assert gui.search_index.search('changed') == []
+    assert gui.sums[0] == len(rides) - 32
+
+
+def test_remove_a_ride_deleted_by_another_program(gui, rides):
+    stale = gui.rides_by_id[40]
+    bike.delete_ride(40)
+    follow(gui)
+    assert 40 not in gui.rides_by_id
+    gui.apply_changes([(stale, None)])
+    assert gui.reloads == 1
+
+
+def test_search_finds_the_rides_as_changed(gui, rides):
+    gui.search_text.set('edited')
+    bike.add_ride(datetime(2022, 2, 1), 5, 1, 'Edited')
+    follow(gui)
+    gui.show_rides()
+    assert [ride.id for ride in gui.rides_view.rides] == [len(rides)]
+    bike.update_ride(len(rides), datetime(2022, 2, 1), 5, 1, 'Edited again')
+    follow(gui)
+    gui.show_rides()
+    assert [ride.comment for ride in gui.rides_view.rides] == [
+        'Edited again']
+
+
+def test_own_changes_are_not_applied_again(gui, rides):
+    version = bike.db_version()
+    ride_id = bike.add_ride(datetime(2022, 2, 1), 5, 1, 'Mine')
+    gui.change_ride(version, None, gui.make_ride(
+        (datetime(2022, 2, 1), 5.0, 1.0, 'Mine', ''), ride_id))
+    bike.update_ride(ride_id, datetime(2022, 2, 2), 6, 1, 'Other')
+    bike.delete_ride(3)
+    data = Velociraptor.read_rides(gui.follow_position)
+    changes = gui.new_changes(data['rides'], data['edits'])
+    assert [(old and old.comment, new and new.comment)
+            for old, new in changes] == [('Mine', 'Other'), ('Ride 3', None)]
+    gui.apply_changes(changes)
+    assert gui.rides_by_id[ride_id].comment == 'Other'
+    assert 3 not in gui.rides_by_id
+    assert gui.reloads == 0
+
+
+def test_lru_cache():
+    cache = Velociraptor.LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert len(cache) == 2
+    assert cache.get('b', 0) == 0
+    cache['a'] = 4
+    cache['d'] = 5
+    assert list(cache.entries.items()) == [('a', 4), ('d', 5)]
+    assert cache.pop('a') == 4
+    assert cache.pop('a') is None
+
+
+def test_views_of_changed_years_are_dropped(gui, rides):
+    for key in ['2021', Velociraptor.ALL_YEARS]:
+        gui.view_entry(key)['sums'] = [0, 0.0, 0.0, 0.0]
+    assert '2021' in gui.view_cache and '2022' in gui.view_cache
+    gui.apply_changes([(None, gui.make_ride(
+        (datetime(2021, 12, 31, 12), 5.0, 1.0, '', ''), len(rides)))])
+    assert '2021' not in gui.view_cache
+    assert Velociraptor.ALL_YEARS not in gui.view_cache
+    # The year shown is updated in place rather than dropped.
+    assert gui.view_cache.get('2022') is not None
+    assert gui.sums[0] == 30
+    gui.apply_changes([(None, gui.make_ride(
+        (datetime(2022, 2, 1), 5.0, 1.0, '', ''), len(rides) + 1))])
+    assert gui.view_cache.get('2022')['sums'][0] == 31